@@ -0,0 +1,222 @@
+from concurrent.futures import Future
+
+from codec import DAP_TRANSFER, transfer_words
+from dap import CSW_WORD_INC, TAR_BLOCK
+
+# debug port registers
+DP_DPIDR = 0x0
+DP_ABORT = 0x0
+DP_CTRL_STAT = 0x4
+DP_SELECT = 0x8
+DP_RDBUFF = 0xc
+
+# mem-ap registers, the upper four bits select the register bank
+AP_CSW = 0x00
+AP_TAR = 0x04
+AP_DRW = 0x0c
+AP_BASE = 0xf8
+AP_IDR = 0xfc
+
+# DAP_Transfer acknowledgements
+ACK_OK = 0x01
+ACK_WAIT = 0x02
+ACK_FAULT = 0x04
+ACK_NO_RESPONSE = 0x07
+
+# ABORT bits, to abort a stalled transaction, and to clear the sticky error flags
+ABORT_DAPABORT = 0x01
+ABORT_CLEAR_STICKY = 0x1e
+
+class TransferError(ValueError):
+    def __init__(self, ack, ctrl_stat=None):
+        # ack is the DAP_Transfer acknowledgement of the failed access, ctrl_stat is read after a fault
+        self.ack = ack
+        self.ctrl_stat = ctrl_stat
+        names = {ACK_WAIT: 'wait', ACK_FAULT: 'fault', ACK_NO_RESPONSE: 'no response'}
+        message = names.get(ack, f'ack 0x{ack:02x}')
+        if ctrl_stat is not None:
+            message += f', ctrl/stat 0x{ctrl_stat:08x}'
+        super().__init__(f'dap transfer failed: {message}')
+
+class DebugPort:
+    # queues dp and ap register accesses, and sends them as few DAP_Transfer commands as will fit in a
+    # packet, the probe pipelines the posted ap reads within each command, SELECT writes are skipped
+    # when they wouldn't change it
+    def __init__(self, dap, index=0):
+        self.dap = dap
+        # jtag device index, ignored for swd
+        self.index = index
+        # (request byte, write value, future) for each access not yet sent
+        self.pending = []
+        # accesses are only queued inside batch, and sent right away otherwise
+        self.batching = 0
+        # last value written to SELECT, None when unknown
+        self.select = None
+        self.aps = {}
+
+    def ap(self, apsel=0):
+        if apsel not in self.aps:
+            self.aps[apsel] = AccessPort(self, apsel)
+        return self.aps[apsel]
+
+    def batch(self):
+        return DebugPortBatch(self)
+
+    def read_dp(self, addr):
+        assert(addr in (DP_DPIDR, DP_CTRL_STAT, DP_SELECT, DP_RDBUFF))
+        return self._queue(0x02 | addr)
+
+    def write_dp(self, addr, value):
+        assert(addr in (DP_ABORT, DP_CTRL_STAT, DP_SELECT))
+        if addr == DP_SELECT:
+            if value == self.select:
+                return self._done(None)
+            self.select = value
+        return self._queue(addr, value)
+
+    def _access_ap(self, apsel, addr, value=None):
+        select = (apsel << 24) | (addr & 0xf0)
+        if select != self.select:
+            self.write_dp(DP_SELECT, select)
+        request = 0x01 | (addr & 0x0c) | (0x02 if value is None else 0x00)
+        return self._queue(request, value)
+
+    def _queue(self, request, value=None):
+        future = Future()
+        self.pending.append((request, value, future))
+        if not self.batching:
+            self.flush()
+        return future
+
+    def _done(self, result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def invalidate(self):
+        # forget cached register values, after an error or anything else that touched the dap
+        self.select = None
+        for ap in self.aps.values():
+            ap.csw = ap.tar = None
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        commands = self._commands(pending)
+        for num, (request, accesses) in enumerate(commands):
+            response = self.dap.command(request)
+            assert(response[0] == DAP_TRANSFER)
+            done, ack = response[1], response[2]
+            words = iter(transfer_words(response))
+            for request_byte, _, future in accesses[:done]:
+                future.set_result(next(words) if request_byte & 0x02 else None)
+            if done < len(accesses):
+                error = self._recover(ack)
+                for _, _, future in accesses[done:]:
+                    future.set_exception(error)
+                for _, later in commands[num+1:]:
+                    for _, _, future in later:
+                        future.set_exception(error)
+                raise error
+
+    def _commands(self, pending):
+        # split accesses into DAP_Transfer requests that fit the packet size for both the request and
+        # the response, and the transfer count
+        limit = self.dap.packet_size
+        commands = []
+        current, accesses, response_len = bytearray(), [], 3
+        for access in pending:
+            request, value, _ = access
+            data = bytes([request]) + (value.to_bytes(4, 'little') if value is not None else b'')
+            read = 4 if request & 0x02 else 0
+            fits = len(accesses) < 255 and 3 + len(current) + len(data) <= limit and response_len + read <= limit
+            if accesses and not fits:
+                commands.append((b'\x05' + bytes([self.index, len(accesses)]) + current, accesses))
+                current, accesses, response_len = bytearray(), [], 3
+            current += data
+            accesses.append(access)
+            response_len += read
+        if accesses:
+            commands.append((b'\x05' + bytes([self.index, len(accesses)]) + current, accesses))
+        return commands
+
+    def _recover(self, ack):
+        # the remaining accesses were dropped, so cached register values can't be trusted, a wait that
+        # outlasted the probe's retries is aborted, and sticky errors from a fault are cleared
+        self.invalidate()
+        ctrl_stat = None
+        if ack == ACK_WAIT:
+            self._write_abort(ABORT_DAPABORT)
+        elif ack == ACK_FAULT:
+            response = self.dap.command(b'\x05' + bytes([self.index]) + b'\x01\x06')
+            if response[0:3] == b'\x05\x01\x01':
+                ctrl_stat = int.from_bytes(response[3:7], 'little')
+            self._write_abort(ABORT_CLEAR_STICKY)
+        return TransferError(ack, ctrl_stat)
+
+    def _write_abort(self, value):
+        # DAP_WriteABORT, which works for both swd and jtag (where ABORT has its own instruction)
+        self.dap.command(b'\x08' + bytes([self.index]) + value.to_bytes(4, 'little'), expect=b'\x08\x00')
+
+class DebugPortBatch:
+    # queues every access made inside the context, and sends them together on exit
+    def __init__(self, dp):
+        self.dp = dp
+
+    def __enter__(self):
+        self.dp.batching += 1
+        return self.dp
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.dp.batching -= 1
+        if not self.dp.batching:
+            if exc_type is None:
+                self.dp.flush()
+            else:
+                self.dp.pending = []
+                self.dp.invalidate()
+
+class AccessPort:
+    # a mem-ap, CSW and TAR writes are skipped when they wouldn't change them, and TAR follows the
+    # auto increment of DRW accesses
+    def __init__(self, dp, apsel):
+        self.dp = dp
+        self.apsel = apsel
+        self.csw = None
+        self.tar = None
+
+    def read(self, addr):
+        future = self.dp._access_ap(self.apsel, addr)
+        self._accessed(addr)
+        return future
+
+    def write(self, addr, value):
+        if addr == AP_CSW:
+            if value == self.csw:
+                return self.dp._done(None)
+            self.csw = value
+        elif addr == AP_TAR:
+            if value == self.tar:
+                return self.dp._done(None)
+            self.tar = value
+        future = self.dp._access_ap(self.apsel, addr, value)
+        self._accessed(addr)
+        return future
+
+    def read32(self, addr):
+        self.write(AP_CSW, CSW_WORD_INC)
+        self.write(AP_TAR, addr)
+        return self.read(AP_DRW)
+
+    def write32(self, addr, value):
+        self.write(AP_CSW, CSW_WORD_INC)
+        self.write(AP_TAR, addr)
+        return self.write(AP_DRW, value)
+
+    def _accessed(self, addr):
+        if addr != AP_DRW or self.tar is None:
+            return
+        # auto increment only within a 1k block, past that TAR is unknown
+        if self.csw == CSW_WORD_INC and (self.tar + 4) % TAR_BLOCK != 0:
+            self.tar += 4
+        else:
+            self.tar = None
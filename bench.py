@@ -0,0 +1,189 @@
+import argparse
+import json
+import platform
+import statistics
+import sys
+import time
+import usb.core
+
+from conftest import EDBG_VID, EDBG_PID, RICEPROBE_VID, RICEPROBE_PID
+from dap import Dap
+from riceio import RiceIO, find_endpoints
+from simulator import SimBackend, SimProbe
+from usbtrace import TraceBuffer, TracedEndpoint, TracedSerial, format_summary, summarize
+
+# commands timed for round trip latency, run after configuring jtag and the tap chain, all of which
+# leave the tap in idle
+LATENCY_COMMANDS = {
+    0x00: b'\x00\x04',
+    0x01: b'\x01\x00\x00',
+    0x05: b'\x05\x00\x01\x06',
+    0x06: b'\x06\x00\x01\x00\x06',
+    0x11: b'\x11\x40\x42\x0f\x00',
+    0x12: b'\x12\x08\x00',
+    0x14: b'\x14\x01\x08\x00',
+    0x16: b'\x16\x00',
+}
+BLOCK_WORDS = [1, 16, 64, 127]
+LOOPBACK_SIZES = [1, 64, 256, 512]
+VCP_SIZES = [16, 256, 1024]
+SWJ_CLOCKS = [100000, 500000, 1000000, 2000000, 4000000, 8000000]
+
+def percentile(samples, pct):
+    return statistics.quantiles(samples, n=100, method='inclusive')[pct - 1]
+
+def time_calls(fn, iterations):
+    samples = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        fn()
+        samples.append(time.perf_counter() - start)
+    return samples
+
+def latency_metrics(name, samples):
+    return {
+        f'{name}.p50_us': percentile(samples, 50) * 1e6,
+        f'{name}.p99_us': percentile(samples, 99) * 1e6,
+    }
+
+def bench_dap(dap, iterations):
+    results = {}
+    dap.configure_jtag()
+    dap.command(b'\x15\x02\x04\x05', expect=b'\x15\x00')
+    dap.power_up()
+
+    for cmd, request in LATENCY_COMMANDS.items():
+        samples = time_calls(lambda: dap.command(request), iterations)
+        results.update(latency_metrics(f'latency.0x{cmd:02x}', samples))
+
+    # ap 0 TAR reads don't touch target memory, so measure the transfer path alone
+    dap.command(b'\x05\x00\x02\x08\x00\x00\x00\x00\x01\x12\x00\x00\x22', expect=b'\x05\x02\x01')
+    for words in BLOCK_WORDS:
+        request = b'\x06\x00' + words.to_bytes(2, 'little') + b'\x07'
+        samples = time_calls(lambda: dap.command(request), iterations)
+        results[f'transfer_block.{words}w.bytes_per_s'] = 4 * words / statistics.median(samples)
+
+    address, length = 0x2009e000, 0x2000
+    samples = time_calls(lambda: dap.read_memory(address, length), max(iterations // 10, 3))
+    results[f'read_memory.{length}.bytes_per_s'] = length / statistics.median(samples)
+    data = bytes(length)
+    samples = time_calls(lambda: dap.write_memory(address, data), max(iterations // 10, 3))
+    results[f'write_memory.{length}.bytes_per_s'] = length / statistics.median(samples)
+
+    request = b'\x06\x00\x7f\x00\x07'
+    for clock in SWJ_CLOCKS:
+        dap.command(b'\x11' + clock.to_bytes(4, 'little'), expect=b'\x11\x00')
+        samples = time_calls(lambda: dap.command(request), max(iterations // 4, 3))
+        results[f'swj_clock.{clock}.bytes_per_s'] = 4 * 0x7f / statistics.median(samples)
+    dap.command(b'\x11\x40\x42\x0f\x00', expect=b'\x11\x00')
+    return results
+
+def bench_loopback(usb_device, iterations, trace=None):
+    results = {}
+    (out_ep, in_ep) = find_endpoints(usb_device)
+    if trace is not None:
+        out_ep = in_ep = TracedEndpoint(out_ep, in_ep, trace)
+    for size in LOOPBACK_SIZES:
+        data = bytes(n & 0xff for n in range(size))
+        def loopback():
+            out_ep.write(data)
+            assert(in_ep.read(512).tobytes() == data)
+        samples = time_calls(loopback, iterations)
+        results.update(latency_metrics(f'loopback.{size}', samples))
+        results[f'loopback.{size}.bytes_per_s'] = size / statistics.median(samples)
+    # sustained streaming, with several transfers in flight each way
+    stream = RiceIO(out_ep, in_ep).stream(packets=max(iterations * 5, 100))
+    assert(stream['errors'] == stream['missing'] == 0 and not stream['failures'])
+    results['loopback.stream.bytes_per_s'] = stream['bytes_per_s']
+    results['loopback.stream.p99_us'] = stream['latency.p99_us']
+    return results
+
+def bench_vcp(iterations, trace=None):
+    import serial
+
+    results = {}
+    edbg_ser = serial.serial_for_url(f'hwgrep://{EDBG_VID:x}:{EDBG_PID:x}', baudrate=115200, timeout=1.0)
+    rice_ser = serial.serial_for_url(f'hwgrep://{RICEPROBE_VID:x}:{RICEPROBE_PID:x}', baudrate=115200, timeout=1.0)
+    if trace is not None:
+        rice_ser = TracedSerial(rice_ser, trace)
+    for size in VCP_SIZES:
+        data = bytes(n & 0xff for n in range(size))
+        def loopback():
+            rice_ser.write(data)
+            assert(edbg_ser.read(size) == data)
+        samples = time_calls(loopback, max(iterations // 10, 3))
+        results[f'vcp.{size}.bytes_per_s'] = size / statistics.median(samples)
+    edbg_ser.close()
+    rice_ser.close()
+    return results
+
+def run(backend=None, iterations=200, vcp=False, trace=None):
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=backend)
+    dap.trace = trace
+    try:
+        results = bench_dap(dap, iterations)
+    finally:
+        dap.shutdown()
+    usb_device = usb.core.find(idVendor=RICEPROBE_VID, idProduct=RICEPROBE_PID, backend=backend)
+    results.update(bench_loopback(usb_device, iterations, trace))
+    if vcp:
+        results.update(bench_vcp(iterations, trace))
+    return results
+
+def compare(results, baseline, threshold):
+    # returns (metric, baseline, result, relative change) for each regression beyond the threshold,
+    # latencies regress when they grow and throughputs when they shrink
+    regressions = []
+    for name, base in baseline.items():
+        if name not in results or base == 0:
+            continue
+        change = (results[name] - base) / base
+        worse = change > threshold if name.endswith('_us') else change < -threshold
+        if worse:
+            regressions.append((name, base, results[name], change))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='RICEProbe latency and throughput benchmarks')
+    parser.add_argument('--sim', action='store_true', help='run against the simulated probe')
+    parser.add_argument('--sim-latency', type=float, default=125e-6, help='simulated usb round trip, in seconds')
+    parser.add_argument('--vcp', action='store_true', help='include the vcp, needs the embedded debugger on the target')
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--output', help='write results as json to this file')
+    parser.add_argument('--compare', metavar='BASELINE', help='flag regressions against a stored json baseline')
+    parser.add_argument('--threshold', type=float, default=0.1, help='relative change counted as a regression')
+    parser.add_argument('--trace', metavar='FILE', help='record usb transfers to this file and summarize them')
+    args = parser.parse_args(argv)
+
+    backend = None
+    if args.sim:
+        backend = SimBackend([SimProbe(packet_latency=args.sim_latency, clocked=True)])
+    trace = TraceBuffer() if args.trace else None
+    results = run(backend, args.iterations, args.vcp and not args.sim, trace)
+    if trace is not None:
+        trace.dump(args.trace)
+        print(format_summary(summarize(trace.records())), file=sys.stderr)
+    report = {
+        'device': 'sim' if args.sim else 'hardware',
+        'host': platform.node(),
+        'time': time.time(),
+        'results': results,
+    }
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as file:
+            file.write(text)
+    else:
+        print(text)
+
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)['results']
+        regressions = compare(results, baseline, args.threshold)
+        for name, base, result, change in regressions:
+            print(f'REGRESSION {name}: {base:.1f} -> {result:.1f} ({change:+.1%})', file=sys.stderr)
+        return 1 if regressions else 0
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,169 @@
+import array
+import struct
+import sys
+
+# command ids
+DAP_INFO = 0x00
+DAP_HOST_STATUS = 0x01
+DAP_CONNECT = 0x02
+DAP_DISCONNECT = 0x03
+DAP_TRANSFER_CONFIGURE = 0x04
+DAP_TRANSFER = 0x05
+DAP_TRANSFER_BLOCK = 0x06
+DAP_TRANSFER_ABORT = 0x07
+DAP_WRITE_ABORT = 0x08
+DAP_DELAY = 0x09
+DAP_RESET_TARGET = 0x0a
+DAP_SWJ_PINS = 0x10
+DAP_SWJ_CLOCK = 0x11
+DAP_SWJ_SEQUENCE = 0x12
+DAP_SWD_CONFIGURE = 0x13
+DAP_JTAG_SEQUENCE = 0x14
+DAP_JTAG_CONFIGURE = 0x15
+DAP_JTAG_IDCODE = 0x16
+DAP_SWD_SEQUENCE = 0x1d
+DAP_QUEUE_COMMANDS = 0x7e
+DAP_EXECUTE_COMMANDS = 0x7f
+
+class Command:
+    # a command's fixed request fields (after the id) and fixed response fields (after the echoed id)
+    # as (name, struct format) pairs, any variable data follows the fixed fields, as the tail
+    def __init__(self, id, name, request=(), response=(('status', 'B'),), has_response=True):
+        self.id = id
+        self.name = name
+        self.request_fields = tuple(field for field, _ in request)
+        self.response_fields = tuple(field for field, _ in response)
+        self.request = struct.Struct('<B' + ''.join(fmt for _, fmt in request))
+        self.response = struct.Struct('<B' + ''.join(fmt for _, fmt in response))
+        # DAP_TransferAbort is never answered
+        self.has_response = has_response
+
+COMMANDS = {command.id: command for command in [
+    Command(DAP_INFO, 'info', [('info', 'B')], [('length', 'B')]),
+    Command(DAP_HOST_STATUS, 'host_status', [('type', 'B'), ('status', 'B')]),
+    Command(DAP_CONNECT, 'connect', [('port', 'B')], [('port', 'B')]),
+    Command(DAP_DISCONNECT, 'disconnect'),
+    Command(
+        DAP_TRANSFER_CONFIGURE, 'transfer_configure', [('idle', 'B'), ('wait_retry', 'H'), ('match_retry', 'H')]
+    ),
+    Command(DAP_TRANSFER, 'transfer', [('index', 'B'), ('count', 'B')], [('count', 'B'), ('ack', 'B')]),
+    Command(
+        DAP_TRANSFER_BLOCK, 'transfer_block', [('index', 'B'), ('count', 'H'), ('request', 'B')],
+        [('count', 'H'), ('ack', 'B')]
+    ),
+    Command(DAP_TRANSFER_ABORT, 'transfer_abort', response=(), has_response=False),
+    Command(DAP_WRITE_ABORT, 'write_abort', [('index', 'B'), ('abort', 'I')]),
+    Command(DAP_DELAY, 'delay', [('delay', 'H')]),
+    Command(DAP_RESET_TARGET, 'reset_target', response=[('status', 'B'), ('execute', 'B')]),
+    Command(DAP_SWJ_PINS, 'swj_pins', [('output', 'B'), ('select', 'B'), ('wait', 'I')], [('pins', 'B')]),
+    Command(DAP_SWJ_CLOCK, 'swj_clock', [('clock', 'I')]),
+    Command(DAP_SWJ_SEQUENCE, 'swj_sequence', [('count', 'B')]),
+    Command(DAP_SWD_CONFIGURE, 'swd_configure', [('configuration', 'B')]),
+    Command(DAP_JTAG_SEQUENCE, 'jtag_sequence', [('count', 'B')]),
+    Command(DAP_JTAG_CONFIGURE, 'jtag_configure', [('count', 'B')]),
+    Command(DAP_JTAG_IDCODE, 'jtag_idcode', [('index', 'B')], [('status', 'B'), ('idcode', 'I')]),
+    Command(DAP_SWD_SEQUENCE, 'swd_sequence', [('count', 'B')]),
+    Command(DAP_QUEUE_COMMANDS, 'queue_commands', [('count', 'B')], response=()),
+    Command(DAP_EXECUTE_COMMANDS, 'execute_commands', [('count', 'B')], [('count', 'B')]),
+]}
+
+def command_name(id):
+    command = COMMANDS.get(id)
+    return command.name if command is not None else f'0x{id:02x}'
+
+class Encoder:
+    # encodes requests into one reusable packet buffer, each result is a view of that buffer, valid
+    # until the next encode
+    def __init__(self, size=512):
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+
+    def encode(self, id, *fields, tail=b''):
+        command = COMMANDS[id]
+        size = command.request.size
+        command.request.pack_into(self.buffer, 0, id, *fields)
+        self.view[size:size+len(tail)] = tail
+        return self.view[:size+len(tail)]
+
+def encode(id, *fields, tail=b''):
+    command = COMMANDS[id]
+    return command.request.pack(id, *fields) + bytes(tail)
+
+def decode_request(data):
+    # (command, fixed fields, tail as a view of data)
+    view = memoryview(data)
+    command = COMMANDS[view[0]]
+    size = command.request.size
+    return command, command.request.unpack_from(view)[1:], view[size:]
+
+def decode_response(data):
+    # (command, fixed fields, tail as a view of data), a single 0xff byte (unsupported or incomplete
+    # command) raises ValueError
+    view = memoryview(data)
+    command = COMMANDS.get(view[0]) if len(view) else None
+    if command is None or len(view) < command.response.size:
+        raise ValueError(f'invalid response {bytes(view[:8]).hex()}')
+    size = command.response.size
+    return command, command.response.unpack_from(view)[1:], view[size:]
+
+def _words(view, out):
+    out.frombytes(view[:len(view) & ~0x3])
+    return out
+
+def transfer_words(response, out=None):
+    # data words of a DAP_Transfer response, for requests without value match or timestamps these
+    # are the read values in order
+    out = array.array('I') if out is None else out
+    start = len(out)
+    _words(memoryview(response)[3:], out)
+    if sys.byteorder == 'big':
+        _byteswap(out, start)
+    return out
+
+def block_words(response, out=None):
+    # data words of a DAP_TransferBlock read response
+    view = memoryview(response)
+    out = array.array('I') if out is None else out
+    start = len(out)
+    count = view[1] | (view[2] << 8)
+    _words(view[4:4+4*count], out)
+    if sys.byteorder == 'big':
+        _byteswap(out, start)
+    return out
+
+def decode_words(responses, out=None):
+    # every data word of a run of DAP_Transfer and DAP_TransferBlock read responses, in one array
+    out = array.array('I') if out is None else out
+    start = len(out)
+    for response in responses:
+        view = memoryview(response)
+        if view[0] == DAP_TRANSFER_BLOCK:
+            _words(view[4:4+4*(view[1] | (view[2] << 8))], out)
+        else:
+            _words(view[3:], out)
+    if sys.byteorder == 'big':
+        _byteswap(out, start)
+    return out
+
+def decode_words_numpy(responses):
+    # as decode_words, as a numpy uint32 array, numpy is only needed for this
+    import numpy
+
+    pieces = []
+    for response in responses:
+        view = memoryview(response)
+        if view[0] == DAP_TRANSFER_BLOCK:
+            view = view[4:4+4*(view[1] | (view[2] << 8))]
+        else:
+            view = view[3:]
+        pieces.append(numpy.frombuffer(view[:len(view) & ~0x3], dtype='<u4'))
+    return numpy.concatenate(pieces).astype(numpy.uint32, copy=False) if pieces else numpy.zeros(0, numpy.uint32)
+
+def _byteswap(out, start):
+    # only words from start were just decoded
+    if start == 0:
+        out.byteswap()
+        return
+    tail = array.array('I', out[start:])
+    tail.byteswap()
+    out[start:] = tail
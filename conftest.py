@@ -1,3 +1,4 @@
+import os
 import pytest
 import usb.core
 
@@ -5,29 +6,148 @@ pytest.register_assert_rewrite('dap')
 pytest.register_assert_rewrite('openocd')
 
 from dap import Dap
-from openocd import OpenOCD
+from openocd import OpenOCDPool
+from probes import ProbeLock, find_device, find_serials, openocd_ports
+from replay import RecordingBackend, ReplayBackend, default_backend
+from simulator import SimBackend, SimProbe
+from symbols import TARGET_ELF, SymbolIndex
 
 RICEPROBE_VID = 0xFFFE
 RICEPROBE_PID = 0xFFD1
+# the embedded debugger on the target board, whose vcp is the far end of the probe's
+EDBG_VID = 0x03EB
+EDBG_PID = 0x2111
+
+def sim_serial(num):
+    # serial numbers of simulated probes, the first matches the simulator default
+    return f'RPB1-2300{num:06d}1'
+
+def pytest_addoption(parser):
+    parser.addoption('--sim', action='store_true', help='run against a simulated probe instead of hardware')
+    parser.addoption('--sim-probes', type=int, default=1, help='number of simulated probes')
+    parser.addoption(
+        '--probe', action='append', default=[], metavar='SERIAL',
+        help='run on the probe with this serial number, can be repeated, defaults to every attached probe'
+    )
+    parser.addoption('--record', metavar='FILE', help='record all usb traffic to this file, to replay later')
+    parser.addoption('--replay', metavar='FILE', help='run against a recording instead of a probe')
+    parser.addoption('--replay-timing', action='store_true', help='replay responses with their recorded latency')
+    parser.addoption(
+        '--autotune-clock', action='store_true',
+        help='run each probe at its fastest stable swj clock, tuned once and then read from the clock cache'
+    )
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'hardware: test needs the physical probe and target, even with --sim')
+    config.addinivalue_line(
+        'markers', 'no_replay: test traffic depends on thread timing, so it is left out of --record and --replay'
+    )
+    # None lets pyusb pick the system backend for real hardware
+    config.usb_backend = None
+    if config.getoption('--sim'):
+        probes = [SimProbe(serial=sim_serial(n)) for n in range(config.getoption('--sim-probes'))]
+        config.usb_backend = SimBackend(probes)
+    if config.getoption('--replay'):
+        config.usb_backend = ReplayBackend.load(config.getoption('--replay'), config.getoption('--replay-timing'))
+    elif config.getoption('--record'):
+        config.usb_backend = RecordingBackend(config.usb_backend or default_backend())
+    config.attached_serials = None
+
+def attached_serials(config):
+    # every attached probe, for stable port assignments, enumerated on first use so sessions that never
+    # touch a probe (and machines without libusb) don't need one
+    if config.attached_serials is None:
+        try:
+            config.attached_serials = find_serials(RICEPROBE_VID, RICEPROBE_PID, config.usb_backend)
+        except usb.core.NoBackendError:
+            config.attached_serials = []
+    return config.attached_serials
+
+def probe_serials(config):
+    # the probes to run on
+    return config.getoption('--probe') or attached_serials(config)
+
+def pytest_unconfigure(config):
+    if isinstance(getattr(config, 'usb_backend', None), RecordingBackend):
+        config.usb_backend.save(config.getoption('--record'))
+
+def pytest_generate_tests(metafunc):
+    # with several probes, every test that uses one runs on each of them
+    if 'probe_serial' not in metafunc.fixturenames:
+        return
+    serials = probe_serials(metafunc.config)
+    if len(serials) > 1:
+        metafunc.parametrize('probe_serial', serials, indirect=True, scope='session')
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--record') or config.getoption('--replay'):
+        # skipped when recording too, so a replay doesn't find their traffic in the way of the next test
+        skip = pytest.mark.skip(reason='usb traffic depends on thread timing, can not be replayed')
+        for item in items:
+            if 'no_replay' in item.keywords:
+                item.add_marker(skip)
+    hardware = [item for item in items if 'hardware' in item.keywords]
+    if config.getoption('--sim') or config.getoption('--replay'):
+        skip = pytest.mark.skip(reason='needs hardware, not available with --sim or --replay')
+    elif hardware and not probe_serials(config):
+        skip = pytest.mark.skip(reason='needs hardware, no probe attached')
+    else:
+        return
+    for item in hardware:
+        item.add_marker(skip)
+
+@pytest.fixture(scope='session')
+def usb_backend(request):
+    return request.config.usb_backend
+
+@pytest.fixture(scope='session')
+def probe_serial(request):
+    # the probe is held exclusively for the session, so other test runs on the same bench wait for it
+    serials = probe_serials(request.config)
+    serial = getattr(request, 'param', serials[0] if serials else None)
+    if serial is None:
+        pytest.skip('no probe attached')
+    if request.config.getoption('--sim') or request.config.getoption('--replay'):
+        yield serial
+        return
+    with ProbeLock(serial):
+        yield serial
 
 @pytest.fixture(scope='module')
-def usb_device():
-    dev = usb.core.find(idVendor=RICEPROBE_VID, idProduct=RICEPROBE_PID)
+def usb_device(usb_backend, probe_serial):
+    dev = find_device(RICEPROBE_VID, RICEPROBE_PID, probe_serial, usb_backend)
     yield dev
     dev.reset()
 
 @pytest.fixture(scope='module')
-def dap():
-    dap = Dap(RICEPROBE_VID, RICEPROBE_PID)
+def dap(request, usb_backend, probe_serial):
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=usb_backend, serial=probe_serial)
+    if request.config.getoption('--autotune-clock'):
+        # later bring-ups (of either port) use the tuned rate
+        dap.configure_swd()
+        dap.autotune_clock()
     yield dap
     dap.shutdown()
 
+@pytest.fixture(scope='session')
+def symbols():
+    # symbols of the target image, None when it hasn't been built here
+    return SymbolIndex() if os.path.exists(TARGET_ELF) else None
+
+@pytest.fixture(scope='session')
+def openocd_pool():
+    # openocd servers are started on first use and kept running for the whole session, the init
+    # commands ensure the target is reset, initialized, and running, since we connected under reset
+    pool = OpenOCDPool(init_commands=[b'reset run'])
+    yield pool
+    pool.close()
+
 @pytest.fixture(scope='module')
-def openocd_rtt():
-    openocd = OpenOCD()
-    openocd.start()
-    # ensure the target is reset, initialized, and running, since we connected under reset
-    openocd.send(b'reset run')
+def openocd_rtt(request, openocd_pool, probe_serial):
+    # each probe gets its own set of openocd ports
+    serials = attached_serials(request.config)
+    ports = openocd_ports(serials.index(probe_serial) if probe_serial in serials else 0)
+    openocd = openocd_pool.acquire(serial=probe_serial, **ports)
 
     rtt = openocd.enable_rtt()
     # make sure we can send and receive data from the shell
@@ -36,4 +156,4 @@ def openocd_rtt():
     assert(rtt.expect_bytes(b'target:~$ ') is not None)
 
     yield openocd, rtt
-    openocd.close()
+    openocd_pool.release(openocd)
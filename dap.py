@@ -1,10 +1,319 @@
+from concurrent.futures import Future
+import collections
+import json
+import os
+import queue
+import threading
 import time
-import usb.core
 import usb.util
 
+from probes import find_device
+from usbtrace import CHANNEL_DAP, TRACE_IN
+
+# commands which wrap other commands, and so can't themselves be batched
+QUEUE_COMMANDS = 0x7e
+EXECUTE_COMMANDS = 0x7f
+
+# MEM-AP CSW for 32-bit accesses with single address increment (from openocd arm_adi_v5.h)
+CSW_WORD_INC = 0x22000012
+# and for 8-bit accesses
+CSW_BYTE_INC = 0x22000010
+# TAR auto increment is only guaranteed within a 1k block
+TAR_BLOCK = 0x400
+
+# commands that leave the port, clock, chain, and tap or line state as they were
+LINK_NEUTRAL = {0x00, 0x01, 0x04, 0x05, 0x06, 0x07, 0x08, 0x09, 0x16}
+# swj clock used by configure_jtag and configure_swd (1MHz)
+DEFAULT_CLOCK = 1000000
+# reset pulse length, in microseconds
+RESET_PULSE = 10000
+
+# swj clock tuning: the fastest rate tried, the fraction of the fastest stable rate used, and where
+# tuned rates are kept, per probe serial and target idcode
+CLOCK_MAX = 50000000
+CLOCK_MARGIN = 0.75
+CLOCK_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'riceprobe', 'swj_clock.json')
+# link selection sequences run by configure_jtag and configure_swd after the line reset
+JTAG_SELECT = [
+    # issue JTAG-to-SWD sequence
+    (b'\x12\x10\x3c\xe7', b'\x12\x00'),
+    # jtag reset
+    (b'\x12\x08\xff', b'\x12\x00'),
+    # set jtag tap state to reset then idle
+    (b'\x14\x02\x48\x00\x01\x00', b'\x14\x00'),
+]
+SWD_SELECT = [
+    # issue JTAG-to-SWD sequence
+    (b'\x12\x10\x9e\xe7', b'\x12\x00'),
+    # SWD reset
+    (b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', b'\x12\x00'),
+    # at least 2 idle cycles
+    (b'\x12\x08\x00', b'\x12\x00'),
+]
+# memory pattern written and read back while tuning
+CLOCK_PATTERN = bytes([0x55, 0xaa, 0x33, 0xcc, 0x0f, 0xf0, 0x00, 0xff] * 32)
+
+def _sequence_bytes(info):
+    # bit count of a jtag or swd sequence info byte, where 0 means 64 bits
+    count = info & 0x3f
+    return ((count if count else 64) + 7) // 8
+
+def _transfer_size(request, count):
+    # response size of the first count transfers in a DAP_Transfer request
+    size, idx = 3, 3
+    for _ in range(count):
+        xfer = request[idx]
+        idx += 1
+        # writes, and reads with value match, carry a data word in the request
+        if not xfer & 0x02 or xfer & 0x30:
+            idx += 4
+        # reads without value match, and timestamps, add a data word to the response
+        if xfer & 0x02 and not xfer & 0x10:
+            size += 4
+        if xfer & 0x80:
+            size += 4
+    return size
+
+def _response_size(request):
+    cmd = request[0]
+    if cmd == 0x00:
+        # strings have no fixed length, so assume they will take up a full packet
+        return {0xf0: 3, 0xf1: 6, 0xfb: 6, 0xfc: 6, 0xfd: 6, 0xfe: 3, 0xff: 4}.get(request[1], None)
+    if cmd == 0x0a:
+        return 3
+    if cmd == 0x16:
+        return 6
+    if cmd == 0x05:
+        return _transfer_size(request, request[2])
+    if cmd == 0x06:
+        count = int.from_bytes(request[2:4], 'little')
+        return 4 + (4 * count if request[4] & 0x02 else 0)
+    if cmd == 0x14:
+        size, idx = 2, 2
+        for _ in range(request[1]):
+            info = request[idx]
+            idx += 1 + _sequence_bytes(info)
+            if info & 0x80:
+                size += _sequence_bytes(info)
+        return size
+    if cmd == 0x1d:
+        size, idx = 2, 2
+        for _ in range(request[1]):
+            info = request[idx]
+            idx += 1
+            if info & 0x80:
+                size += _sequence_bytes(info)
+            else:
+                idx += _sequence_bytes(info)
+        return size
+    return 2
+
+def response_size(request):
+    # the largest response a single command can produce, used to decide how many commands fit in a packet
+    try:
+        return _response_size(request)
+    except IndexError:
+        # incomplete commands are answered with a single byte
+        return 1
+
+def response_length(request, response):
+    # the actual length of the response to a single command, found at the start of the response data
+    cmd = request[0]
+    if response[0] != cmd:
+        # unsupported or incomplete commands are answered with a single byte
+        return 1
+    if cmd == 0x00 and response_size(request) is None:
+        return 2 + response[1]
+    if cmd == 0x05:
+        return _transfer_size(request, response[1])
+    if cmd == 0x06:
+        count = int.from_bytes(response[1:3], 'little')
+        return 4 + (4 * count if request[4] & 0x02 else 0)
+    if cmd == 0x14 and response[1] != 0x00:
+        # a failed jtag sequence doesn't return any captured data
+        return 2
+    return response_size(request)
+
+class DapBatch:
+    def __init__(self, dap, queue=False):
+        self.dap = dap
+        self.queue = queue
+        self.commands = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+    def command(self, data, expect=None):
+        data = bytes(data)
+        # transfer abort is handled out of band by the probe, and can't be part of a batch
+        assert(data[0] not in (0x07, QUEUE_COMMANDS, EXECUTE_COMMANDS))
+        self.dap.observe(data)
+        future = Future()
+        self.commands.append((data, expect, future))
+        return future
+
+    def packets(self):
+        # pack as many commands into each packet as will fit for both the request and the response
+        packets = []
+        limit = self.dap.packet_size
+        current, request_len, response_len = [], 2, 2
+        for command in self.commands:
+            request = command[0]
+            response = response_size(request)
+            if response is None:
+                response = limit - 2
+            fits = (
+                len(current) < 255 and
+                request_len + len(request) <= limit and
+                response_len + response <= limit
+            )
+            if current and not fits:
+                packets.append(current)
+                current, request_len, response_len = [], 2, 2
+            current.append(command)
+            request_len += len(request)
+            response_len += response
+        if current:
+            packets.append(current)
+        return packets
+
+    def execute(self):
+        packets = self.packets()
+        self.commands = []
+        self.send(packets)
+
+    def send(self, packets):
+        # packets are lists of (request, expect, future), each of which must fit in a single packet
+        pipeline = self.dap.active_pipeline
+        # when queueing, the probe can only hold as many packets as it has buffers for
+        group = self.dap.packet_count if self.queue else 1
+        if pipeline is not None:
+            # the pipeline's reader owns the in endpoint, so submit packets ahead of reading responses,
+            # queued packets are only answered once the execute packet after them is in, so a group
+            # can't be deeper than the pipeline
+            group = min(group, pipeline.depth)
+            responses = []
+            for start in range(0, len(packets), group):
+                chunk = packets[start:start+group]
+                for num, packet in enumerate(chunk):
+                    cmd = QUEUE_COMMANDS if num < len(chunk) - 1 else EXECUTE_COMMANDS
+                    responses.append(pipeline._submit(self._request(packet, cmd)))
+            for packet, response in zip(packets, responses):
+                self._complete(packet, response.result())
+            return
+        for start in range(0, len(packets), group):
+            chunk = packets[start:start+group]
+            for num, packet in enumerate(chunk):
+                cmd = QUEUE_COMMANDS if num < len(chunk) - 1 else EXECUTE_COMMANDS
+                self.dap.write(self._request(packet, cmd))
+            for packet in chunk:
+                self._complete(packet, self.dap.read(self.dap.packet_size))
+
+    def _request(self, packet, cmd=EXECUTE_COMMANDS):
+        return bytes([cmd, len(packet)]) + b''.join(c[0] for c in packet)
+
+    def _complete(self, packet, data):
+        assert(data[0] in (QUEUE_COMMANDS, EXECUTE_COMMANDS) and data[1] == len(packet))
+        idx = 2
+        for request, expect, future in packet:
+            length = response_length(request, data[idx:])
+            response = data[idx:idx+length]
+            idx += length
+            if expect is not None:
+                assert(response == expect)
+            future.set_result(response)
+
+class DapPipeline:
+    def __init__(self, dap, depth=None):
+        self.dap = dap
+        # query packet details up front, the reader thread owns the in endpoint from here on
+        self.depth = depth if depth is not None else dap.packet_count
+        self.packet_size = dap.packet_size
+        self.slots = threading.Semaphore(self.depth)
+        # (future, expect) for each packet in flight, in the order they were written
+        self.pending = queue.Queue()
+        # held to queue and write a packet together, so submitting threads can't reorder them
+        self.lock = threading.Lock()
+        # the failed transfer that stopped the pipeline, responses after it can't be matched up
+        self.error = None
+        # commands go through the pipeline from before the reader starts, so nothing else reads
+        assert(dap.active_pipeline is None)
+        dap.active_pipeline = self
+        self.reader = threading.Thread(target=self._read, daemon=True)
+        self.reader.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, data, expect=None):
+        # write a command as soon as the probe has a free buffer, the returned future
+        # completes with the response
+        self.dap.observe(data)
+        return self._submit(data, expect)
+
+    def _submit(self, data, expect=None):
+        self.slots.acquire()
+        future = Future()
+        with self.lock:
+            if self.error is not None:
+                self.slots.release()
+                raise self._stopped()
+            self.pending.put((future, expect))
+            try:
+                self.dap.write(data)
+            except Exception as e:
+                # the reader fails the future, whether or not the packet went out
+                self.error = e
+                raise
+        return future
+
+    def _stopped(self):
+        error = ConnectionError('dap pipeline stopped by a failed transfer')
+        error.__cause__ = self.error
+        return error
+
+    def close(self):
+        # wait for everything in flight, then stop the reader
+        self.pending.put(None)
+        self.reader.join()
+        if self.dap.active_pipeline is self:
+            self.dap.active_pipeline = None
+
+    def _read(self):
+        while True:
+            item = self.pending.get()
+            if item is None:
+                return
+            future, expect = item
+            try:
+                if self.error is not None:
+                    raise self._stopped()
+                try:
+                    read = self.dap.read(self.packet_size)
+                except Exception as e:
+                    # a late response would answer the wrong command, so nothing more is read
+                    with self.lock:
+                        self.error = e
+                    raise
+                if expect is not None:
+                    assert(read == expect)
+                future.set_result(read)
+            except Exception as e:
+                future.set_exception(e)
+            finally:
+                self.slots.release()
+
 class Dap:
-    def __init__(self, vid, pid):
-        self.usb_device = usb.core.find(idVendor=vid, idProduct=pid)
+    def __init__(self, vid, pid, backend=None, serial=None):
+        # serial picks one of several attached probes, by default the first one found is used
+        self.usb_device = find_device(vid, pid, serial, backend)
         cfg = self.usb_device.get_active_configuration()
         intf = usb.util.find_descriptor(
             cfg,
@@ -12,70 +321,336 @@ class Dap:
         )
         self.out_ep, self.in_ep = intf.endpoints()
 
+        # probe packet details, queried on first use
+        self._packet_size = None
+        self._packet_count = None
+        # commands go through the pipeline while one is active, to keep responses in order
+        self.active_pipeline = None
+
+        # link state, as last configured, None where unknown: the port mode, swj clock, jtag chain
+        # ir lengths, and the port whose bring-up sequence is still in effect (cleared by anything
+        # that could disturb the line or tap state)
+        self.port = None
+        self.clock = None
+        self.chain = None
+        self.link = None
+        # swj clock used for bring-up, raised by autotune_clock
+        self.link_clock = DEFAULT_CLOCK
+
+        # opt in TraceBuffer recording every usb transfer, responses are matched to the requests they
+        # answer by order
+        self.trace = None
+        self.trace_writes = collections.deque()
+
+    @property
+    def packet_size(self):
+        if self._packet_size is None:
+            data = self.command(b'\x00\xff')
+            assert(data[0:2] == b'\x00\x02')
+            self._packet_size = int.from_bytes(data[2:4], 'little')
+        return self._packet_size
+
+    @property
+    def packet_count(self):
+        if self._packet_count is None:
+            data = self.command(b'\x00\xfe')
+            assert(data[0:2] == b'\x00\x01')
+            self._packet_count = data[2]
+        return self._packet_count
+
     def write(self, data):
-        return self.out_ep.write(data)
+        if self.trace is None:
+            return self.out_ep.write(data)
+        start = time.perf_counter_ns()
+        written = self.out_ep.write(data)
+        self.trace.record(start, time.perf_counter_ns(), CHANNEL_DAP, data[0] if len(data) else 0, len(data))
+        self.trace_writes.append(start)
+        return written
 
-    def read(self, len, timeout=None):
-        return self.in_ep.read(len, timeout).tobytes()
+    def read(self, size, timeout=None):
+        if self.trace is None:
+            return self.in_ep.read(size, timeout).tobytes()
+        data = self.in_ep.read(size, timeout).tobytes()
+        end = time.perf_counter_ns()
+        start = self.trace_writes.popleft() if self.trace_writes else end
+        self.trace.record(start, end, CHANNEL_DAP | TRACE_IN, data[0] if data else 0, len(data))
+        return data
 
     def command(self, data, expect=None):
+        self.observe(data)
+        if self.active_pipeline is not None:
+            return self.active_pipeline._submit(data, expect).result()
         self.write(data)
         read = self.read(512)
         if expect is not None:
             assert(read == expect)
         return read
-    
-    def configure_jtag(self):
-        # set a reasonable clock rate (1MHz)
-        self.command(b'\x11\x40\x42\x0f\x00', expect=b'\x11\x00')
-        # configure dap port as jtag
-        self.command(b'\x02\x02', expect=b'\x02\x02')
-        # reset target
-        data = self.command(b'\x10\x00\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-        time.sleep(0.01)
-        data = self.command(b'\x10\x80\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-
-        # ensure both SWD and JTAG in reset states
-        self.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
-        # issue JTAG-to-SWD sequence
-        self.command(b'\x12\x10\x3c\xe7', expect=b'\x12\x00')
-        # jtag reset
-        self.command(b'\x12\x08\xff', expect=b'\x12\x00')
-        # set jtag tap state to reset then idle
-        self.command(b'\x14\x02\x48\x00\x01\x00', expect=b'\x14\x00')
-
-    def configure_swd(self):
-        # set a reasonable clock rate (1MHz)
-        self.command(b'\x11\x40\x42\x0f\x00', expect=b'\x11\x00')
-        # configure dap port as swd
-        self.command(b'\x02\x01', expect=b'\x02\x01')
-        # reset target
-        data = self.command(b'\x10\x00\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-        time.sleep(0.01)
-        data = self.command(b'\x10\x80\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-
-        # ensure both SWD and JTAG in reset states
-        self.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
-        # issue JTAG-to-SWD sequence
-        self.command(b'\x12\x10\x9e\xe7', expect=b'\x12\x00')
-        # SWD reset
-        self.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
-        # at least 2 idle cycles
-        self.command(b'\x12\x08\x00', expect=b'\x12\x00')
+
+    def observe(self, request):
+        # forget link state that a command sent may change, the configure methods record the new
+        # state once their commands succeed
+        cmd = request[0]
+        if cmd in LINK_NEUTRAL:
+            return
+        if cmd == 0x11:
+            self.clock = None
+            return
+        if cmd == 0x15:
+            self.chain = None
+            return
+        if cmd in (QUEUE_COMMANDS, EXECUTE_COMMANDS):
+            # raw batches aren't looked into
+            self.port = self.clock = self.chain = None
+        elif cmd in (0x02, 0x03):
+            self.port = None
+        self.link = None
+
+    def pipeline(self, depth=None):
+        # keep up to depth commands in flight (by default the probe's packet count), reading responses
+        # in order on a background thread, as a context manager that waits for them all on exit
+        return DapPipeline(self, depth)
+
+    def batch(self, queue=False):
+        # collect commands and send them together with DAP_ExecuteCommands, or DAP_QueueCommands
+        # if queue is set, as a context manager that executes the batch on exit
+        return DapBatch(self, queue)
+
+    def power_up(self):
+        # request debug and system power, then wait for both acknowledgements
+        request = b'\x04\x00\x00\x00\x50' + b'\x20\x00\x00\x00\xa0' + b'\x16\x00\x00\x00\xa0'
+        self.command(b'\x05\x00\x03' + request, expect=b'\x05\x03\x01')
+
+    def _memory_packets(self, addr, count, data=None):
+        # split a run of words into packets that are each filled up to the packet size, selecting
+        # the ap and setting CSW once, and writing TAR only at the start and at 1k boundaries
+        packets = []
+        done = 0
+        while done < count:
+            packet = []
+            request_room = response_room = self.packet_size - 2
+            while done < count:
+                current = addr + 4 * done
+                transfers = b''
+                if done == 0:
+                    # SELECT ap 0 bank 0, then CSW
+                    transfers += b'\x08' + bytes(4) + b'\x01' + CSW_WORD_INC.to_bytes(4, 'little')
+                if done == 0 or current % TAR_BLOCK == 0:
+                    transfers += b'\x05' + current.to_bytes(4, 'little')
+                setup = b'\x05\x00' + bytes([len(transfers) // 5]) + transfers if transfers else b''
+                if data is None:
+                    room = (response_room - (3 if setup else 0) - 4) // 4
+                else:
+                    room = (request_room - len(setup) - 5) // 4
+                words = min(count - done, (TAR_BLOCK - current % TAR_BLOCK) // 4, room)
+                if words <= 0:
+                    break
+                if setup:
+                    packet.append((setup, b'\x05' + bytes([len(transfers) // 5, 0x01]), Future()))
+                    request_room -= len(setup)
+                    response_room -= 3
+                if data is None:
+                    block = b'\x06\x00' + words.to_bytes(2, 'little') + b'\x0f'
+                    expect = None
+                else:
+                    block = b'\x06\x00' + words.to_bytes(2, 'little') + b'\x0d' + data[4*done:4*(done+words)]
+                    expect = b'\x06' + words.to_bytes(2, 'little') + b'\x01'
+                packet.append((block, expect, Future()))
+                request_room -= len(block)
+                response_room -= 4 + (4 * words if data is None else 0)
+                done += words
+            packets.append(packet)
+        return packets
+
+    def read_memory(self, addr, length):
+        # read target memory through MEM-AP 0 with DAP_TransferBlock, the debug port must be powered up
+        start = addr & ~0x3
+        count = (addr + length - start + 3) // 4
+        data = bytearray(4 * count)
+        view = memoryview(data)
+        packets = self._memory_packets(start, count)
+        DapBatch(self).send(packets)
+        idx = 0
+        for packet in packets:
+            for request, _, future in packet:
+                if request[0] != 0x06:
+                    continue
+                response = future.result()
+                words = int.from_bytes(request[2:4], 'little')
+                assert(response[0:4] == b'\x06' + words.to_bytes(2, 'little') + b'\x01')
+                view[idx:idx+4*words] = response[4:]
+                idx += 4 * words
+        return view[addr-start:addr-start+length]
+
+    def write_memory(self, addr, data):
+        # write target memory through MEM-AP 0 with DAP_TransferBlock, the debug port must be powered up
+        assert(addr % 4 == 0 and len(data) % 4 == 0)
+        DapBatch(self).send(self._memory_packets(addr, len(data) // 4, memoryview(data)))
+
+    def write_bytes(self, addr, data):
+        # write bytes within one word with 8-bit accesses, leaving the rest of the word alone, for the
+        # ends of ranges that aren't whole words, where the target may be changing the bytes around them
+        assert((addr & 0x3) + len(data) <= 4)
+        # SELECT ap 0 bank 0, CSW for bytes, and TAR
+        transfers = b'\x08' + bytes(4) + b'\x01' + CSW_BYTE_INC.to_bytes(4, 'little')
+        transfers += b'\x05' + addr.to_bytes(4, 'little')
+        for num, byte in enumerate(data):
+            # each byte goes on its own byte lane of DRW
+            transfers += b'\x0d' + (byte << 8 * ((addr + num) & 0x3)).to_bytes(4, 'little')
+        # back to words, which everything else expects
+        transfers += b'\x01' + CSW_WORD_INC.to_bytes(4, 'little')
+        count = len(transfers) // 5
+        self.command(b'\x05\x00' + bytes([count]) + transfers, expect=b'\x05' + bytes([count, 0x01]))
+
+    def set_clock(self, clock):
+        if clock != self.clock:
+            self.command(b'\x11' + clock.to_bytes(4, 'little'), expect=b'\x11\x00')
+            self.clock = clock
+
+    def configure_chain(self, ir_lengths):
+        # DAP_JTAG_Configure, with the ir length of each device starting from the one closest to tdo
+        ir_lengths = tuple(ir_lengths)
+        if ir_lengths != self.chain:
+            self.command(b'\x15' + bytes([len(ir_lengths)]) + bytes(ir_lengths), expect=b'\x15\x00')
+            self.chain = ir_lengths
+
+    def configure_jtag(self, force=False):
+        # a no-op when jtag is already configured and nothing has disturbed it since
+        if self.link == 'jtag' and not force:
+            return
+        self._bring_up(0x02, JTAG_SELECT)
+        self.port = self.link = 'jtag'
+
+    def configure_swd(self, force=False):
+        # a no-op when swd is already configured and nothing has disturbed it since
+        if self.link == 'swd' and not force:
+            return
+        self._bring_up(0x01, SWD_SELECT)
+        self.port = self.link = 'swd'
+
+    def _bring_up(self, port, select, clock=None, reset=True):
+        # the whole sequence goes out as a single batch, with the reset pulse timed on the probe
+        clock = self.link_clock if clock is None else clock
+        with self.batch() as batch:
+            # set a reasonable clock rate (1MHz, unless tuned)
+            batch.command(b'\x11' + clock.to_bytes(4, 'little'), expect=b'\x11\x00')
+            # configure dap port
+            batch.command(b'\x02' + bytes([port]), expect=b'\x02' + bytes([port]))
+            # reset target
+            pins = self._reset_pulse(batch) if reset else []
+            # ensure both SWD and JTAG in reset states
+            batch.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
+            for request, expect in select:
+                batch.command(request, expect=expect)
+        assert(all(p.result()[0] == 0x10 for p in pins))
+        self.clock = clock
+
+    def _reset_pulse(self, batch):
+        pins = [batch.command(b'\x10\x00\x80\xff\xff\x00\x00')]
+        batch.command(b'\x09' + RESET_PULSE.to_bytes(2, 'little'), expect=b'\x09\x00')
+        pins.append(batch.command(b'\x10\x80\x80\xff\xff\x00\x00'))
+        return pins
+
+    def read_idcode(self):
+        # idcode of the debug port over the configured link, for jtag the chain must be configured
+        if self.port == 'jtag':
+            data = self.command(b'\x16\x00')
+            assert(data[0:2] == b'\x16\x00')
+            return int.from_bytes(data[2:6], 'little')
+        data = self.command(b'\x05\x00\x01\x02')
+        assert(data[0:3] == b'\x05\x01\x01')
+        return int.from_bytes(data[3:7], 'little')
+
+    def autotune_clock(self, scratch=None, reads=16, low=DEFAULT_CLOCK, high=CLOCK_MAX, margin=CLOCK_MARGIN,
+                       cache=CLOCK_CACHE):
+        # find the fastest swj clock that reliably reads the idcode, and with a scratch address in target
+        # ram (and the debug port powered up) writes and reads back a memory pattern, then run at margin
+        # times that rate, results are kept in the cache file (None to disable) for the next session
+        assert(self.link is not None)
+        idcode = self.read_idcode()
+        key = f'{self.usb_device.serial_number}:{idcode:08x}'
+        clocks = self._load_clocks(cache)
+        # the rate the link is known to work at, to fall back to after a failed candidate
+        good = self.clock if self.clock is not None else self.link_clock
+        if key in clocks and self._check_clock(clocks[key], idcode, scratch, reads, good):
+            self._use_clock(clocks[key])
+            return clocks[key]
+
+        if not self._check_clock(low, idcode, scratch, reads, good):
+            raise ValueError(f'link is not stable at the lowest swj clock, {low}Hz')
+        # double until a rate fails, then bisect until within 1/16th of the fastest stable rate
+        good, bad = low, None
+        while bad is None and good < high:
+            candidate = min(2 * good, high)
+            if self._check_clock(candidate, idcode, scratch, reads, good):
+                good = candidate
+            else:
+                bad = candidate
+        while bad is not None and bad - good > good // 16:
+            candidate = (good + bad) // 2
+            if self._check_clock(candidate, idcode, scratch, reads, good):
+                good = candidate
+            else:
+                bad = candidate
+        clock = max(low, int(good * margin))
+        self._use_clock(clock)
+        if cache is not None:
+            clocks[key] = clock
+            self._save_clocks(cache, clocks)
+        return clock
+
+    def _check_clock(self, clock, idcode, scratch, reads, good):
+        self.set_clock(clock)
+        try:
+            stable = all(self.read_idcode() == idcode for _ in range(reads))
+            if stable and scratch is not None:
+                self.write_memory(scratch, CLOCK_PATTERN)
+                stable = self.read_memory(scratch, len(CLOCK_PATTERN)) == CLOCK_PATTERN
+        except AssertionError:
+            stable = False
+        if not stable:
+            # bring the link back up at the good rate, without resetting the target, and clear any
+            # sticky errors
+            if self.port == 'jtag':
+                self._bring_up(0x02, JTAG_SELECT, good, reset=False)
+            else:
+                self._bring_up(0x01, SWD_SELECT, good, reset=False)
+                # swd needs the idcode read after a line reset
+                self.read_idcode()
+            self.command(b'\x08\x00\x1e\x00\x00\x00', expect=b'\x08\x00')
+            if scratch is not None:
+                self.power_up()
+        return stable
+
+    def _use_clock(self, clock):
+        self.link_clock = clock
+        self.set_clock(clock)
+
+    @staticmethod
+    def _load_clocks(cache):
+        if cache is None:
+            return {}
+        try:
+            with open(cache) as file:
+                return json.load(file)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _save_clocks(cache, clocks):
+        os.makedirs(os.path.dirname(cache), exist_ok=True)
+        with open(cache + '.tmp', 'w') as file:
+            json.dump(clocks, file, indent=2, sort_keys=True)
+        os.replace(cache + '.tmp', cache)
 
     def shutdown(self):
-        # ensure both SWD and JTAG in reset states
-        self.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
-        # reset target
-        data = self.command(b'\x10\x00\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-        time.sleep(0.01)
-        data = self.command(b'\x10\x80\x80\xff\xff\x00\x00')
-        assert(data[0] == 0x10)
-        # disconnect probe from target
-        self.command(b'\x03', expect=b'\x03\x00')
+        with self.batch() as batch:
+            # ensure both SWD and JTAG in reset states
+            batch.command(b'\x12\x38\xff\xff\xff\xff\xff\xff\xff', expect=b'\x12\x00')
+            # reset target
+            pins = self._reset_pulse(batch)
+            # disconnect probe from target
+            batch.command(b'\x03', expect=b'\x03\x00')
+        assert(all(p.result()[0] == 0x10 for p in pins))
         self.usb_device.reset()
+        # the probe starts over after a usb reset
+        self.port = self.clock = self.chain = self.link = None
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import pathlib
+import struct
+import tempfile
+import time
+
+from openocd import TclError
+from symbols import ELF_HEADER
+
+# stm32l4r5zi flash, in the default dual bank mode the sectors (pages) are 4k
+FLASH_BASE = 0x08000000
+FLASH_SIZE = 0x200000
+SECTOR_SIZE = 0x1000
+FLASH_MANIFEST = os.path.join(os.path.expanduser('~'), '.cache', 'riceprobe', 'flash')
+# the longest openocd takes to start a write_image, and to erase and program each sector of it, in
+# seconds, far longer than the tcl connection waits for other commands
+WRITE_TIME = 5.0
+SECTOR_TIME = 0.5
+# erased flash reads as all ones
+ERASED = 0xff
+PT_LOAD = 1
+PROGRAM_HEADER = {1: 'IIIIIIII', 2: 'IIQQQQQQ'}
+
+def read_image(path, base=FLASH_BASE):
+    # (address, data) of each loaded segment of an elf file at its physical address, or the whole of
+    # any other file as a raw binary at base
+    with open(path, 'rb') as file:
+        data = file.read()
+    if data[:4] != b'\x7fELF':
+        return [(base, data)]
+    bits, order = data[4], '<' if data[5] == 1 else '>'
+    header = struct.unpack_from(order + ELF_HEADER[bits], data, 16)
+    phoff, phentsize, phnum = header[4], header[8], header[9]
+    segments = []
+    for num in range(phnum):
+        fields = struct.unpack_from(order + PROGRAM_HEADER[bits], data, phoff + num * phentsize)
+        if bits == 1:
+            kind, offset, _, paddr, filesz = fields[:5]
+        else:
+            kind, _, offset, _, paddr, filesz = fields[:6]
+        if kind == PT_LOAD and filesz:
+            segments.append((paddr, data[offset:offset+filesz]))
+    return segments
+
+def split_sectors(segments, base=FLASH_BASE, size=FLASH_SIZE, sector_size=SECTOR_SIZE):
+    # the image as {sector address: sector contents}, padded with the erased value, for the sectors
+    # it touches, segments outside of flash (initialized ram data is loaded from flash) are skipped
+    sectors = {}
+    for addr, data in segments:
+        if not (base <= addr and addr + len(data) <= base + size):
+            continue
+        for sector in range(addr & -sector_size, addr + len(data), sector_size):
+            contents = sectors.setdefault(sector, bytearray([ERASED]) * sector_size)
+            start, end = max(addr, sector), min(addr + len(data), sector + sector_size)
+            contents[start-sector:end-sector] = data[start-addr:end-addr]
+    return {sector: bytes(contents) for sector, contents in sorted(sectors.items())}
+
+def sector_hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+class FlashProgrammer:
+    # programs only the flash sectors an image changes, through openocd, sectors are compared by hash
+    # against a manifest of what was last programmed through here (kept per probe in manifest, None
+    # to disable), or when there isn't one, against the target with openocd's on-target checksums
+    def __init__(self, openocd, base=FLASH_BASE, size=FLASH_SIZE, sector_size=SECTOR_SIZE,
+                 manifest=FLASH_MANIFEST):
+        self.openocd = openocd
+        self.base = base
+        self.size = size
+        self.sector_size = sector_size
+        name = openocd.serial if openocd.serial is not None else 'default'
+        self.manifest = os.path.join(manifest, f'{name}.json') if manifest is not None else None
+
+    def program(self, path, check=None, run=True):
+        # check is 'manifest' or 'target', by default the manifest when there is one, returns the
+        # sector counts, bytes written and time taken
+        start = time.perf_counter()
+        sectors = split_sectors(read_image(path, self.base), self.base, self.size, self.sector_size)
+        hashes = {sector: sector_hash(data) for sector, data in sectors.items()}
+        manifest = self._load_manifest()
+        if check is None:
+            check = 'manifest' if manifest else 'target'
+        with tempfile.TemporaryDirectory() as directory:
+            self.openocd.send(b'reset halt')
+            if check == 'manifest':
+                changed = [sector for sector in sectors if manifest.get(sector) != hashes[sector]]
+            elif check == 'target':
+                changed = self._check_target(sectors, directory)
+            else:
+                raise ValueError(f'unknown flash check {check!r}')
+            runs = self._runs(changed)
+            # one batch of write_image commands, each erasing and programming a run of changed sectors
+            commands = []
+            for num, (first, count) in enumerate(runs):
+                data = b''.join(sectors[first + n * self.sector_size] for n in range(count))
+                image = self._write_file(directory, f'run{num}.bin', data)
+                commands.append(b'flash write_image erase {%b} 0x%x bin' % (image, first))
+            timeout = WRITE_TIME + SECTOR_TIME * max((count for _, count in runs), default=0)
+            try:
+                self.openocd.send_many(commands, timeout=timeout)
+            except (TclError, OSError):
+                # sectors that might have been erased are unknown until checked again
+                for sector in changed:
+                    manifest.pop(sector, None)
+                self._save_manifest(manifest)
+                raise
+            if run:
+                self.openocd.send(b'reset run')
+        manifest.update(hashes)
+        self._save_manifest(manifest)
+        return {
+            'sectors': len(sectors),
+            'changed': len(changed),
+            'runs': len(runs),
+            'bytes_written': len(changed) * self.sector_size,
+            'check': check,
+            'elapsed': time.perf_counter() - start,
+        }
+
+    def forget(self):
+        # drop the manifest, after the flash was programmed some other way
+        if self.manifest is not None and os.path.exists(self.manifest):
+            os.remove(self.manifest)
+
+    def _check_target(self, sectors, directory):
+        # openocd checksums each sector on the target against a file of its new contents, the
+        # sectors whose checksums don't match are the changed ones
+        commands = []
+        for sector, data in sectors.items():
+            image = self._write_file(directory, f'{sector:08x}.bin', data)
+            commands.append(b'verify_image_checksum {%b} 0x%x bin' % (image, sector))
+        try:
+            self.openocd.send_many(commands)
+        except TclError as e:
+            addresses = list(sectors)
+            return [addresses[num] for num in sorted(e.errors)]
+        return []
+
+    def _runs(self, changed):
+        # (first sector, count) of each run of consecutive sectors
+        runs = []
+        for sector in changed:
+            if runs and runs[-1][0] + runs[-1][1] * self.sector_size == sector:
+                runs[-1] = (runs[-1][0], runs[-1][1] + 1)
+            else:
+                runs.append((sector, 1))
+        return runs
+
+    def _write_file(self, directory, name, data):
+        # openocd can't read files python still has open, and wants forward slashes
+        path = pathlib.Path(directory) / name
+        path.write_bytes(data)
+        return path.as_posix().encode()
+
+    def _load_manifest(self):
+        if self.manifest is None:
+            return {}
+        try:
+            with open(self.manifest) as file:
+                manifest = json.load(file)
+        except (OSError, ValueError):
+            return {}
+        if (manifest.get('base'), manifest.get('sector_size')) != (self.base, self.sector_size):
+            return {}
+        return {int(sector, 16): digest for sector, digest in manifest.get('sectors', {}).items()}
+
+    def _save_manifest(self, sectors):
+        if self.manifest is None:
+            return
+        os.makedirs(os.path.dirname(self.manifest), exist_ok=True)
+        manifest = {
+            'base': self.base,
+            'sector_size': self.sector_size,
+            'sectors': {f'0x{sector:08x}': digest for sector, digest in sorted(sectors.items())},
+        }
+        with open(self.manifest + '.tmp', 'w') as file:
+            json.dump(manifest, file, indent=2)
+        os.replace(self.manifest + '.tmp', self.manifest)
@@ -0,0 +1,250 @@
+import re
+import socket
+
+# bytes that have to be escaped in binary data, as '}' then the byte xor 0x20
+ESCAPED = re.compile(rb'[#$}*]')
+# breakpoint and watchpoint types for Z and z packets
+BREAK_SOFTWARE = 0
+BREAK_HARDWARE = 1
+WATCH_WRITE = 2
+WATCH_READ = 3
+WATCH_ACCESS = 4
+# packet size to assume when the server doesn't say
+DEFAULT_PACKET_SIZE = 400
+
+class GdbError(ValueError):
+    def __init__(self, command, reply):
+        # reply is the server's error reply, Exx for most commands
+        self.command = command
+        self.reply = reply
+        super().__init__(f'{command[:32]!r} failed: {reply!r}')
+
+def checksum(data):
+    return b'%02x' % (sum(data) & 0xff)
+
+def escape(data):
+    return ESCAPED.sub(lambda m: bytes([0x7d, m.group()[0] ^ 0x20]), bytes(data))
+
+def unescape(data):
+    # undoes binary escapes and run length encoding ('*' then the repeat count + 29) in a reply
+    if b'}' not in data and b'*' not in data:
+        return data
+    out = bytearray()
+    idx = 0
+    while idx < len(data):
+        byte = data[idx]
+        if byte == 0x7d:
+            out.append(data[idx + 1] ^ 0x20)
+            idx += 2
+        elif byte == 0x2a:
+            out += out[-1:] * (data[idx + 1] - 29)
+            idx += 2
+        else:
+            out.append(byte)
+            idx += 1
+    return bytes(out)
+
+class GdbClient:
+    # gdb remote serial protocol client, for openocd's gdb port (or anything else speaking it), with
+    # binary memory writes, reads split to the server's packet size, and no-ack mode when offered,
+    # openocd halts the target when a gdb connection is made
+    def __init__(self, ip='127.0.0.1', port=3333, timeout=5.0):
+        self.timeout = timeout
+        self.sock = socket.create_connection((ip, port), timeout)
+        self.sock.settimeout(timeout)
+        self.buffer = bytearray()
+        self.ack = True
+        self.packet_size = DEFAULT_PACKET_SIZE
+        self.features = {}
+        self._handshake()
+
+    def close(self):
+        try:
+            self.command(b'D')
+        except (OSError, GdbError):
+            pass
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _handshake(self):
+        reply = self.command(b'qSupported:swbreak+;hwbreak+')
+        # name=value, or name+ and name- for supported and unsupported features
+        for feature in reply.decode().split(';'):
+            name, sep, value = feature.partition('=')
+            if sep:
+                self.features[name] = value
+            elif name[-1:] in ('+', '-'):
+                self.features[name[:-1]] = name[-1] == '+'
+        if 'PacketSize' in self.features:
+            self.packet_size = int(self.features['PacketSize'], 16)
+        if self.features.get('QStartNoAckMode'):
+            if self.command(b'QStartNoAckMode') == b'OK':
+                self.ack = False
+
+    # packets
+
+    def command(self, data):
+        self.send_packet(data)
+        return self.recv_packet()
+
+    def send_packet(self, data):
+        packet = b'$' + data + b'#' + checksum(data)
+        while True:
+            self.sock.sendall(packet)
+            if not self.ack:
+                return
+            # resend on a nak
+            if self._recv_ack():
+                return
+
+    def _recv_ack(self):
+        while True:
+            byte = self._take(1)
+            if byte == b'+':
+                return True
+            if byte == b'-':
+                return False
+
+    def recv_packet(self):
+        # the next packet, skipping anything before its start, replies are acked (or naked if the
+        # checksum fails) unless in no-ack mode
+        while True:
+            start = self.buffer.find(b'$')
+            end = self.buffer.find(b'#', start) if start >= 0 else -1
+            if end < 0 or len(self.buffer) < end + 3:
+                self._recv()
+                continue
+            data = bytes(self.buffer[start+1:end])
+            good = bytes(self.buffer[end+1:end+3]).lower() == checksum(data)
+            del self.buffer[:end+3]
+            if self.ack:
+                self.sock.sendall(b'+' if good else b'-')
+            if good:
+                return unescape(data)
+
+    def _take(self, size):
+        while len(self.buffer) < size:
+            self._recv()
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def _recv(self):
+        data = self.sock.recv(65536)
+        if not data:
+            raise ConnectionError('gdb server closed the connection')
+        self.buffer += data
+
+    def _check(self, command, reply, ok=b'OK'):
+        if reply != ok:
+            raise GdbError(command, reply)
+        return reply
+
+    # memory
+
+    def read_memory(self, addr, length):
+        # m packets, each reply (two hex digits a byte) filling at most a packet
+        chunk = max((self.packet_size - 4) // 2, 1)
+        out = bytearray()
+        while len(out) < length:
+            size = min(chunk, length - len(out))
+            command = b'm%x,%x' % (addr + len(out), size)
+            reply = self.command(command)
+            # hex data never starts with E
+            if not reply or reply[:1] == b'E':
+                raise GdbError(command, reply)
+            out += bytes.fromhex(reply.decode())
+        return bytes(out)
+
+    def write_memory(self, addr, data):
+        # binary X packets, as much escaped data as fits in each
+        data = memoryview(data)
+        done = 0
+        while done < len(data):
+            header = b'X%x,' % (addr + done)
+            # room for the data after the framing, header, and length
+            room = self.packet_size - 4 - len(header) - 9
+            size = min(room, len(data) - done)
+            payload = escape(data[done:done+size])
+            while len(payload) > room:
+                # each byte dropped frees one or two bytes of room, so drop half the excess and try again
+                size -= (len(payload) - room + 1) // 2
+                payload = escape(data[done:done+size])
+            command = header + b'%x:' % size + payload
+            self._check(command, self.command(command))
+            done += size
+
+    # registers
+
+    def read_registers(self):
+        # every general register at once, as the raw little endian bytes of the target's g layout
+        reply = self.command(b'g')
+        if reply[:1] == b'E':
+            raise GdbError(b'g', reply)
+        return bytes.fromhex(reply.decode())
+
+    def read_register_words(self):
+        # read_registers as 32-bit words, for 32-bit targets like the cortex-m
+        data = self.read_registers()
+        return [int.from_bytes(data[idx:idx+4], 'little') for idx in range(0, len(data) - len(data) % 4, 4)]
+
+    def read_register(self, num):
+        reply = self.command(b'p%x' % num)
+        if not reply or reply[:1] == b'E':
+            raise GdbError(b'p%x' % num, reply)
+        return int.from_bytes(bytes.fromhex(reply.decode()), 'little')
+
+    def write_register(self, num, value, size=4):
+        command = b'P%x=%b' % (num, value.to_bytes(size, 'little').hex().encode())
+        self._check(command, self.command(command))
+
+    # break and watchpoints
+
+    def insert_breakpoint(self, addr, kind=2, hardware=True):
+        # kind is the instruction size, 2 for thumb
+        command = b'Z%d,%x,%x' % (BREAK_HARDWARE if hardware else BREAK_SOFTWARE, addr, kind)
+        self._check(command, self.command(command))
+
+    def remove_breakpoint(self, addr, kind=2, hardware=True):
+        command = b'z%d,%x,%x' % (BREAK_HARDWARE if hardware else BREAK_SOFTWARE, addr, kind)
+        self._check(command, self.command(command))
+
+    def insert_watchpoint(self, addr, length, type=WATCH_WRITE):
+        command = b'Z%d,%x,%x' % (type, addr, length)
+        self._check(command, self.command(command))
+
+    def remove_watchpoint(self, addr, length, type=WATCH_WRITE):
+        command = b'z%d,%x,%x' % (type, addr, length)
+        self._check(command, self.command(command))
+
+    # execution
+
+    def resume(self):
+        # the stop reply only comes once the target halts again, see wait_stop
+        self.send_packet(b'c')
+
+    def interrupt(self, timeout=None):
+        self.sock.sendall(b'\x03')
+        return self.wait_stop(timeout)
+
+    def wait_stop(self, timeout=None):
+        # the stop reply (S or T packet) of the next halt
+        if timeout is not None:
+            self.sock.settimeout(timeout)
+        try:
+            while True:
+                reply = self.recv_packet()
+                if reply[:1] in (b'S', b'T'):
+                    return reply
+                # console output while running
+                if reply[:1] != b'O':
+                    raise GdbError(b'c', reply)
+        except socket.timeout:
+            raise TimeoutError(f'target did not halt within {timeout}s')
+        finally:
+            self.sock.settimeout(self.timeout)
@@ -0,0 +1,202 @@
+import collections
+
+# next state for tms low and tms high
+TAP_STATES = {
+    'reset': ('idle', 'reset'),
+    'idle': ('idle', 'select-dr'),
+    'select-dr': ('capture-dr', 'select-ir'),
+    'capture-dr': ('shift-dr', 'exit1-dr'),
+    'shift-dr': ('shift-dr', 'exit1-dr'),
+    'exit1-dr': ('pause-dr', 'update-dr'),
+    'pause-dr': ('pause-dr', 'exit2-dr'),
+    'exit2-dr': ('shift-dr', 'update-dr'),
+    'update-dr': ('idle', 'select-dr'),
+    'select-ir': ('capture-ir', 'reset'),
+    'capture-ir': ('shift-ir', 'exit1-ir'),
+    'shift-ir': ('shift-ir', 'exit1-ir'),
+    'exit1-ir': ('pause-ir', 'update-ir'),
+    'pause-ir': ('pause-ir', 'exit2-ir'),
+    'exit2-ir': ('shift-ir', 'update-ir'),
+    'update-ir': ('idle', 'select-dr'),
+}
+
+# bits in a single DAP_JTAG_Sequence sequence
+SEQUENCE_BITS = 64
+
+def tms_path(start, end):
+    # shortest list of tms values from start to end, a start of None (unknown state) goes through reset
+    if start is None:
+        return [1] * 5 + tms_path('reset', end)
+    paths = {start: []}
+    pending = collections.deque([start])
+    while end not in paths:
+        state = pending.popleft()
+        for tms, next_state in enumerate(TAP_STATES[state]):
+            if next_state not in paths:
+                paths[next_state] = paths[state] + [tms]
+                pending.append(next_state)
+    return paths[end]
+
+class JtagProgram:
+    # a list of tap operations, compiled and run by Jtag, taps are indexed as in DAP_JTAG_Configure
+    # (0 is closest to tdo), and every other tap is put in bypass
+    def __init__(self):
+        self.ops = []
+
+    def reset(self):
+        self.ops.append(('reset',))
+        return self
+
+    def goto(self, state):
+        assert(state in TAP_STATES)
+        self.ops.append(('goto', state))
+        return self
+
+    def shift_ir(self, tap, instruction, end='idle'):
+        self.ops.append(('ir', tap, instruction, end))
+        return self
+
+    def shift_dr(self, tap, bits, value=0, capture=True, end='idle'):
+        # each captured shift adds the bits shifted out of the tap to the results of Jtag.run
+        self.ops.append(('dr', tap, bits, value, capture, end))
+        return self
+
+    def idle(self, cycles):
+        self.ops.append(('idle', cycles))
+        return self
+
+class CompiledProgram:
+    def __init__(self, commands, captures, end_state):
+        # DAP_JTAG_Sequence requests, one per packet
+        self.commands = commands
+        # (response index, response offset, bits) for each sequence with captured tdo, in order
+        self.pieces = []
+        # (offset in the captured bit stream, bits) for each captured shift
+        self.captures = captures
+        self.end_state = end_state
+
+    def results(self, responses):
+        stream, offset = 0, 0
+        for idx, start, bits in self.pieces:
+            nbytes = (bits + 7) // 8
+            chunk = int.from_bytes(responses[idx][start:start+nbytes], 'little') & ((1 << bits) - 1)
+            stream |= chunk << offset
+            offset += bits
+        return [(stream >> start) & ((1 << bits) - 1) for start, bits in self.captures]
+
+class Jtag:
+    def __init__(self, dap, ir_lengths=None, state=None):
+        self.dap = dap
+        # chain configuration, from configure
+        self.ir_lengths = tuple(ir_lengths) if ir_lengths is not None else None
+        # current tap state, None when unknown, which programs resolve with a tap reset
+        self.state = state
+        # compiled programs keyed by (ir lengths, start state, operations)
+        self.cache = {}
+
+    def configure(self, ir_lengths):
+        self.dap.configure_chain(ir_lengths)
+        self.ir_lengths = tuple(ir_lengths)
+
+    def run(self, program):
+        # returns the values captured by each capturing shift_dr, in order
+        compiled = self.compile(program)
+        if len(compiled.commands) > 1 and self.dap.active_pipeline is None:
+            with self.dap.pipeline() as pipeline:
+                futures = [pipeline.submit(command) for command in compiled.commands]
+            responses = [future.result() for future in futures]
+        else:
+            responses = [self.dap.command(command) for command in compiled.commands]
+        for response in responses:
+            assert(response[0:2] == b'\x14\x00')
+        self.state = compiled.end_state
+        return compiled.results(responses)
+
+    def compile(self, program):
+        key = (self.ir_lengths, self.state, tuple(program.ops))
+        compiled = self.cache.get(key)
+        if compiled is None:
+            compiled = self._compile(program.ops)
+            self.cache[key] = compiled
+        return compiled
+
+    def _compile(self, ops):
+        # expand into (tms, tdi, capture) for each clock, then merge runs of matching tms and capture
+        # into sequences, and sequences into as few commands as fit in a packet
+        clocks = []
+        captures = []
+        captured = 0
+        state = self.state
+
+        def goto(end):
+            clocks.extend((tms, 0, False) for tms in tms_path(state, end))
+            return end
+
+        def shift(bits, tdi, capture):
+            clocks.extend((int(num == bits - 1), (tdi >> num) & 0x1, capture) for num in range(bits))
+
+        for op in ops:
+            if op[0] == 'reset':
+                clocks.extend((1, 0, False) for _ in range(5))
+                state = 'reset'
+            elif op[0] == 'goto':
+                state = goto(op[1])
+            elif op[0] == 'idle':
+                state = goto('idle')
+                clocks.extend((0, 0, False) for _ in range(op[1]))
+            elif op[0] == 'ir':
+                _, tap, instruction, end = op
+                assert(self.ir_lengths is not None and tap < len(self.ir_lengths))
+                # all ones (bypass) for every other tap
+                tdi, offset = 0, 0
+                for num, length in enumerate(self.ir_lengths):
+                    value = instruction if num == tap else (1 << length) - 1
+                    tdi |= (value & ((1 << length) - 1)) << offset
+                    offset += length
+                state = goto('shift-ir')
+                shift(offset, tdi, False)
+                # the last bit moves on to exit1-ir
+                state = 'exit1-ir'
+                state = goto(end)
+            elif op[0] == 'dr':
+                _, tap, bits, value, capture, end = op
+                assert(self.ir_lengths is not None and tap < len(self.ir_lengths))
+                # one bypass bit for each other tap, those closer to tdo shift out first
+                total = bits + len(self.ir_lengths) - 1
+                state = goto('shift-dr')
+                shift(total, (value & ((1 << bits) - 1)) << tap, capture)
+                if capture:
+                    captures.append((captured + tap, bits))
+                    captured += total
+                state = 'exit1-dr'
+                state = goto(end)
+
+        sequences = []
+        for tms, tdi, capture in clocks:
+            last = sequences[-1] if sequences else None
+            if last is not None and last[0] == tms and last[2] == capture and len(last[1]) < SEQUENCE_BITS:
+                last[1].append(tdi)
+            else:
+                sequences.append((tms, [tdi], capture))
+
+        compiled = CompiledProgram([], captures, state)
+        limit = self.dap.packet_size
+        current, count, response_len = bytearray(), 0, 2
+        for tms, tdi, capture in sequences:
+            bits = len(tdi)
+            nbytes = (bits + 7) // 8
+            data = sum(bit << num for num, bit in enumerate(tdi)).to_bytes(nbytes, 'little')
+            request = bytes([(bits % SEQUENCE_BITS) | (tms << 6) | (capture << 7)]) + data
+            fits = count < 255 and 2 + len(current) + len(request) <= limit
+            fits = fits and response_len + (nbytes if capture else 0) <= limit
+            if count and not fits:
+                compiled.commands.append(b'\x14' + bytes([count]) + current)
+                current, count, response_len = bytearray(), 0, 2
+            if capture:
+                compiled.pieces.append((len(compiled.commands), response_len, bits))
+                response_len += nbytes
+            current += request
+            count += 1
+        if count:
+            compiled.commands.append(b'\x14' + bytes([count]) + current)
+        return compiled
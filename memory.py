@@ -0,0 +1,253 @@
+import collections
+import struct
+import threading
+
+# debug halting control and status, writes need the key in the top half
+DHCSR = 0xe000edf0
+DHCSR_KEY = 0xa05f0000
+C_DEBUGEN = 0x1
+C_HALT = 0x2
+S_HALT = 1 << 17
+# peripheral, device and system regions, where reads have side effects or change on their own, these
+# are never cached
+UNCACHED = [(0x40000000, 0x60000000), (0xa0000000, 0x100000000)]
+# the code region, which doesn't change while the core runs, pages here are kept on resume
+STABLE = [(0x00000000, 0x20000000)]
+
+def _within(regions, addr, length):
+    return any(start <= addr and addr + length <= end for start, end in regions)
+
+def _overlaps(regions, addr, length):
+    return any(addr < end and start < addr + length for start, end in regions)
+
+class TargetMemory:
+    # target memory through a Dap or OpenOCD (anything with read_memory and write_memory), behind an
+    # lru cache of page_size pages, so repeated inspection of a halted target doesn't touch the bus,
+    # pages are dropped when the core resumes (outside STABLE) and updated by writes made through
+    # here, writes made any other way need invalidate, mem[addr:addr+n] reads and writes bytes
+    def __init__(self, target, page_size=1024, pages=256):
+        assert(page_size % 4 == 0 and page_size & (page_size - 1) == 0)
+        self.target = target
+        self.page_size = page_size
+        self.capacity = pages
+        # page address -> bytearray, least recently used first
+        self.pages = collections.OrderedDict()
+        # page address -> [start, end) offsets written but not yet sent, while batching
+        self.dirty = {}
+        self.batching = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+        # openocd reports resumes on its own, anything else is only seen through DHCSR writes here
+        if hasattr(target, 'add_callback'):
+            target.add_callback(self._event)
+        self.halted = bool(self._read_word(DHCSR) & S_HALT)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            assert(key.step is None and key.start is not None and key.stop is not None)
+            return self.read(key.start, key.stop - key.start)
+        return self.read(key, 1)[0]
+
+    def __setitem__(self, key, data):
+        if isinstance(key, slice):
+            assert(key.step is None and key.start is not None and len(data) == key.stop - key.start)
+            self.write(key.start, data)
+        else:
+            self.write(key, bytes([data]))
+
+    def read(self, addr, length):
+        # a read only memoryview of the bytes, reads within one page view the cached page itself,
+        # which follows later writes made through here
+        with self.lock:
+            if not self._cacheable(addr, length):
+                self.flush()
+                return self.target.read_memory(addr, length).toreadonly()
+            first = addr & -self.page_size
+            last = (addr + length - 1) & -self.page_size
+            self._fill(first, last)
+            if first == last:
+                offset = addr - first
+                return memoryview(self.pages[first])[offset:offset+length].toreadonly()
+            data = b''.join(self.pages[page] for page in range(first, last + self.page_size, self.page_size))
+            return memoryview(data)[addr-first:addr-first+length].toreadonly()
+
+    def view(self, addr, length):
+        return self.read(addr, length)
+
+    def unpack(self, format, addr):
+        # struct.unpack of the bytes at addr, use an explicit byte order, the target is little endian
+        return struct.unpack(format, self.read(addr, struct.calcsize(format)))
+
+    def read32(self, addr):
+        return self.unpack('<I', addr)[0]
+
+    def read_words(self, addr, count):
+        return list(self.unpack('<%dI' % count, addr))
+
+    def write32(self, addr, value):
+        self.write(addr, value.to_bytes(4, 'little'))
+
+    def write(self, addr, data):
+        data = bytes(data)
+        with self.lock:
+            if self.batching and self.halted and self._cacheable(addr, len(data)):
+                self._write_back(addr, data)
+                return
+            # earlier writes go first
+            self.flush()
+            if addr <= DHCSR < addr + len(data):
+                self._dhcsr(int.from_bytes(data[DHCSR-addr:DHCSR-addr+4], 'little'))
+            self._write_through(addr, data)
+
+    def halt(self):
+        if hasattr(self.target, 'send'):
+            # keep openocd's idea of the target state in step
+            self.target.send(b'halt')
+            with self.lock:
+                self.halted = True
+        else:
+            self.write32(DHCSR, DHCSR_KEY | C_DEBUGEN | C_HALT)
+
+    def resume(self):
+        if hasattr(self.target, 'send'):
+            with self.lock:
+                self.flush()
+                self._resumed()
+            self.target.send(b'resume')
+        else:
+            self.write32(DHCSR, DHCSR_KEY | C_DEBUGEN)
+
+    def batch(self):
+        # as a context manager, holds writes to cacheable memory while the core is halted, and sends
+        # them as one write per run of changed words on exit (or on flush and resume)
+        return TargetMemoryBatch(self)
+
+    def flush(self):
+        with self.lock:
+            for page, (start, end) in sorted(self.dirty.items()):
+                self.target.write_memory(page + start, memoryview(self.pages[page])[start:end])
+            self.dirty.clear()
+
+    def invalidate(self, addr=None, length=None):
+        # forget cached pages overlapping addr to addr + length, or every page, pending writes to them
+        # are dropped
+        with self.lock:
+            if addr is None:
+                self.pages.clear()
+                self.dirty.clear()
+                return
+            for page in list(self.pages):
+                if page < addr + length and addr < page + self.page_size:
+                    del self.pages[page]
+                    self.dirty.pop(page, None)
+
+    def _cacheable(self, addr, length):
+        span = ((addr + length - 1) & -self.page_size) - (addr & -self.page_size) + self.page_size
+        if _overlaps(UNCACHED, addr, length) or span > self.capacity * self.page_size:
+            return False
+        # memory that changes while the core runs is only cached while it is halted
+        return self.halted or _within(STABLE, addr, length)
+
+    def _fill(self, first, last):
+        # read the missing pages between first and last, each run of them in one read
+        run = None
+        for page in range(first, last + self.page_size, self.page_size):
+            if page in self.pages:
+                self.hits += 1
+                self.pages.move_to_end(page)
+                if run is not None:
+                    self._load(run, page)
+                    run = None
+            else:
+                self.misses += 1
+                run = page if run is None else run
+        if run is not None:
+            self._load(run, last + self.page_size)
+
+    def _load(self, start, end):
+        data = self.target.read_memory(start, end - start)
+        for page in range(start, end, self.page_size):
+            self.pages[page] = bytearray(data[page-start:page-start+self.page_size])
+        self._evict()
+
+    def _evict(self):
+        while len(self.pages) > self.capacity:
+            page = next(iter(self.pages))
+            if page in self.dirty:
+                start, end = self.dirty.pop(page)
+                self.target.write_memory(page + start, memoryview(self.pages[page])[start:end])
+            del self.pages[page]
+
+    def _write_back(self, addr, data):
+        first = addr & -self.page_size
+        last = (addr + len(data) - 1) & -self.page_size
+        self._fill(first, last)
+        for page in range(first, last + self.page_size, self.page_size):
+            start = max(addr, page)
+            end = min(addr + len(data), page + self.page_size)
+            self.pages[page][start-page:end-page] = data[start-addr:end-addr]
+            # pending writes cover whole words
+            start, end = (start - page) & ~0x3, (end - page + 3) & ~0x3
+            if page in self.dirty:
+                start, end = min(start, self.dirty[page][0]), max(end, self.dirty[page][1])
+            self.dirty[page] = (start, end)
+
+    def _write_through(self, addr, data):
+        # word aligned writes, reading the partial words at either end first
+        start = addr & ~0x3
+        end = (addr + len(data) + 3) & ~0x3
+        if (start, end) != (addr, addr + len(data)):
+            words = bytearray(self.read(start, end - start))
+            words[addr-start:addr-start+len(data)] = data
+        else:
+            words = data
+        self.target.write_memory(start, words)
+        for page in range(start & -self.page_size, end, self.page_size):
+            if page in self.pages:
+                lo, hi = max(addr, page), min(addr + len(data), page + self.page_size)
+                self.pages[page][lo-page:hi-page] = data[lo-addr:hi-addr]
+
+    def _read_word(self, addr):
+        return int.from_bytes(self.target.read_memory(addr, 4), 'little')
+
+    def _dhcsr(self, value):
+        if value & 0xffff0000 != DHCSR_KEY:
+            return
+        if value & C_DEBUGEN and value & C_HALT:
+            self.halted = True
+        elif self.halted:
+            # pending writes go out before the core runs
+            self.flush()
+            self._resumed()
+
+    def _resumed(self):
+        # pages with pending writes are kept until they are sent
+        self.halted = False
+        for page in list(self.pages):
+            if not _within(STABLE, page, self.page_size) and page not in self.dirty:
+                del self.pages[page]
+
+    def _event(self, event, state):
+        # openocd target events, on its notification thread
+        with self.lock:
+            if state == 'halted':
+                self.halted = True
+            elif state is not None and self.halted:
+                self._resumed()
+
+class TargetMemoryBatch:
+    # see TargetMemory.batch
+    def __init__(self, memory):
+        self.memory = memory
+
+    def __enter__(self):
+        with self.memory.lock:
+            self.memory.batching += 1
+        return self.memory
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with self.memory.lock:
+            self.memory.batching -= 1
+            if self.memory.batching == 0:
+                self.memory.flush()
@@ -1,9 +1,159 @@
+import queue
 import shutil
 import socket
-import streamexpect
+import struct
 import subprocess
+import threading
 import time
 
+from gdbrsp import GdbClient
+from rtt import RttChannel
+
+def _balanced(command):
+    # whether a command's braces pair up, counting only unescaped ones, and it can't end the frame
+    depth = 0
+    escaped = False
+    for byte in command:
+        if escaped:
+            escaped = False
+        elif byte == 0x5c:
+            escaped = True
+        elif byte == 0x7b:
+            depth += 1
+        elif byte == 0x7d:
+            depth -= 1
+            if depth < 0:
+                return False
+        elif byte == OpenOCD.TERM[0]:
+            return False
+    return depth == 0 and not escaped
+
+class TclError(ValueError):
+    def __init__(self, errors, responses):
+        # errors maps command index to (command, error message), responses has None for failed commands
+        self.errors = errors
+        self.responses = responses
+        super().__init__('; '.join(f'{cmd!r} failed: {msg!r}' for cmd, msg in errors.values()))
+
+class RttSocket(RttChannel):
+    # rtt through the openocd rtt server
+    def __init__(self, sock, size=1 << 20, window=1024):
+        self.sock = sock
+        super().__init__(size, window)
+
+    def send(self, data):
+        self.sock.sendall(data)
+        return len(data)
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+    def _recv(self):
+        try:
+            return self.sock.recv(65536)
+        except OSError:
+            return b''
+
+class TclNotifications:
+    # a second tcl connection with notifications on, which tracks the target state from openocd's
+    # asynchronous target events, so halts can be waited for instead of polling curstate
+    TERM = b'\x1a'
+    EVENT_PREFIX = b'type target_event event '
+    # states entered on events, named as curstate reports them
+    EVENT_STATES = {'halted': 'halted', 'resumed': 'running', 'reset-start': 'reset'}
+
+    def __init__(self, sock):
+        self.sock = sock
+        # last known target state, None until known
+        self.state = None
+        # count of target events seen, and the count when the current state was entered, so a wait
+        # can ask for a state reached after some point
+        self.sequence = 0
+        self.entered = 0
+        # called with (event, state) on the reader thread for each target event, state is None for
+        # events that don't change it
+        self.callbacks = []
+        self.closed = False
+        self.condition = threading.Condition()
+        # command responses on this connection, in between the notifications
+        self.responses = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+        self.command(b'tcl_notifications on')
+        state = self.command(b'[target current] curstate').decode(errors='replace').strip()
+        with self.condition:
+            # any event since is newer than the state read
+            if self.sequence == 0:
+                self.state = state
+            self.condition.notify_all()
+
+    def command(self, data, timeout=5.0):
+        self.sock.sendall(data + self.TERM)
+        try:
+            response = self.responses.get(timeout=timeout)
+        except queue.Empty:
+            raise TimeoutError(f'no response to {data!r} within {timeout}s')
+        if response is None:
+            raise ConnectionError('openocd closed the notification connection')
+        return response
+
+    def wait_for_state(self, state, timeout=1.0, since=None):
+        # waits for the target to be in state, and if since (a previous sequence) is given, for it
+        # to have got there through an event after since, returns the sequence of the last event
+        def reached():
+            return self.state == state and (since is None or self.entered > since)
+        with self.condition:
+            if not self.condition.wait_for(lambda: reached() or self.closed, timeout):
+                raise TimeoutError(f'target not {state} within {timeout}s, last seen {self.state}')
+            if not reached():
+                raise ConnectionError('openocd closed the notification connection')
+            return self.sequence
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+        self.thread.join()
+
+    def _run(self):
+        buffer = b''
+        while True:
+            try:
+                data = self.sock.recv(4096)
+            except OSError:
+                data = b''
+            if not data:
+                break
+            buffer += data
+            *messages, buffer = buffer.split(self.TERM)
+            for message in messages:
+                if message.startswith(self.EVENT_PREFIX):
+                    self._event(message[len(self.EVENT_PREFIX):].decode(errors='replace').strip())
+                elif not message.startswith(b'type '):
+                    self.responses.put(message)
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.responses.put(None)
+
+    def _event(self, event):
+        state = self.EVENT_STATES.get(event)
+        with self.condition:
+            self.sequence += 1
+            if state is not None:
+                self.state = state
+                self.entered = self.sequence
+            self.condition.notify_all()
+        for callback in list(self.callbacks):
+            callback(event, state)
+
 class OpenOCD:
     # for now the config commands are hardcoded for the given target (stm32l4r5zitx), this may need to be
     # more generalized later on, but for now it is simple and works
@@ -21,75 +171,345 @@ class OpenOCD:
     # terminator character for tcl commands
     TERM = b'\x1a'
 
-    def __init__(self, exec=None, tcl_port=6666, rtt_port=7777):
+    def __init__(self, exec=None, tcl_port=6666, rtt_port=7777, gdb_port=3333, telnet_port=4444, serial=None):
         # openocd server initialization
         self.exec = exec if exec is not None else shutil.which('openocd')
         self.tcl_port = tcl_port
         self.rtt_port = rtt_port
+        self.gdb_port = gdb_port
+        self.telnet_port = telnet_port
+        # probe serial number, None uses the first probe found
+        self.serial = serial
         self.process = None
 
         # socket for connection to openocd tcl interface
         self.ip = '127.0.0.1'
         self.tcl_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.tcl_sock.settimeout(1.0)
-        self.rtt_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # rtt channel, made by enable_rtt
+        self.rtt = None
+        # target event connection, made by enable_notifications
+        self.notifications = None
 
-        # data buffering for server responses
-        self.buffer = bytes()
+        # data buffering for server responses, received data is buffer[head:tail], and the search for
+        # the terminator character resumes from scanned
         self.buffer_chunk = 1024
+        self.buffer = bytearray(self.buffer_chunk)
+        self.view = memoryview(self.buffer)
+        self.head = 0
+        self.tail = 0
+        self.scanned = 0
 
-    def start(self):
+    def start(self, timeout=10.0):
         # startup the openocd server
         openocd_args = [self.exec]
-        # make sure to use the expected port
+        # make sure to use the expected ports
         openocd_args.extend(['-c', f'tcl_port {self.tcl_port}'])
+        openocd_args.extend(['-c', f'gdb_port {self.gdb_port}'])
+        openocd_args.extend(['-c', f'telnet_port {self.telnet_port}'])
         for command in self.CONFIG_COMMANDS:
             openocd_args.extend(['-c', command])
+            if command.startswith('cmsis_dap_vid_pid') and self.serial is not None:
+                openocd_args.extend(['-c', f'adapter serial {self.serial}'])
         self.process = subprocess.Popen(
             openocd_args,
             stdin=subprocess.DEVNULL,
             stdout=subprocess.DEVNULL,
             stderr=subprocess.DEVNULL
         )
-        # connect over the tcl interface
-        self.tcl_sock.connect((self.ip, self.tcl_port))
+        # connect over the tcl interface, once the server is listening
+        self._connect(timeout)
         # ensure we can send a command, and receive input back
         self.send(b'version')
 
+    def _connect(self, timeout):
+        # the tcl port only opens after the config commands have run, so poll it with backoff
+        deadline = time.monotonic() + timeout
+        delay = 0.01
+        while True:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.settimeout(1.0)
+            try:
+                sock.connect((self.ip, self.tcl_port))
+                break
+            except ConnectionRefusedError:
+                sock.close()
+            if self.process.poll() is not None:
+                raise ValueError(f'openocd exited with {self.process.returncode} before opening the tcl port')
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'openocd did not open the tcl port within {timeout}s')
+            time.sleep(delay)
+            delay = min(delay * 2, 0.5)
+        self.tcl_sock.close()
+        self.tcl_sock = sock
+        self.head = self.tail = self.scanned = 0
+
+    def alive(self):
+        # true if the server is running and still answering commands
+        if self.process is None or self.process.poll() is not None:
+            return False
+        try:
+            self.send(b'version')
+        except OSError:
+            return False
+        return True
+
+    def restart(self):
+        self.close()
+        self.start()
+
     def close(self):
         try:
             # attempt to close nicely
-            self.send(b'rtt server stop %i' % (self.rtt_port))
-            self.send(b'shutdown')
-            time.sleep(0.1)
+            if self.process is not None and self.process.poll() is None:
+                self.send(b'rtt server stop %i' % (self.rtt_port))
+                self.send(b'shutdown')
+                time.sleep(0.1)
+        except OSError:
+            pass
         finally:
             # close connections and force server shutdown
             self.tcl_sock.close()
-            self.rtt_sock.close()
-            self.process.terminate()
+            if self.rtt is not None:
+                self.rtt.close()
+                self.rtt = None
+            if self.notifications is not None:
+                self.notifications.close()
+                self.notifications = None
+            if self.process is not None:
+                self.process.terminate()
+                self.process.wait()
 
-    def send(self, data):
-        self.tcl_sock.send(data + self.TERM)
-        # get and return response
-        idx = -1
+    def send(self, data, timeout=None):
+        # timeout, in seconds, replaces the connection's timeout for a slow command
+        previous = self._timeout(timeout) if timeout is not None else None
+        try:
+            self.tcl_sock.sendall(data + self.TERM)
+            try:
+                return self._response()
+            except OSError:
+                self._resync(1)
+                raise
+        finally:
+            if timeout is not None:
+                self._timeout(previous)
+
+    def send_many(self, commands, window=64, timeout=None):
+        # keep up to window commands in flight without waiting for each response, sending more as
+        # responses come back so neither side stalls on full socket buffers, and return the responses
+        # in order, commands are wrapped in braces, so theirs have to balance, timeout is as for send,
+        # for each response
+        for command in commands:
+            if not _balanced(command):
+                raise ValueError(f'unbalanced braces in {command!r}')
+        previous = self._timeout(timeout) if timeout is not None else None
+        try:
+            return self._send_many(commands, window)
+        finally:
+            if timeout is not None:
+                self._timeout(previous)
+
+    def _send_many(self, commands, window):
+        responses, errors = [], {}
+        sent = 0
+        for num, command in enumerate(commands):
+            burst = commands[sent:num+window]
+            if burst:
+                # catch errors, so that each response starts with the tcl return code
+                self.tcl_sock.sendall(b''.join(
+                    b'format "%%d %%s" [catch {%b} _send_many_result] $_send_many_result' % cmd + self.TERM
+                    for cmd in burst
+                ))
+                sent += len(burst)
+            try:
+                code, _, response = self._response().partition(b' ')
+            except OSError:
+                self._resync(sent - len(responses))
+                raise
+            if code == b'1':
+                errors[num] = (command, response)
+                response = None
+            responses.append(response)
+        if errors:
+            raise TclError(errors, responses)
+        return responses
+
+    def _timeout(self, timeout):
+        # swaps in the connection's timeout and returns the previous one, a closed connection keeps it
+        previous = self.tcl_sock.gettimeout()
+        if self.tcl_sock.fileno() >= 0:
+            self.tcl_sock.settimeout(timeout)
+        return previous
+
+    def _resync(self, owed):
+        # after a failed read the responses still owed would answer the next commands, so read them
+        # now, or if that fails too, close the connection rather than use it out of step
+        try:
+            for _ in range(owed):
+                self._response()
+        except OSError:
+            self.tcl_sock.close()
+
+    def _response(self):
+        idx = self._find_term()
         while idx < 0:
-            # read back in 1k chunks
-            chunk = self.tcl_sock.recv(self.buffer_chunk)
-            self.buffer += chunk
-            # check for the terminator character
-            idx = self.buffer.find(self.TERM)
-
-        response = self.buffer[:idx]
-        # strip the terminator character and prevoius response
-        self.buffer = self.buffer[idx+1:]
+            self._recv()
+            idx = self._find_term()
+        response = bytes(self.view[self.head:idx])
+        # skip the terminator character
+        self._consume(idx + 1)
         return response
 
+    def send_stream(self, data):
+        # like send, but yields the response in chunks as they arrive instead of holding all of it
+        self.tcl_sock.sendall(data + self.TERM)
+        while True:
+            idx = self._find_term()
+            if idx >= 0:
+                if idx > self.head:
+                    yield bytes(self.view[self.head:idx])
+                self._consume(idx + 1)
+                return
+            if self.tail > self.head:
+                yield bytes(self.view[self.head:self.tail])
+                self._consume(self.tail)
+            self._recv()
+
+    def _find_term(self):
+        idx = self.buffer.find(self.TERM, self.scanned, self.tail)
+        self.scanned = self.tail if idx < 0 else idx
+        return idx
+
+    def _consume(self, idx):
+        self.head = idx
+        self.scanned = max(self.scanned, idx)
+        if self.head == self.tail:
+            self.head = self.tail = self.scanned = 0
+
+    def _recv(self):
+        if self.tail == len(self.buffer):
+            # move unread data to the front of a new buffer, doubling the size (and so the size
+            # of the next read) when the buffer is mostly unread data
+            pending = self.tail - self.head
+            size = len(self.buffer) * (2 if pending > len(self.buffer) // 2 else 1)
+            buffer = bytearray(size)
+            buffer[:pending] = self.view[self.head:self.tail]
+            self.buffer, self.view = buffer, memoryview(buffer)
+            self.scanned -= self.head
+            self.head, self.tail = 0, pending
+        read = self.tcl_sock.recv_into(self.view[self.tail:])
+        if read == 0:
+            raise ConnectionError('openocd closed the tcl connection')
+        self.tail += read
+
+    def read_memory(self, addr, length, chunk=1024):
+        # words through the read_memory command (openocd 0.12), chunk words a command
+        start = addr & ~0x3
+        count = (addr + length - start + 3) // 4
+        responses = self.send_many([
+            b'read_memory 0x%x 32 %d' % (start + 4 * idx, min(chunk, count - idx))
+            for idx in range(0, count, chunk)
+        ])
+        words = [int(word, 0) for response in responses for word in response.split()]
+        return memoryview(struct.pack('<%dI' % len(words), *words))[addr-start:addr-start+length]
+
+    def write_memory(self, addr, data, chunk=1024):
+        assert(addr % 4 == 0 and len(data) % 4 == 0)
+        words = struct.unpack('<%dI' % (len(data) // 4), data)
+        self.send_many([
+            b'write_memory 0x%x 32 {%b}' % (addr + 4 * idx, b' '.join(b'0x%x' % w for w in words[idx:idx+chunk]))
+            for idx in range(0, len(words), chunk)
+        ])
+
     def enable_rtt(self, address=b'0x20000000', size=b'0x10000'):
         self.send(b'rtt setup %b %b "SEGGER RTT"' % (address, size))
         self.send(b'rtt start')
         if b'Channels:' not in self.send(b'rtt channels'):
             raise ValueError('failed to find rtt channels, initialization failed')
         self.send(b'rtt server start %i 0' % (self.rtt_port))
-        
-        self.rtt_sock.connect((self.ip, self.rtt_port))
-        return streamexpect.wrap(self.rtt_sock)
+
+        rtt_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        rtt_sock.connect((self.ip, self.rtt_port))
+        self.rtt = RttSocket(rtt_sock)
+        return self.rtt
+
+    def enable_notifications(self):
+        if self.notifications is None:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect((self.ip, self.tcl_port))
+            self.notifications = TclNotifications(sock)
+        return self.notifications
+
+    def wait_for_state(self, state, timeout=1.0, since=None):
+        # state as curstate reports it ('halted', 'running', 'reset'), see TclNotifications
+        return self.enable_notifications().wait_for_state(state, timeout, since)
+
+    def add_callback(self, callback):
+        # callback(event, state) for each target event, on the notification thread
+        self.enable_notifications().callbacks.append(callback)
+
+    def connect_gdb(self, timeout=5.0):
+        # bulk memory and register access over the gdb port, openocd halts the target on connect
+        return GdbClient(self.ip, self.gdb_port, timeout)
+
+    def disable_rtt(self):
+        if self.rtt is not None:
+            self.rtt.close()
+            self.rtt = None
+        # errors here just mean rtt was not running
+        try:
+            self.send_many([b'rtt server stop %i' % (self.rtt_port), b'rtt stop'])
+        except TclError:
+            pass
+
+class OpenOCDPool:
+    # keeps one running openocd server per configuration (the OpenOCD constructor arguments), so
+    # the startup and connect under reset are paid once per session instead of once per user
+    # commands that undo what a user may have left behind, without resetting the target, failures
+    # just mean there was nothing to undo (rwp all needs openocd 0.12 or newer)
+    RESTORE_COMMANDS = [b'rbp all', b'rwp all', b'resume']
+
+    def __init__(self, init_commands=(b'reset run',)):
+        # init commands run after each (re)start of a server
+        self.init_commands = list(init_commands)
+        self.servers = {}
+        self.in_use = set()
+
+    def acquire(self, **kwargs):
+        key = tuple(sorted(kwargs.items()))
+        assert(key not in self.in_use)
+        openocd = self.servers.get(key)
+        if openocd is None:
+            openocd = OpenOCD(**kwargs)
+            self.servers[key] = openocd
+            openocd.start()
+            self._init(openocd)
+        elif not openocd.alive():
+            openocd.restart()
+            self._init(openocd)
+        self.in_use.add(key)
+        return openocd
+
+    def release(self, openocd):
+        key = next(key for key, server in self.servers.items() if server is openocd)
+        self.in_use.discard(key)
+        if not openocd.alive():
+            # restarted on the next acquire
+            return
+        openocd.disable_rtt()
+        if openocd.notifications is not None:
+            openocd.notifications.callbacks.clear()
+        try:
+            openocd.send_many(self.RESTORE_COMMANDS)
+        except TclError:
+            pass
+
+    def close(self):
+        for openocd in self.servers.values():
+            openocd.close()
+        self.servers.clear()
+        self.in_use.clear()
+
+    def _init(self, openocd):
+        for command in self.init_commands:
+            openocd.send(command)
@@ -0,0 +1,75 @@
+import os
+import sys
+import tempfile
+import time
+import usb.core
+
+if sys.platform == 'win32':
+    import msvcrt
+else:
+    import fcntl
+
+# openocd ports for the first probe, each further probe (by position in the sorted serials) is offset
+# by PORT_STRIDE so servers for different probes can run side by side
+OPENOCD_PORTS = {'tcl_port': 6666, 'rtt_port': 7777, 'gdb_port': 3333, 'telnet_port': 4444}
+PORT_STRIDE = 10
+
+def find_devices(vid, pid, serial=None, backend=None):
+    # every attached probe, or only the one with the given serial number
+    devices = usb.core.find(find_all=True, idVendor=vid, idProduct=pid, backend=backend)
+    return [d for d in devices if serial is None or d.serial_number == serial]
+
+def find_device(vid, pid, serial=None, backend=None):
+    devices = find_devices(vid, pid, serial, backend)
+    return devices[0] if devices else None
+
+def find_serials(vid, pid, backend=None):
+    return sorted(d.serial_number for d in find_devices(vid, pid, backend=backend))
+
+def openocd_ports(index):
+    return {name: port + PORT_STRIDE * index for name, port in OPENOCD_PORTS.items()}
+
+class ProbeLock:
+    # exclusive use of a probe across processes, as a lock file in the temp directory, which the os
+    # releases if the holder dies
+    def __init__(self, serial, directory=None):
+        directory = directory if directory is not None else tempfile.gettempdir()
+        self.path = os.path.join(directory, f'riceprobe-{serial}.lock')
+        self.file = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+    def acquire(self, timeout=None):
+        # waits for the lock, forever by default
+        end = time.monotonic() + timeout if timeout is not None else None
+        file = open(self.path, 'a+')
+        while True:
+            try:
+                if sys.platform == 'win32':
+                    file.seek(0)
+                    msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+                else:
+                    fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                if end is not None and time.monotonic() > end:
+                    file.close()
+                    raise TimeoutError(f'probe is in use, locked with {self.path}')
+                time.sleep(0.1)
+        self.file = file
+
+    def release(self):
+        if self.file is None:
+            return
+        if sys.platform == 'win32':
+            self.file.seek(0)
+            msvcrt.locking(self.file.fileno(), msvcrt.LK_UNLCK, 1)
+        else:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_UN)
+        self.file.close()
+        self.file = None
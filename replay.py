@@ -0,0 +1,393 @@
+import collections
+import json
+import threading
+import time
+import types
+import usb.backend
+import usb.backend.libusb0
+import usb.backend.libusb1
+import usb.backend.openusb
+import usb.core
+
+# descriptor fields kept in a recording, enough for usb.core to enumerate and open the device
+DEVICE_FIELDS = [
+    'bLength', 'bDescriptorType', 'bcdUSB', 'bDeviceClass', 'bDeviceSubClass', 'bDeviceProtocol',
+    'bMaxPacketSize0', 'idVendor', 'idProduct', 'bcdDevice', 'iManufacturer', 'iProduct', 'iSerialNumber',
+    'bNumConfigurations', 'address', 'bus', 'port_number', 'port_numbers', 'speed'
+]
+CONFIGURATION_FIELDS = [
+    'bLength', 'bDescriptorType', 'wTotalLength', 'bNumInterfaces', 'bConfigurationValue', 'iConfiguration',
+    'bmAttributes', 'bMaxPower', 'extra_descriptors'
+]
+INTERFACE_FIELDS = [
+    'bLength', 'bDescriptorType', 'bInterfaceNumber', 'bAlternateSetting', 'bNumEndpoints', 'bInterfaceClass',
+    'bInterfaceSubClass', 'bInterfaceProtocol', 'iInterface', 'extra_descriptors'
+]
+ENDPOINT_FIELDS = [
+    'bLength', 'bDescriptorType', 'bEndpointAddress', 'bmAttributes', 'wMaxPacketSize', 'bInterval',
+    'bRefresh', 'bSynchAddress', 'extra_descriptors'
+]
+
+RECORDING_VERSION = 1
+# how long a read waits for the writes it answers when no timeout is given, in seconds
+REPLAY_WAIT = 5.0
+
+class ReplayDivergence(ValueError):
+    pass
+
+def default_backend():
+    # the backend usb.core.find would pick, for RecordingBackend to wrap
+    for module in (usb.backend.libusb1, usb.backend.libusb0, usb.backend.openusb):
+        backend = module.get_backend()
+        if backend is not None:
+            return backend
+    raise usb.core.NoBackendError('No backend available')
+
+def _fields(desc, fields):
+    values = {}
+    for name in fields:
+        value = getattr(desc, name, None)
+        values[name] = list(value) if isinstance(value, (tuple, list, bytes, bytearray)) else value
+    return values
+
+def _descriptors(backend, dev):
+    # every descriptor of dev as plain values, interfaces with all their alternate settings
+    device = _fields(backend.get_device_descriptor(dev), DEVICE_FIELDS)
+    configurations = []
+    for config in range(device['bNumConfigurations']):
+        desc = backend.get_configuration_descriptor(dev, config)
+        interfaces = []
+        for intf in range(desc.bNumInterfaces):
+            alt = 0
+            while True:
+                try:
+                    intf_desc = backend.get_interface_descriptor(dev, intf, alt, config)
+                except IndexError:
+                    break
+                endpoints = [
+                    _fields(backend.get_endpoint_descriptor(dev, ep, intf, alt, config), ENDPOINT_FIELDS)
+                    for ep in range(intf_desc.bNumEndpoints)
+                ]
+                interfaces.append({'descriptor': _fields(intf_desc, INTERFACE_FIELDS), 'endpoints': endpoints})
+                alt += 1
+        configurations.append({'descriptor': _fields(desc, CONFIGURATION_FIELDS), 'interfaces': interfaces})
+    return {'device': device, 'configurations': configurations, 'control': {}}
+
+def _control_key(bmRequestType, bRequest, wValue, wIndex, length):
+    return f'{bmRequestType:02x}:{bRequest:02x}:{wValue:04x}:{wIndex:04x}:{length}'
+
+def _error(e):
+    return {'type': type(e).__name__, 'strerror': e.strerror, 'errno': e.errno, 'code': e.backend_error_code}
+
+def _raise(error):
+    cls = usb.core.USBTimeoutError if error['type'] == 'USBTimeoutError' else usb.core.USBError
+    raise cls(error['strerror'], error['code'], error['errno'])
+
+class RecordedDevice:
+    def __init__(self, index, dev):
+        self.index = index
+        self.dev = dev
+
+class RecordingBackend(usb.backend.IBackend):
+    # passes everything through to another pyusb backend, recording the descriptors, control
+    # transfers and bulk traffic of each device so ReplayBackend can stand in for it later
+    def __init__(self, backend):
+        super().__init__()
+        self.backend = backend
+        self.devices = []
+        # index of each recorded device by bus, address, vid and pid, for later enumerations
+        self.addresses = {}
+        # each bulk transfer, as a dict with the device index, op, endpoint, interface, time and data
+        self.events = []
+        # writes so far per (device, interface), which reads record to replay them in causal order
+        self.writes = collections.Counter()
+        self.lock = threading.Lock()
+        self.start = time.monotonic()
+
+    def save(self, path):
+        with self.lock:
+            recording = {'version': RECORDING_VERSION, 'devices': self.devices, 'events': self.events}
+            with open(path, 'w') as file:
+                json.dump(recording, file)
+
+    def _record(self, event):
+        with self.lock:
+            event['time'] = time.monotonic() - self.start
+            key = (event['device'], event['intf'])
+            if event['op'] == 'write':
+                self.writes[key] += 1
+            else:
+                event['after'] = self.writes[key]
+            self.events.append(event)
+
+    def enumerate_devices(self):
+        for dev in self.backend.enumerate_devices():
+            desc = self.backend.get_device_descriptor(dev)
+            key = (getattr(desc, 'bus', None), getattr(desc, 'address', None), desc.idVendor, desc.idProduct)
+            with self.lock:
+                if key not in self.addresses:
+                    self.addresses[key] = len(self.devices)
+                    self.devices.append(_descriptors(self.backend, dev))
+            yield RecordedDevice(self.addresses[key], dev)
+
+    def get_device_descriptor(self, dev):
+        return self.backend.get_device_descriptor(dev.dev)
+
+    def get_configuration_descriptor(self, dev, config):
+        return self.backend.get_configuration_descriptor(dev.dev, config)
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        return self.backend.get_interface_descriptor(dev.dev, intf, alt, config)
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        return self.backend.get_endpoint_descriptor(dev.dev, ep, intf, alt, config)
+
+    def open_device(self, dev):
+        return RecordedDevice(dev.index, self.backend.open_device(dev.dev))
+
+    def close_device(self, dev_handle):
+        self.backend.close_device(dev_handle.dev)
+
+    def set_configuration(self, dev_handle, config_value):
+        self.backend.set_configuration(dev_handle.dev, config_value)
+
+    def get_configuration(self, dev_handle):
+        return self.backend.get_configuration(dev_handle.dev)
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        self.backend.set_interface_altsetting(dev_handle.dev, intf, altsetting)
+
+    def claim_interface(self, dev_handle, intf):
+        self.backend.claim_interface(dev_handle.dev, intf)
+
+    def release_interface(self, dev_handle, intf):
+        self.backend.release_interface(dev_handle.dev, intf)
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        event = {'device': dev_handle.index, 'op': 'write', 'ep': ep, 'intf': intf, 'data': bytes(data).hex()}
+        try:
+            event['result'] = self.backend.bulk_write(dev_handle.dev, ep, intf, data, timeout)
+        except usb.core.USBError as e:
+            event['error'] = _error(e)
+            raise
+        finally:
+            self._record(event)
+        return event['result']
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        event = {'device': dev_handle.index, 'op': 'read', 'ep': ep, 'intf': intf}
+        try:
+            length = self.backend.bulk_read(dev_handle.dev, ep, intf, buff, timeout)
+            event['data'] = bytes(buff[:length]).hex()
+        except usb.core.USBError as e:
+            event['error'] = _error(e)
+            raise
+        finally:
+            self._record(event)
+        return length
+
+    def intr_read(self, dev_handle, ep, intf, buff, timeout):
+        return self.bulk_read(dev_handle, ep, intf, buff, timeout)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue, wIndex, data, timeout):
+        # control transfers are replayed by request, regardless of order
+        control = {}
+        try:
+            result = self.backend.ctrl_transfer(
+                dev_handle.dev, bmRequestType, bRequest, wValue, wIndex, data, timeout
+            )
+            control['result'] = result
+            if bmRequestType & 0x80:
+                control['data'] = bytes(data[:result]).hex()
+        except usb.core.USBError as e:
+            control['error'] = _error(e)
+            raise
+        finally:
+            key = _control_key(bmRequestType, bRequest, wValue, wIndex, len(data))
+            with self.lock:
+                self.devices[dev_handle.index]['control'][key] = control
+        return result
+
+    def clear_halt(self, dev_handle, ep):
+        self.backend.clear_halt(dev_handle.dev, ep)
+
+    def reset_device(self, dev_handle):
+        self.backend.reset_device(dev_handle.dev)
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return self.backend.is_kernel_driver_active(dev_handle.dev, intf)
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        self.backend.detach_kernel_driver(dev_handle.dev, intf)
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        self.backend.attach_kernel_driver(dev_handle.dev, intf)
+
+class ReplayDevice:
+    def __init__(self, index, recording, events):
+        self.index = index
+        self.recording = recording
+        # recorded transfers per endpoint, each endpoint is replayed in order
+        self.endpoints = collections.defaultdict(collections.deque)
+        # recorded and replayed times of the writes on each interface, reads wait for the writes
+        # they answer
+        self.recorded_writes = collections.defaultdict(list)
+        self.writes = collections.defaultdict(list)
+        for event in events:
+            self.endpoints[event['ep']].append(event)
+            if event['op'] == 'write':
+                self.recorded_writes[event['intf']].append(event['time'])
+
+class ReplayBackend(usb.backend.IBackend):
+    # stands in for a recorded device, writes must match the recording byte for byte, or raise
+    # ReplayDivergence, and reads return the recorded responses, once the writes they answered have
+    # been replayed, and with timing, no sooner after them than they were recorded
+    def __init__(self, recording, timing=False):
+        super().__init__()
+        if recording.get('version') != RECORDING_VERSION:
+            raise ValueError(f'unsupported recording version {recording.get("version")}')
+        self.timing = timing
+        self.lock = threading.Condition()
+        self.devices = [
+            ReplayDevice(num, device, [e for e in recording['events'] if e['device'] == num])
+            for num, device in enumerate(recording['devices'])
+        ]
+        self.start = time.monotonic()
+
+    @classmethod
+    def load(cls, path, timing=False):
+        with open(path) as file:
+            return cls(json.load(file), timing)
+
+    def remaining(self):
+        # transfers not yet replayed, across every device
+        with self.lock:
+            return sum(len(events) for dev in self.devices for events in dev.endpoints.values())
+
+    def enumerate_devices(self):
+        return iter(self.devices)
+
+    def get_device_descriptor(self, dev):
+        return types.SimpleNamespace(**dev.recording['device'])
+
+    def get_configuration_descriptor(self, dev, config):
+        if config >= len(dev.recording['configurations']):
+            raise IndexError('Invalid configuration index')
+        return types.SimpleNamespace(**dev.recording['configurations'][config]['descriptor'])
+
+    def _interface(self, dev, intf, alt, config):
+        for interface in dev.recording['configurations'][config]['interfaces']:
+            desc = interface['descriptor']
+            if desc['bInterfaceNumber'] == intf and desc['bAlternateSetting'] == alt:
+                return interface
+        raise IndexError('Invalid interface index')
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        return types.SimpleNamespace(**self._interface(dev, intf, alt, config)['descriptor'])
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        return types.SimpleNamespace(**self._interface(dev, intf, alt, config)['endpoints'][ep])
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        pass
+
+    def get_configuration(self, dev_handle):
+        return dev_handle.recording['configurations'][0]['descriptor']['bConfigurationValue']
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        pass
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def _next(self, dev_handle, ep, op):
+        events = dev_handle.endpoints[ep]
+        if not events:
+            raise ReplayDivergence(f'{op} on endpoint 0x{ep:02x} past the end of the recording')
+        if events[0]['op'] != op:
+            raise ReplayDivergence(f'{op} on endpoint 0x{ep:02x}, recording has a {events[0]["op"]}')
+        return events[0]
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        with self.lock:
+            event = self._next(dev_handle, ep, 'write')
+            sent = bytes(data)
+            if sent.hex() != event['data']:
+                num = len(dev_handle.writes[intf])
+                raise ReplayDivergence(
+                    f'write {num} on endpoint 0x{ep:02x} diverged from the recording: '
+                    f'sent {sent[:32].hex()}, recorded {event["data"][:64]}'
+                )
+            dev_handle.endpoints[ep].popleft()
+            dev_handle.writes[intf].append(time.monotonic())
+            self.lock.notify_all()
+        if 'error' in event:
+            _raise(event['error'])
+        return event['result']
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        with self.lock:
+            event = self._next(dev_handle, ep, 'read')
+            after = event['after']
+            deadline = time.monotonic() + (timeout / 1000 if timeout else REPLAY_WAIT)
+            while True:
+                now = time.monotonic()
+                ready = None
+                if len(dev_handle.writes[intf]) >= after:
+                    ready = now
+                    if self.timing and after:
+                        # as long after the last write it followed as when it was recorded
+                        latency = event['time'] - dev_handle.recorded_writes[intf][after - 1]
+                        ready = dev_handle.writes[intf][after - 1] + latency
+                    elif self.timing:
+                        ready = self.start + event['time']
+                if ready is not None and ready <= now:
+                    break
+                if now >= deadline:
+                    raise usb.core.USBTimeoutError('Operation timed out', -7, 110)
+                self.lock.wait(min(deadline, ready if ready is not None else deadline) - now)
+            dev_handle.endpoints[ep].popleft()
+        if 'error' in event:
+            _raise(event['error'])
+        data = bytes.fromhex(event['data'])[:len(buff) * buff.itemsize]
+        buff[:len(data)] = type(buff)('B', data)
+        return len(data)
+
+    def intr_read(self, dev_handle, ep, intf, buff, timeout):
+        return self.bulk_read(dev_handle, ep, intf, buff, timeout)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue, wIndex, data, timeout):
+        key = _control_key(bmRequestType, bRequest, wValue, wIndex, len(data))
+        control = dev_handle.recording['control'].get(key)
+        if control is None:
+            raise ReplayDivergence(f'control request 0x{bmRequestType:02x} 0x{bRequest:02x} not in the recording')
+        if 'error' in control:
+            _raise(control['error'])
+        if 'data' in control:
+            desc = bytes.fromhex(control['data'])
+            data[:len(desc)] = type(data)('B', desc)
+        return control['result']
+
+    def clear_halt(self, dev_handle, ep):
+        pass
+
+    def reset_device(self, dev_handle):
+        pass
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass
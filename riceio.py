@@ -0,0 +1,196 @@
+import array
+import collections
+import statistics
+import struct
+import threading
+import time
+import usb.core
+import usb.util
+
+IO_INTERFACE = 'Rice I/O v1'
+# each streamed packet starts with its sequence number, the rest is a pattern offset by it
+HEADER = struct.Struct('<I')
+
+def find_endpoints(usb_device):
+    intf = usb.util.find_descriptor(
+        usb_device.get_active_configuration(),
+        custom_match=lambda i : usb.util.get_string(usb_device, i.iInterface) == IO_INTERFACE
+    )
+    return intf.endpoints()
+
+class LoopbackEndpoint:
+    # one direction of Loopback, with the pyusb endpoint write and read calls
+    def __init__(self, loopback):
+        self.loopback = loopback
+
+    def write(self, data, timeout=None):
+        return self.loopback.write(data, timeout)
+
+    def read(self, size_or_buffer, timeout=None):
+        return self.loopback.read(size_or_buffer, timeout)
+
+class Loopback:
+    # stands in for the rice i/o interface without the board: each packet written comes back after
+    # latency seconds, and writes block while capacity packets are waiting to be read, like the
+    # probe's buffers
+    def __init__(self, latency=0.0, capacity=8):
+        self.latency = latency
+        self.capacity = capacity
+        # (ready time, data) for each packet not yet read
+        self.packets = collections.deque()
+        self.lock = threading.Condition()
+        self.out_ep = LoopbackEndpoint(self)
+        self.in_ep = LoopbackEndpoint(self)
+
+    def endpoints(self):
+        return self.out_ep, self.in_ep
+
+    def _wait(self, ready, timeout):
+        deadline = time.monotonic() + timeout / 1000 if timeout else None
+        while True:
+            now = time.monotonic()
+            wake = ready(now)
+            if wake is True:
+                return
+            if deadline is not None and now >= deadline:
+                raise usb.core.USBTimeoutError('Operation timed out', -7, 110)
+            wakeups = [t for t in (deadline, wake) if t is not None]
+            self.lock.wait(min(wakeups) - now if wakeups else None)
+
+    def write(self, data, timeout=None):
+        with self.lock:
+            self._wait(lambda now: len(self.packets) < self.capacity or None, timeout)
+            self.packets.append((time.monotonic() + self.latency, bytes(data)))
+            self.lock.notify_all()
+        return len(data)
+
+    def read(self, size_or_buffer, timeout=None):
+        with self.lock:
+            def ready(now):
+                if not self.packets:
+                    return None
+                return True if self.packets[0][0] <= now else self.packets[0][0]
+            self._wait(ready, timeout)
+            _, data = self.packets.popleft()
+            self.lock.notify_all()
+        if isinstance(size_or_buffer, int):
+            return array.array('B', data[:size_or_buffer])
+        size = min(len(data), len(size_or_buffer))
+        size_or_buffer[:size] = array.array('B', data[:size])
+        return size
+
+class RiceIO:
+    # the rice i/o bulk loopback interface, of a probe or a Loopback stand-in
+    def __init__(self, out_ep, in_ep):
+        self.out_ep = out_ep
+        self.in_ep = in_ep
+
+    @classmethod
+    def open(cls, usb_device):
+        return cls(*find_endpoints(usb_device))
+
+    def stream(self, packets=1000, packet_size=512, depth=4, timeout=1000):
+        # writes packets as fast as the interface takes them, with depth transfers outstanding in
+        # each direction (depth writer and depth reader threads), reading each straight into a
+        # buffer allocated up front, and checks every packet against its sequence numbered pattern
+        assert(packet_size > HEADER.size)
+        pattern = bytes(n & 0xff for n in range(packet_size + 256))
+        # send time and latency of each packet by sequence number, and whether it arrived
+        sent = array.array('d', bytes(8 * packets))
+        latencies = array.array('d', bytes(8 * packets))
+        received = bytearray(packets)
+        lock = threading.Lock()
+        # packets in flight, so the writers don't overrun the interface's buffering
+        slots = threading.BoundedSemaphore(depth)
+        state = {
+            'next': 0, 'reads': packets, 'written': 0, 'read': 0, 'freed': 0,
+            'errors': 0, 'duplicates': 0, 'bytes': 0, 'failures': [],
+        }
+        stop = threading.Event()
+
+        def free():
+            # a slot is freed for each packet both written and read back, whichever finishes first,
+            # a read can complete before the write it answers is counted (or in a replay, is made)
+            while state['freed'] < min(state['written'], state['read']):
+                state['freed'] += 1
+                slots.release()
+
+        def writer():
+            buffer = bytearray(packet_size)
+            view = memoryview(buffer)
+            while not stop.is_set():
+                if not slots.acquire(timeout=timeout / 1000):
+                    continue
+                with lock:
+                    seq = state['next']
+                    state['next'] += 1
+                if seq >= packets:
+                    slots.release()
+                    return
+                HEADER.pack_into(buffer, 0, seq)
+                offset = seq & 0xff
+                view[HEADER.size:] = pattern[offset:offset+packet_size-HEADER.size]
+                sent[seq] = time.perf_counter()
+                self.out_ep.write(buffer, timeout)
+                with lock:
+                    state['written'] += 1
+                    free()
+
+        def reader():
+            buffer = array.array('B', bytes(packet_size))
+            view = memoryview(buffer)
+            while not stop.is_set():
+                with lock:
+                    if state['reads'] == 0:
+                        return
+                    state['reads'] -= 1
+                size = self.in_ep.read(buffer, timeout)
+                now = time.perf_counter()
+                seq = HEADER.unpack_from(buffer)[0] if size >= HEADER.size else packets
+                offset = seq & 0xff
+                intact = size == packet_size and seq < packets
+                intact = intact and view[HEADER.size:size] == pattern[offset:offset+size-HEADER.size]
+                with lock:
+                    state['read'] += 1
+                    free()
+                    state['bytes'] += size
+                    if not intact:
+                        state['errors'] += 1
+                    elif received[seq]:
+                        state['duplicates'] += 1
+                    else:
+                        received[seq] = 1
+                        latencies[seq] = now - sent[seq]
+
+        def run(fn):
+            try:
+                fn()
+            except Exception as e:
+                # one failure stops the whole stream
+                state['failures'].append(e)
+                stop.set()
+
+        threads = [threading.Thread(target=run, args=(fn,)) for fn in [writer] * depth + [reader] * depth]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        arrived = sorted(latencies[seq] for seq in range(packets) if received[seq])
+        results = {
+            'packets': packets,
+            'bytes_per_s': state['bytes'] / elapsed if elapsed else 0.0,
+            'errors': state['errors'],
+            'duplicates': state['duplicates'],
+            'missing': packets - len(arrived),
+            'failures': [repr(e) for e in state['failures']],
+        }
+        if arrived:
+            results.update({
+                'latency.p50_us': statistics.median(arrived) * 1e6,
+                'latency.p99_us': arrived[min(len(arrived) - 1, len(arrived) * 99 // 100)] * 1e6,
+                'latency.max_us': arrived[-1] * 1e6,
+            })
+        return results
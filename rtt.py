@@ -0,0 +1,256 @@
+import re
+import streamexpect
+import struct
+import threading
+import time
+
+# SEGGER RTT control block, the id, then the number of up and down buffers, followed by the up and
+# then down buffer descriptors (name, buffer, size, write offset, read offset, flags)
+RTT_ID = b'SEGGER RTT\x00'
+RTT_HEADER_SIZE = 24
+RTT_DESCRIPTOR_SIZE = 24
+
+class RttChannel:
+    # drains an rtt up channel on a background thread, so bursts of target output are read even
+    # when nothing is waiting on them (the target drops output once its up buffer fills), and
+    # searches with the same send/expect_bytes/expect_regex surface as a streamexpect wrapper,
+    # subclasses provide send, close, and _recv, which blocks for the next data (b'' once closed), an
+    # error from _recv closes the channel and is raised (as the cause) from each later expect
+    def __init__(self, size=1 << 20, window=1024):
+        # received data is data[0:], starting at stream offset base, and is capped at size bytes,
+        # dropping the oldest data when full
+        self.size = size
+        self.data = bytearray()
+        self.base = 0
+        # stream offset after the last match, the next expect starts here
+        self.consumed = 0
+        # bytes dropped before an expect could see them
+        self.dropped = 0
+        # (stream offset, receive time) for the start of each chunk still in data
+        self.chunks = []
+        # regex searches resume this far before where the last search stopped, so matches up to
+        # this long are found, like the history window of streamexpect
+        self.window = window
+        self.closed = False
+        # the exception that closed the channel, if one did
+        self.error = None
+        self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._read, daemon=True)
+        self.thread.start()
+
+    def expect_bytes(self, b, timeout=3):
+        # anything before the previous scan end minus the pattern length has been ruled out
+        def search(start, scanned):
+            pos = max(start, scanned - len(b) + 1)
+            idx = self.data.find(b, pos - self.base)
+            if idx < 0:
+                return None
+            idx += self.base
+            return streamexpect.SequenceMatch(None, b, idx, idx + len(b))
+        return self._expect(search, timeout)
+
+    def expect_regex(self, pattern, timeout=3, regex_options=0):
+        regex = re.compile(pattern, regex_options)
+        def search(start, scanned):
+            pos = max(start, scanned - self.window)
+            match = regex.search(self.data, pos - self.base)
+            if match is None:
+                return None
+            return streamexpect.RegexMatch(
+                None, match.group(0), match.start() + self.base, match.end() + self.base, match.groups()
+            )
+        return self._expect(search, timeout)
+
+    def time_of(self, offset):
+        # receive time of the data at a stream offset, None if it has already been dropped
+        with self.cond:
+            if offset < self.base:
+                return None
+            for start, timestamp in reversed(self.chunks):
+                if start <= offset:
+                    return timestamp
+        return None
+
+    def _expect(self, search, timeout):
+        end = time.monotonic() + timeout
+        with self.cond:
+            start = self.consumed
+            scanned = start
+            while True:
+                start = max(start, self.base)
+                match = search(start, scanned)
+                if match is not None:
+                    break
+                scanned = self.base + len(self.data)
+                remaining = end - time.monotonic()
+                if self.closed and self.error is not None:
+                    raise ConnectionError(f'rtt connection failed: {self.error}') from self.error
+                if self.closed:
+                    raise ConnectionError('rtt connection closed')
+                if remaining <= 0:
+                    raise streamexpect.ExpectTimeout()
+                self.cond.wait(remaining)
+            self.consumed = match.end
+            return match
+
+    def _read(self):
+        while True:
+            try:
+                data = self._recv()
+            except Exception as e:
+                # a waiting expect gets this instead of timing out
+                with self.cond:
+                    self.error = e
+                    self.closed = True
+                    self.cond.notify_all()
+                return
+            timestamp = time.monotonic()
+            with self.cond:
+                if not data:
+                    self.closed = True
+                    self.cond.notify_all()
+                    return
+                self.chunks.append((self.base + len(self.data), timestamp))
+                self.data += data
+                if len(self.data) > self.size:
+                    self._trim()
+                self.cond.notify_all()
+
+    def _trim(self):
+        # drop at least a quarter of the buffer at a time, so trimming stays amortized, preferring
+        # data that has already been matched past
+        trim = max(len(self.data) - self.size, self.size // 4, self.consumed - self.base)
+        trim = min(trim, len(self.data))
+        if self.base + trim > self.consumed:
+            self.dropped += self.base + trim - self.consumed
+            self.consumed = self.base + trim
+        del self.data[:trim]
+        self.base += trim
+        # keep the chunk that now holds the first byte
+        idx = 0
+        while idx + 1 < len(self.chunks) and self.chunks[idx + 1][0] <= self.base:
+            idx += 1
+        del self.chunks[:idx]
+
+class DapRtt(RttChannel):
+    # rtt directly over dap memory access, without openocd, the debug port must be powered up, and other
+    # users of the dap must hold lock while the channel is open
+    def __init__(
+        self, dap, address=0x20000000, length=0x10000, channel=0, poll_min=0.0005, poll_max=0.05,
+        size=1 << 20, window=1024
+    ):
+        self.dap = dap
+        self.lock = threading.Lock()
+        # polling backs off from poll_min to poll_max while the target is quiet, and drops back to
+        # poll_min once there is data or something to send
+        self.poll_min = poll_min
+        self.poll_max = poll_max
+        self.interval = poll_min
+        self.wake = threading.Event()
+        self.stopped = False
+        # data accepted by send, but not yet written to the down buffer
+        self.pending = bytearray()
+
+        self.control_block = self._find(address, length)
+        up_count, down_count = struct.unpack('<II', dap.read_memory(self.control_block + 16, 8))
+        if channel >= up_count or channel >= down_count:
+            raise ValueError(f'rtt channel {channel} not available, the target has {up_count} up and {down_count} down')
+        descriptors = self.control_block + RTT_HEADER_SIZE
+        self.up = self._descriptor(descriptors + RTT_DESCRIPTOR_SIZE * channel)
+        self.down = self._descriptor(descriptors + RTT_DESCRIPTOR_SIZE * (up_count + channel))
+        super().__init__(size, window)
+
+    def send(self, data):
+        with self.lock:
+            self.pending += data
+        self.wake.set()
+        return len(data)
+
+    def close(self):
+        self.stopped = True
+        self.wake.set()
+        self.thread.join()
+
+    def _find(self, address, length):
+        # the control block is word aligned, scan the whole window with block reads
+        memory = bytes(self.dap.read_memory(address, length))
+        idx = memory.find(RTT_ID)
+        while idx >= 0 and idx % 4 != 0:
+            idx = memory.find(RTT_ID, idx + 1)
+        if idx < 0:
+            raise ValueError(f'failed to find the rtt control block in 0x{address:08x}+0x{length:x}')
+        return address + idx
+
+    def _descriptor(self, address):
+        # (descriptor address, buffer address, buffer size)
+        _, buffer, size = struct.unpack('<III', self.dap.read_memory(address, 12))
+        return address, buffer, size
+
+    def _offsets(self, desc):
+        write, read = struct.unpack('<II', self.dap.read_memory(desc[0] + 12, 8))
+        if write >= desc[2] or read >= desc[2]:
+            raise ValueError(
+                f'rtt control block at 0x{self.control_block:08x} is corrupted, buffer offsets {write} and {read} '
+                f'are past its size of {desc[2]}'
+            )
+        return write, read
+
+    def _recv(self):
+        while not self.stopped:
+            with self.lock:
+                written = self._write_down()
+                data = self._read_up()
+            if data or written:
+                self.interval = self.poll_min
+                if data:
+                    return data
+                continue
+            if self.wake.wait(self.interval):
+                self.wake.clear()
+                self.interval = self.poll_min
+            else:
+                self.interval = min(2 * self.interval, self.poll_max)
+        return b''
+
+    def _read_up(self):
+        address, buffer, size = self.up
+        write, read = self._offsets(self.up)
+        if write == read:
+            return b''
+        if write > read:
+            data = bytes(self.dap.read_memory(buffer + read, write - read))
+        else:
+            data = bytes(self.dap.read_memory(buffer + read, size - read))
+            if write:
+                data += bytes(self.dap.read_memory(buffer, write))
+        # hand the space back to the target
+        self.dap.write_memory(address + 16, write.to_bytes(4, 'little'))
+        return data
+
+    def _write_down(self):
+        # returns the number of bytes written
+        if not self.pending:
+            return 0
+        address, buffer, size = self.down
+        write, read = self._offsets(self.down)
+        count = min((read - write - 1) % size, len(self.pending), size - write)
+        if count == 0:
+            return 0
+        self._write_bytes(buffer + write, self.pending[:count])
+        # data first, then the write offset, so the target never reads stale data
+        self.dap.write_memory(address + 12, ((write + count) % size).to_bytes(4, 'little'))
+        del self.pending[:count]
+        return count
+
+    def _write_bytes(self, address, data):
+        # dap block writes are whole words, so the unaligned ends are written a byte at a time rather
+        # than read back and written whole, which would race the target over the bytes around them
+        end = address + len(data)
+        head = min(-address & 0x3, len(data))
+        tail = max((end & ~0x3) - address, head)
+        if head:
+            self.dap.write_bytes(address, data[:head])
+        if tail > head:
+            self.dap.write_memory(address + head, data[head:tail])
+        if len(data) > tail:
+            self.dap.write_bytes(address + tail, data[tail:])
@@ -0,0 +1,72 @@
+import argparse
+import concurrent.futures
+import glob
+import os
+import re
+import subprocess
+import sys
+
+from conftest import RICEPROBE_VID, RICEPROBE_PID, sim_serial
+from probes import find_serials
+
+TESTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests')
+
+def count_tests(path):
+    with open(path) as file:
+        return len(re.findall(r'^def test_', file.read(), re.MULTILINE))
+
+def split(modules, workers):
+    # modules maps each module to its weight, the heaviest are placed first, each onto the least
+    # loaded worker
+    shards = [[] for _ in range(workers)]
+    loads = [0] * workers
+    for module, weight in sorted(modules.items(), key=lambda m: (-m[1], m[0])):
+        idx = loads.index(min(loads))
+        shards[idx].append(module)
+        loads[idx] += weight
+    return shards
+
+def run_worker(command):
+    process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    return process.returncode, process.stdout
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='run the test modules split across every attached RICEProbe, one worker process per probe',
+        epilog='any other arguments are passed on to pytest'
+    )
+    parser.add_argument('--sim', action='store_true', help='run against simulated probes')
+    parser.add_argument('--sim-probes', type=int, default=2, help='number of simulated probes')
+    parser.add_argument('--probe', action='append', default=[], metavar='SERIAL', help='only use these probes')
+    parser.add_argument('modules', nargs='*', help='test modules, defaults to every module in tests')
+    args, pytest_args = parser.parse_known_args(argv)
+
+    if args.sim:
+        serials = [sim_serial(n) for n in range(args.sim_probes)]
+        pytest_args += ['--sim', '--sim-probes', str(args.sim_probes)]
+    else:
+        serials = find_serials(RICEPROBE_VID, RICEPROBE_PID)
+    serials = args.probe or serials
+    if not serials:
+        print('no probes found', file=sys.stderr)
+        return 1
+    modules = args.modules or sorted(glob.glob(os.path.join(TESTS, 'test_*.py')))
+    shards = split({module: count_tests(module) for module in modules}, min(len(serials), len(modules)))
+
+    # workers hold their probe's lock for the whole run, see the probe_serial fixture
+    commands = [
+        [sys.executable, '-m', 'pytest', *shard, '--probe', serial, *pytest_args]
+        for serial, shard in zip(serials, shards)
+    ]
+    with concurrent.futures.ThreadPoolExecutor(len(commands)) as executor:
+        results = list(executor.map(run_worker, commands))
+
+    code = 0
+    for serial, (returncode, output) in zip(serials, results):
+        print(f'==== {serial} ====')
+        print(output)
+        code = code or returncode
+    return code
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,1137 @@
+import array
+import collections
+import threading
+import time
+import types
+import usb.backend
+import usb.core
+import usb.util
+
+from dap import EXECUTE_COMMANDS, QUEUE_COMMANDS
+from jtag import TAP_STATES
+
+# strings reported by the RICEProbe firmware
+MANUFACTURER = 'Nick Kraus'
+PRODUCT = 'RICEProbe IO CMSIS-DAP'
+DAP_INTERFACE = 'Rice CMSIS-DAP v2'
+IO_INTERFACE = 'Rice I/O v1'
+FIRMWARE_VERSION = 'v0.0.0-0-g0000000'
+PROTOCOL_VERSION = '2.1.1'
+
+# swd / jtag transfer acknowledgements, as reported in DAP_Transfer responses
+ACK_OK = 0x01
+ACK_WAIT = 0x02
+ACK_FAULT = 0x04
+ACK_NONE = 0x07
+VALUE_MISMATCH = 0x10
+
+# cortex-m debug registers
+DHCSR = 0xe000edf0
+DCRSR = 0xe000edf4
+DCRDR = 0xe000edf8
+
+# swj-dp select sequences, sent lsb first after at least 50 cycles of swdio/tms high
+JTAG_TO_SWD = 0xe79e
+SWD_TO_JTAG = 0xe73c
+
+def _parity(value):
+    return bin(value).count('1') & 1
+
+class Memory:
+    def __init__(self):
+        # list of (start, data, writable)
+        self.regions = []
+        # word aligned registers with custom behavior, address -> (read, write)
+        self.registers = {}
+
+    def add(self, start, size, writable=True, fill=0x00):
+        region = bytearray([fill]) * size
+        self.regions.append((start, region, writable))
+        return region
+
+    def _region(self, addr, size):
+        for start, region, writable in self.regions:
+            if start <= addr and addr + size <= start + len(region):
+                return region, addr - start, writable
+        return None, 0, False
+
+    def read(self, addr, size):
+        # returns None on a bus fault
+        register = self.registers.get(addr & ~0x3)
+        if register is not None:
+            return (register[0]() >> (8 * (addr & 0x3))) & ((1 << (8 * size)) - 1)
+        region, offset, _ = self._region(addr, size)
+        if region is None:
+            return None
+        return int.from_bytes(region[offset:offset+size], 'little')
+
+    def write(self, addr, size, value):
+        # returns False on a bus fault
+        register = self.registers.get(addr & ~0x3)
+        if register is not None:
+            register[1](value << (8 * (addr & 0x3)))
+            return True
+        region, offset, writable = self._region(addr, size)
+        if region is None or not writable:
+            return False
+        region[offset:offset+size] = value.to_bytes(size, 'little')
+        return True
+
+    def read_bytes(self, addr, size):
+        region, offset, _ = self._region(addr, size)
+        assert(region is not None)
+        return bytes(region[offset:offset+size])
+
+    def write_bytes(self, addr, data):
+        region, offset, _ = self._region(addr, len(data))
+        assert(region is not None)
+        region[offset:offset+len(data)] = data
+
+class Core:
+    def __init__(self, memory):
+        self.halted = False
+        self.dhcsr = 0
+        self.dcrdr = 0
+        self.regs = collections.defaultdict(int)
+        memory.registers[DHCSR] = (self.read_dhcsr, self.write_dhcsr)
+        memory.registers[DCRSR] = (lambda: 0, self.write_dcrsr)
+        memory.registers[DCRDR] = (lambda: self.dcrdr, self.write_dcrdr)
+
+    def read_dhcsr(self):
+        # S_REGRDY is always set, register transfers complete immediately
+        return (self.dhcsr & 0xf) | (1 << 16) | ((1 << 17) if self.halted else 0)
+
+    def write_dhcsr(self, value):
+        # writes are ignored without the debug key
+        if value >> 16 != 0xa05f:
+            return
+        self.dhcsr = value & 0xf
+        debugen = bool(value & 0x1)
+        self.halted = debugen and bool(value & 0x2)
+
+    def write_dcrsr(self, value):
+        regsel = value & 0x7f
+        if value & (1 << 16):
+            self.regs[regsel] = self.dcrdr
+        else:
+            self.dcrdr = self.regs[regsel]
+
+    def write_dcrdr(self, value):
+        self.dcrdr = value
+
+    def reset(self):
+        self.halted = False
+        self.regs.clear()
+
+class MemAp:
+    IDR = 0x24770011
+    BASE = 0xe00ff003
+    # CSW bits which read as set regardless of the written value (DeviceEn, and a fixed prot bit)
+    CSW_FIXED = 0x01000040
+
+    def __init__(self, memory):
+        self.memory = memory
+        self.csw = self.CSW_FIXED | 0x02
+        self.tar = 0
+
+    def read(self, addr):
+        # returns (ack, value)
+        if addr == 0x00:
+            return ACK_OK, self.csw
+        if addr == 0x04:
+            return ACK_OK, self.tar
+        if addr == 0x0c or 0x10 <= addr <= 0x1c:
+            return self._data(addr, None)
+        if addr == 0xf4:
+            return ACK_OK, 0x0
+        if addr == 0xf8:
+            return ACK_OK, self.BASE
+        if addr == 0xfc:
+            return ACK_OK, self.IDR
+        return ACK_OK, 0x0
+
+    def write(self, addr, value):
+        if addr == 0x00:
+            self.csw = (value & 0xff00ff77) | self.CSW_FIXED
+        elif addr == 0x04:
+            self.tar = value
+        elif addr == 0x0c or 0x10 <= addr <= 0x1c:
+            return self._data(addr, value)[0]
+        return ACK_OK
+
+    def _data(self, addr, value):
+        size = 1 << (self.csw & 0x7)
+        if addr == 0x0c:
+            target = self.tar
+        else:
+            # banked data registers access the four words at the 16 byte aligned TAR
+            target = (self.tar & ~0xf) | (addr & 0xc)
+        lane = target & 0x3 if size < 4 else 0
+        target &= ~(size - 1)
+        if value is None:
+            data = self.memory.read(target, size)
+            if data is not None:
+                data <<= 8 * lane
+        else:
+            data = (value >> (8 * lane)) & ((1 << (8 * size)) - 1)
+            data = data if self.memory.write(target, size, data) else None
+        if data is None:
+            return ACK_FAULT, 0
+        if addr == 0x0c and (self.csw >> 4) & 0x3 == 0x1:
+            # auto increment only wraps within a 1k block
+            self.tar = (self.tar & ~0x3ff) | ((self.tar + size) & 0x3ff)
+        return ACK_OK, data
+
+class DebugPort:
+    DPIDR = 0x2ba01477
+    # cdbgpwrupack stays set on this target while the debug port is powered
+    CTRL_STAT_FIXED = 0x20000000
+    STICKY = 0x000000b2
+    WRITABLE = 0x54000f0d
+
+    def __init__(self, ap):
+        self.ap = ap
+        self.ctrl_stat = 0
+        self.select = 0
+        self.rdbuff = 0
+
+    def reset(self):
+        self.ctrl_stat = 0
+        self.select = 0
+
+    def read_ctrl_stat(self):
+        value = self.ctrl_stat | self.CTRL_STAT_FIXED
+        # power up acknowledgements follow their requests
+        if value & (1 << 30):
+            value |= 1 << 31
+        if value & (1 << 28):
+            value |= 1 << 29
+        return value
+
+    def abort(self, value):
+        # STKCMPCLR, STKERRCLR, WDERRCLR, ORUNERRCLR
+        if value & (1 << 1):
+            self.ctrl_stat &= ~(1 << 4)
+        if value & (1 << 2):
+            self.ctrl_stat &= ~(1 << 5)
+        if value & (1 << 3):
+            self.ctrl_stat &= ~(1 << 7)
+        if value & (1 << 4):
+            self.ctrl_stat &= ~(1 << 1)
+
+    def access(self, mode, ap, rnw, addr, value=0):
+        # perform a single dp or ap access, returning (ack, value)
+        if ap:
+            # sticky errors block all ap accesses until cleared
+            if self.ctrl_stat & (1 << 5):
+                return ACK_FAULT, 0
+            if self.select >> 24 != 0:
+                # no ap is implemented other than ap 0, reads as zero
+                return ACK_OK, 0
+            reg = (self.select & 0xf0) | addr
+            if rnw:
+                ack, value = self.ap.read(reg)
+            else:
+                ack = self.ap.write(reg, value)
+            if ack == ACK_FAULT:
+                self.ctrl_stat |= 1 << 5
+                value = 0
+            self.rdbuff = value
+            return ack, value
+        if rnw:
+            if addr == 0x0:
+                value = self.DPIDR if mode == 'swd' else 0
+            elif addr == 0x4:
+                value = self.read_ctrl_stat()
+            elif addr == 0x8:
+                value = self.select if mode == 'jtag' else self.rdbuff
+            else:
+                value = self.rdbuff
+            return ACK_OK, value
+        if addr == 0x0:
+            self.abort(value)
+        elif addr == 0x4:
+            if mode == 'jtag':
+                # sticky bits are write one to clear over jtag
+                self.ctrl_stat &= ~(value & self.STICKY)
+            self.ctrl_stat = (self.ctrl_stat & self.STICKY) | (value & self.WRITABLE)
+        elif addr == 0x8:
+            self.select = value
+        return ACK_OK, 0
+
+class Tap:
+    IR_IDCODE = None
+    IR_BYPASS = None
+
+    def __init__(self, ir_len, idcode):
+        self.ir_len = ir_len
+        self.idcode = idcode
+        self.ir = 0
+        self.shift = 0
+        self.shift_len = 0
+        self.reset()
+
+    def reset(self):
+        self.ir = self.IR_IDCODE
+
+    def capture_ir(self):
+        # the two least significant bits always capture as 0b01
+        self.shift, self.shift_len = 0x1, self.ir_len
+
+    def update_ir(self):
+        self.ir = self.shift
+
+    def capture_dr(self):
+        if self.ir == self.IR_IDCODE:
+            self.shift, self.shift_len = self.idcode, 32
+        else:
+            self.shift, self.shift_len = 0, 1
+
+    def update_dr(self):
+        pass
+
+class BoundaryScanTap(Tap):
+    IR_IDCODE = 0b00001
+    IR_BYPASS = 0b11111
+
+    def __init__(self):
+        super().__init__(5, 0x06470041)
+
+class DebugTap(Tap):
+    IR_IDCODE = 0b1110
+    IR_BYPASS = 0b1111
+    IR_ABORT = 0b1000
+    IR_DPACC = 0b1010
+    IR_APACC = 0b1011
+
+    def __init__(self, dp):
+        self.dp = dp
+        self.result = 0
+        super().__init__(4, 0x4ba00477)
+
+    def capture_dr(self):
+        if self.ir in (self.IR_DPACC, self.IR_APACC, self.IR_ABORT):
+            # previous read result, with an OK/FAULT acknowledgement
+            self.shift, self.shift_len = (self.result << 3) | 0b010, 35
+        else:
+            super().capture_dr()
+
+    def update_dr(self):
+        rnw, addr, value = self.shift & 0x1, (self.shift & 0x6) << 1, self.shift >> 3
+        if self.ir == self.IR_ABORT:
+            self.dp.abort(value)
+        elif self.ir in (self.IR_DPACC, self.IR_APACC):
+            _, self.result = self.dp.access('jtag', self.ir == self.IR_APACC, rnw, addr, value)
+
+class Target:
+    # stm32l4r5zi memory map
+    FLASH = 0x08000000
+    FLASH_SIZE = 0x200000
+    SRAM = 0x20000000
+    SRAM_SIZE = 0xa0000
+    ROM_TABLE = 0xe00ff000
+
+    def __init__(self):
+        self.memory = Memory()
+        self.flash = self.memory.add(self.FLASH, self.FLASH_SIZE, writable=False, fill=0xff)
+        self.sram = self.memory.add(self.SRAM, self.SRAM_SIZE)
+        self.ppb = self.memory.add(0xe0000000, 0x100000)
+        self._rom_table()
+        self.core = Core(self.memory)
+        self.ap = MemAp(self.memory)
+        self.dp = DebugPort(self.ap)
+        # jtag chain, starting from the device closest to tdo
+        self.taps = [DebugTap(self.dp), BoundaryScanTap()]
+
+        # swj-dp starts out in jtag mode
+        self.mode = 'jtag'
+        self.tap_state = 'reset'
+        self.swj_ones = 0
+        self.swj_select = None
+        self.swd_reset()
+
+    def _rom_table(self):
+        # cortex-m4 rom table entries (scs, dwt, fpb, itm, tpiu, etm), then component id registers
+        entries = [0xfff0f003, 0xfff02003, 0xfff03003, 0xfff01003, 0xfff41003, 0xfff42003, 0x0]
+        base = self.ROM_TABLE - 0xe0000000
+        for num, entry in enumerate(entries):
+            self.ppb[base+4*num:base+4*num+4] = entry.to_bytes(4, 'little')
+        for num, cidr in enumerate([0x0d, 0x10, 0x05, 0xb1]):
+            self.ppb[base+0xff0+4*num] = cidr
+        # pidr0/pidr1 identifying the stm32l4 rom table
+        self.ppb[base+0xfe0] = 0x70
+        self.ppb[base+0xfe4] = 0x04
+
+    def reset(self):
+        # system reset from nRESET, the debug port is unaffected
+        self.core.reset()
+
+    def clock_swj(self, bit):
+        # watch swdio/tms for the jtag <-> swd select sequences, which start with a low bit
+        if self.swj_select is not None:
+            self.swj_select.append(bit)
+            if len(self.swj_select) == 16:
+                value = sum(b << n for n, b in enumerate(self.swj_select))
+                if value in (JTAG_TO_SWD, SWD_TO_JTAG):
+                    self.mode = 'swd' if value == JTAG_TO_SWD else 'jtag'
+                    self.tap_state = 'reset'
+                    for tap in self.taps:
+                        tap.reset()
+                    self.swd_reset()
+                self.swj_select = None
+        elif not bit and self.swj_ones >= 50:
+            self.swj_select = [bit]
+        self.swj_ones = self.swj_ones + 1 if bit else 0
+
+    def clock_jtag(self, tms, tdi=1):
+        # returns the value of tdo for this clock
+        tdo = 1
+        state = self.tap_state
+        if self.mode == 'jtag':
+            if state in ('capture-dr', 'capture-ir'):
+                for tap in self.taps:
+                    tap.capture_dr() if state == 'capture-dr' else tap.capture_ir()
+            elif state in ('shift-dr', 'shift-ir'):
+                tdo = self.taps[0].shift & 0x1
+                for num, tap in enumerate(self.taps):
+                    shift_in = self.taps[num+1].shift & 0x1 if num + 1 < len(self.taps) else tdi
+                    tap.shift = (tap.shift >> 1) | (shift_in << (tap.shift_len - 1))
+            state = TAP_STATES[state][tms]
+            if state == 'update-dr':
+                for tap in self.taps:
+                    tap.update_dr()
+            elif state == 'update-ir':
+                for tap in self.taps:
+                    tap.update_ir()
+            elif state == 'reset':
+                for tap in self.taps:
+                    tap.reset()
+            self.tap_state = state
+        self.clock_swj(tms)
+        return tdo
+
+    def swd_reset(self):
+        self.swd_state = 'reset'
+        self.swd_bits = []
+        self.swd_out = []
+
+    def clock_swd(self, bit=None):
+        # host drives the line with a bit, or samples the line with None, returns the line value
+        if self.mode != 'swd':
+            if bit is not None:
+                self.clock_swj(bit)
+            return 1 if bit is None else bit
+
+        if self.swd_out:
+            line = self.swd_out.pop(0)
+            if not self.swd_out and self.swd_state == 'write':
+                # turnaround back to the host before the write data
+                self.swd_bits = []
+            return line if bit is None else bit
+        line = 1 if bit is None else bit
+        if bit is not None:
+            self.clock_swj(bit)
+            if self.mode != 'swd':
+                return line
+        if self.swj_ones >= 50 and bit:
+            self.swd_state = 'reset'
+            return line
+
+        if self.swd_state == 'reset':
+            if bit == 0:
+                self.swd_state = 'idle'
+        elif self.swd_state == 'idle':
+            if bit == 1:
+                self.swd_state, self.swd_bits = 'request', [1]
+        elif self.swd_state == 'request':
+            self.swd_bits.append(line)
+            if len(self.swd_bits) == 8:
+                self._swd_request()
+        elif self.swd_state == 'write':
+            self.swd_bits.append(line)
+            if len(self.swd_bits) == 33:
+                value = sum(b << n for n, b in enumerate(self.swd_bits[:32]))
+                self.dp.access('swd', self.swd_request_bits[0], 0, self.swd_request_bits[2], value)
+                self.swd_state = 'idle'
+        return line
+
+    def _swd_request(self):
+        bits = self.swd_bits
+        apndp, rnw, addr = bits[1], bits[2], (bits[3] | (bits[4] << 1)) << 2
+        if bits[7] != 1 or bits[6] != 0 or _parity(bits[1] | bits[2] << 1 | bits[3] << 2 | bits[4] << 3) != bits[5]:
+            # protocol error, the target doesn't drive the line until the next line reset
+            self.swd_state = 'reset'
+            return
+        self.swd_request_bits = (apndp, rnw, addr)
+        if apndp and self.dp.ctrl_stat & (1 << 5):
+            ack, value = ACK_FAULT, 0
+        elif rnw:
+            # ap reads are posted, returning the result of the previous ap read
+            previous = self.dp.rdbuff
+            ack, value = self.dp.access('swd', apndp, 1, addr)
+            if apndp:
+                value = previous
+        else:
+            ack, value = ACK_OK, 0
+        # turnaround, acknowledgement
+        self.swd_out = [1] + [(ack >> n) & 0x1 for n in range(3)]
+        if ack != ACK_OK:
+            self.swd_state = 'idle'
+        elif rnw:
+            self.swd_out += [(value >> n) & 0x1 for n in range(32)] + [_parity(value)]
+            self.swd_state = 'idle'
+        else:
+            # turnaround back to the host
+            self.swd_out.append(1)
+            self.swd_state = 'write'
+
+class RttShell:
+    # stands in for the target firmware's zephyr shell on rtt, a SEGGER RTT control block in sram with
+    # one up and one down buffer, running the test commands from target/nucleo_l4r5zi
+    PROMPT = b'target:~$ '
+    CONTROL_BLOCK = 0x20001000
+    VAR = 0x20000ff0
+    FN = 0x08001235
+
+    def __init__(self, memory, up_size=2048, down_size=128):
+        self.memory = memory
+        name = self.CONTROL_BLOCK + 0x80
+        self.up = self.CONTROL_BLOCK + 24
+        self.down = self.up + 24
+        up_buffer = self.CONTROL_BLOCK + 0x100
+        down_buffer = up_buffer + up_size
+        memory.write_bytes(name, b'Terminal\x00')
+        for desc, buffer, size in [(self.up, up_buffer, up_size), (self.down, down_buffer, down_size)]:
+            for num, value in enumerate([name, buffer, size, 0, 0, 0]):
+                memory.write(desc + 4 * num, 4, value)
+        memory.write(self.VAR, 4, 0)
+        # the id is written last, so the host never finds a partially initialized control block
+        memory.write(self.CONTROL_BLOCK + 16, 4, 1)
+        memory.write(self.CONTROL_BLOCK + 20, 4, 1)
+        memory.write_bytes(self.CONTROL_BLOCK, b'SEGGER RTT'.ljust(16, b'\x00'))
+
+        self.line = b''
+        # output waiting for room in the up buffer, the shell blocks rather than trimming its output
+        self.output = bytearray()
+        self.thread = None
+        self.running = False
+
+    def start(self, interval=0.0002):
+        self.running = True
+        def run():
+            while self.running:
+                self.step()
+                time.sleep(interval)
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        self.thread.join()
+
+    def step(self):
+        for byte in self._read_down():
+            if byte == ord('\r'):
+                continue
+            if byte != ord('\n'):
+                self.line += bytes([byte])
+                continue
+            self.output += self.line + b'\r\n' + self.execute(self.line.split()) + self.PROMPT
+            self.line = b''
+        self._write_up()
+
+    def execute(self, argv):
+        if not argv:
+            return b''
+        if argv[:2] == [b'test', b'dump']:
+            return b''.join(
+                b' '.join(b'0x%08x' % n for n in range(i, i + 8)) + b'\r\n' for i in range(0, 400, 8)
+            )
+        if argv[:2] == [b'test', b'var']:
+            value = self.memory.read(self.VAR, 4)
+            value -= (value & 0x80000000) << 1
+            return b"int 'var' address: 0x%08x\r\nint 'var' value: %d\r\n" % (self.VAR, value)
+        if argv[:2] == [b'test', b'setvar'] and len(argv) == 3:
+            self.memory.write(self.VAR, 4, int(argv[2], 0) & 0xffffffff)
+            return b"new 'var' value: %d\r\n" % int(argv[2], 0)
+        if argv[:2] == [b'test', b'fn']:
+            return b'fn address: 0x%08x\r\n' % self.FN
+        return b'%b: command not found\r\n' % argv[0]
+
+    def _buffer(self, desc):
+        return [self.memory.read(desc + 4 * num, 4) for num in range(1, 5)]
+
+    def _read_down(self):
+        buffer, size, write, read = self._buffer(self.down)
+        data = b''
+        while read != write:
+            data += bytes([self.memory.read(buffer + read, 1)])
+            read = (read + 1) % size
+        self.memory.write(self.down + 16, 4, read)
+        return data
+
+    def _write_up(self):
+        buffer, size, write, read = self._buffer(self.up)
+        room = (read - write - 1) % size
+        count = min(room, len(self.output), size - write)
+        if count == 0:
+            return
+        # data first, then the write offset, so the host never reads stale data
+        self.memory.write_bytes(buffer + write, bytes(self.output[:count]))
+        self.memory.write(self.up + 12, 4, (write + count) % size)
+        del self.output[:count]
+
+class SimProbe:
+    # pins as reported by DAP_SWJ_Pins
+    PIN_TCK = 0x01
+    PIN_TMS = 0x02
+    PIN_TDI = 0x04
+    PIN_TDO = 0x08
+    PIN_NRESET = 0x80
+    # pins driven by the probe in each port mode
+    DRIVEN = {None: 0x00, 'jtag': 0x87, 'swd': 0x83}
+
+    def __init__(
+        self, vid=0xfffe, pid=0xffd1, serial='RPB1-23000000001', packet_count=1, packet_size=512,
+        packet_latency=0.0, transfer_latency=0.0, clocked=False, max_clock=None
+    ):
+        self.vid = vid
+        self.pid = pid
+        self.serial = serial
+        self.packet_count = packet_count
+        self.packet_size = packet_size
+        # latency model: usb round trip per packet (which overlaps with other packets in flight), then
+        # probe time per dap transfer, and optionally the time to clock each bit at the swj clock rate
+        self.packet_latency = packet_latency
+        self.transfer_latency = transfer_latency
+        self.clocked = clocked
+        # fastest swj clock the wiring to the target handles, transfers and idcode reads are
+        # corrupted above it
+        self.max_clock = max_clock
+
+        self.target = Target()
+        self.lock = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.port = None
+            self.pins = 0xff
+            self.clock = 1000000
+            self.jtag_ir_lengths = []
+            self.idle_cycles = 0
+            self.wait_retry = 100
+            self.match_retry = 0
+            self.match_mask = 0
+            # usb packets waiting to be read by the host as (ready time, data), per in endpoint
+            self.responses = {0x81: collections.deque(), 0x82: collections.deque(), 0x84: collections.deque()}
+            self.queued = []
+            # time taken by the command being processed, and when the probe finishes its current work
+            self.elapsed = 0.0
+            self.busy = 0.0
+            self.lock.notify_all()
+
+    # usb descriptors
+
+    def strings(self):
+        return [None, MANUFACTURER, PRODUCT, self.serial, DAP_INTERFACE, IO_INTERFACE, 'Rice VCP']
+
+    def device_descriptor(self):
+        return types.SimpleNamespace(
+            bLength=18, bDescriptorType=0x01, bcdUSB=0x0200,
+            bDeviceClass=0xef, bDeviceSubClass=0x02, bDeviceProtocol=0x01, bMaxPacketSize0=64,
+            idVendor=self.vid, idProduct=self.pid, bcdDevice=0x0100,
+            iManufacturer=1, iProduct=2, iSerialNumber=3, bNumConfigurations=1,
+            address=1, bus=1, port_number=1, port_numbers=(1,), speed=usb.util.SPEED_HIGH
+        )
+
+    def configuration_descriptor(self):
+        return types.SimpleNamespace(
+            bLength=9, bDescriptorType=0x02, wTotalLength=0, bNumInterfaces=4, bConfigurationValue=1,
+            iConfiguration=0, bmAttributes=0x80, bMaxPower=50, extra_descriptors=[]
+        )
+
+    def interfaces(self):
+        # (class, subclass, string index, endpoints as (address, attributes))
+        return [
+            (0xff, 0x00, 4, [(0x01, 0x02), (0x81, 0x02)]),
+            (0xff, 0x00, 5, [(0x02, 0x02), (0x82, 0x02)]),
+            (0x02, 0x02, 6, [(0x83, 0x03)]),
+            (0x0a, 0x02, 0, [(0x04, 0x02), (0x84, 0x02)]),
+        ]
+
+    def interface_descriptor(self, intf):
+        cls, subcls, string, endpoints = self.interfaces()[intf]
+        return types.SimpleNamespace(
+            bLength=9, bDescriptorType=0x04, bInterfaceNumber=intf, bAlternateSetting=0,
+            bNumEndpoints=len(endpoints), bInterfaceClass=cls, bInterfaceSubClass=subcls,
+            bInterfaceProtocol=0x00, iInterface=string, extra_descriptors=[]
+        )
+
+    def endpoint_descriptor(self, intf, ep):
+        address, attributes = self.interfaces()[intf][3][ep]
+        return types.SimpleNamespace(
+            bLength=7, bDescriptorType=0x05, bEndpointAddress=address, bmAttributes=attributes,
+            wMaxPacketSize=self.packet_size if attributes == 0x02 else 16, bInterval=0 if attributes == 0x02 else 16,
+            bRefresh=0, bSynchAddress=0, extra_descriptors=[]
+        )
+
+    def string_descriptor(self, index):
+        if index == 0:
+            # english (united states) only
+            return b'\x04\x03\x09\x04'
+        data = self.strings()[index].encode('utf-16-le')
+        return bytes([len(data) + 2, 0x03]) + data
+
+    # usb endpoints
+
+    def write(self, ep, data, timeout):
+        with self.lock:
+            if ep == 0x01:
+                # the probe can only buffer a limited number of packets before the host must read responses
+                deadline = time.monotonic() + timeout / 1000 if timeout else None
+                while len(self.responses[0x81]) + len(self.queued) >= self.packet_count:
+                    remaining = None if deadline is None else deadline - time.monotonic()
+                    if remaining is not None and remaining <= 0:
+                        raise usb.core.USBTimeoutError('Operation timed out', -7, 110)
+                    self.lock.wait(remaining)
+                self.process(bytes(data))
+            elif ep == 0x02:
+                # rice i/o interface loops data back
+                self.responses[0x82].append((time.monotonic(), bytes(data)))
+            self.lock.notify_all()
+        return len(data)
+
+    def read(self, ep, size, timeout):
+        with self.lock:
+            deadline = time.monotonic() + timeout / 1000 if timeout else None
+            while True:
+                now = time.monotonic()
+                queue = self.responses[ep]
+                if queue and queue[0][0] <= now:
+                    break
+                if deadline is not None and deadline <= now:
+                    raise usb.core.USBTimeoutError('Operation timed out', -7, 110)
+                # wait for a response to arrive, or for the probe to finish processing it
+                wakeups = [t for t in (deadline, queue[0][0] if queue else None) if t is not None]
+                self.lock.wait(min(wakeups) - now if wakeups else None)
+            _, data = self.responses[ep].popleft()
+            self.lock.notify_all()
+        return data[:size]
+
+    # cmsis-dap command processing
+
+    def process(self, request):
+        # responses become readable once the probe has spent the modelled time on them, which
+        # lets the host keep working in the meantime just like with real hardware
+        if request[:1] == b'\x07':
+            # transfer abort has an empty response
+            self.responses[0x81].append((time.monotonic(), b''))
+        elif request[:1] == bytes([QUEUE_COMMANDS]):
+            self.queued.append(request)
+        else:
+            for packet in self.queued + [request]:
+                self.elapsed = 0.0
+                response = self.execute(packet)
+                self.busy = max(self.busy, time.monotonic()) + self.elapsed
+                self.responses[0x81].append((self.busy + self.packet_latency, response))
+            self.queued = []
+
+    def execute(self, request):
+        if request[:1] in (bytes([QUEUE_COMMANDS]), bytes([EXECUTE_COMMANDS])):
+            if len(request) < 2:
+                return b'\xff'
+            response, idx = bytearray([EXECUTE_COMMANDS, request[1]]), 2
+            for _ in range(request[1]):
+                data, length = self.command(request[idx:])
+                response += data
+                idx += length
+            return bytes(response)
+        return self.command(request)[0]
+
+    @staticmethod
+    def _require(request, length):
+        if len(request) < length:
+            raise IndexError('incomplete request')
+
+    def command(self, request):
+        # returns the response and the length of the request consumed
+        handler = self.COMMANDS.get(request[0]) if request else None
+        if handler is None:
+            return b'\xff', 1
+        try:
+            response, length = handler(self, request)
+        except IndexError:
+            # incomplete request
+            return b'\xff', len(request)
+        if length > len(request):
+            return b'\xff', len(request)
+        return response, length
+
+    def cmd_info(self, request):
+        info = request[1]
+        strings = {
+            0x01: MANUFACTURER, 0x02: PRODUCT, 0x03: self.serial, 0x04: PROTOCOL_VERSION,
+            0x05: '', 0x06: '', 0x07: '', 0x08: '', 0x09: FIRMWARE_VERSION
+        }
+        if info in strings:
+            data = strings[info].encode('ascii') + b'\x00' if strings[info] else b''
+        elif info == 0xf0:
+            data = b'\x02'
+        elif info == 0xf1:
+            # the firmware reports the unused test domain timer with a length of 8, but only 4 bytes
+            return b'\x00\x08\x00\x00\x00\x00', 2
+        elif info in (0xfb, 0xfc):
+            data = (1024).to_bytes(4, 'little')
+        elif info == 0xfd:
+            data = b'\x00\x00\x00\x00'
+        elif info == 0xfe:
+            data = bytes([self.packet_count])
+        elif info == 0xff:
+            data = self.packet_size.to_bytes(2, 'little')
+        else:
+            return b'\xff', 2
+        return b'\x00' + bytes([len(data)]) + data, 2
+
+    def cmd_host_status(self, request):
+        self._require(request, 3)
+        status = 0x00 if request[1] in (0, 1) and request[2] in (0, 1) else 0xff
+        return bytes([0x01, status]), 3
+
+    def cmd_connect(self, request):
+        port = {0: 'jtag', 1: 'swd', 2: 'jtag'}.get(request[1])
+        self.port = port
+        self.pins = 0xff
+        return bytes([0x02, {None: 0, 'swd': 1, 'jtag': 2}[port]]), 2
+
+    def cmd_disconnect(self, request):
+        self.port = None
+        return b'\x03\x00', 1
+
+    def cmd_transfer_configure(self, request):
+        self._require(request, 6)
+        self.idle_cycles = request[1]
+        self.wait_retry = int.from_bytes(request[2:4], 'little')
+        self.match_retry = int.from_bytes(request[4:6], 'little')
+        return b'\x04\x00', 6
+
+    def _transfer_ready(self, index):
+        if self.port == 'swd':
+            return self.target.mode == 'swd'
+        if self.port == 'jtag':
+            return index < len(self.jtag_ir_lengths) and self.target.mode == 'jtag'
+        return False
+
+    def _unstable(self):
+        return self.max_clock is not None and self.clock > self.max_clock
+
+    def _transfer(self, apndp, rnw, addr, value=0):
+        self.elapsed += self.transfer_latency
+        if self.clocked:
+            self.elapsed += 46 / self.clock
+        if self._unstable():
+            return ACK_NONE, 0
+        if self.port == 'jtag':
+            # transfers leave the debug tap selected for dp/ap access, and the tap in idle
+            self.target.taps[0].ir = DebugTap.IR_APACC if apndp else DebugTap.IR_DPACC
+            self.target.tap_state = 'idle'
+        for _ in range(self.wait_retry + 1):
+            ack, data = self.target.dp.access(self.port, apndp, rnw, addr, value)
+            if ack != ACK_WAIT:
+                break
+        return ack, data
+
+    def cmd_transfer(self, request):
+        index, count, idx = request[1], request[2], 3
+        ready = self._transfer_ready(index)
+        response, done, status = bytearray(), 0, ACK_OK
+        for _ in range(count):
+            xfer = request[idx]
+            idx += 1
+            apndp, rnw, addr = xfer & 0x1, (xfer >> 1) & 0x1, xfer & 0xc
+            value = None
+            if not rnw or xfer & 0x30:
+                self._require(request, idx + 4)
+                value = int.from_bytes(request[idx:idx+4], 'little')
+                idx += 4
+            if not ready or status != ACK_OK:
+                # remaining transfers are skipped after an error
+                continue
+            if xfer & 0x20:
+                self.match_mask = value
+            elif rnw and xfer & 0x10:
+                for _ in range(self.match_retry + 1):
+                    status, data = self._transfer(apndp, 1, addr)
+                    if status != ACK_OK or data & self.match_mask == value:
+                        break
+                else:
+                    status |= VALUE_MISMATCH
+            elif rnw:
+                status, data = self._transfer(apndp, 1, addr)
+                if status == ACK_OK:
+                    response += data.to_bytes(4, 'little')
+            else:
+                status, _ = self._transfer(apndp, 0, addr, value)
+            if status == ACK_OK:
+                if xfer & 0x80:
+                    # the test domain timer is unused, so timestamps are always zero
+                    response += b'\x00\x00\x00\x00'
+                done += 1
+        # nothing is attempted when the port isn't ready for transfers
+        status = status if ready else 0
+        return bytes([0x05, done, status]) + response, idx
+
+    def cmd_transfer_block(self, request):
+        index, count, xfer = request[1], int.from_bytes(request[2:4], 'little'), request[4]
+        apndp, rnw, addr = xfer & 0x1, (xfer >> 1) & 0x1, xfer & 0xc
+        length = 5 if rnw else 5 + 4 * count
+        self._require(request, length)
+        if not self._transfer_ready(index):
+            return b'\x06\x00\x00\x00', length
+        response, done, status = bytearray(), 0, ACK_OK
+        for num in range(count):
+            if rnw:
+                status, data = self._transfer(apndp, 1, addr)
+            else:
+                value = int.from_bytes(request[5+4*num:9+4*num], 'little')
+                status, data = self._transfer(apndp, 0, addr, value)
+            if status != ACK_OK:
+                break
+            if rnw:
+                response += data.to_bytes(4, 'little')
+            done += 1
+        return b'\x06' + done.to_bytes(2, 'little') + bytes([status]) + response, length
+
+    def cmd_write_abort(self, request):
+        self._require(request, 6)
+        value = int.from_bytes(request[2:6], 'little')
+        if self._transfer_ready(request[1]):
+            self.target.dp.abort(value)
+        return b'\x08\x00', 6
+
+    def cmd_delay(self, request):
+        self._require(request, 3)
+        delay = int.from_bytes(request[1:3], 'little')
+        self.elapsed += delay / 1000000
+        return b'\x09\x00', 3
+
+    def cmd_reset_target(self, request):
+        return b'\x0a\x00\x00', 1
+
+    def cmd_swj_pins(self, request):
+        self._require(request, 7)
+        output, select = request[1], request[2]
+        driven = self.DRIVEN[self.port] & select
+        previous = self.pins
+        self.pins = (self.pins & ~driven) | (output & driven)
+        if not previous & self.PIN_NRESET and self.pins & self.PIN_NRESET:
+            self.target.reset()
+        return bytes([0x10, self.read_pins()]), 7
+
+    def read_pins(self):
+        driven = self.DRIVEN[self.port]
+        # undriven pins are pulled up, other than tck which is pulled down
+        pins = (self.pins & driven) | (~driven & (self.PIN_TMS | self.PIN_TDI | self.PIN_NRESET))
+        return pins | self.PIN_TDO
+
+    def cmd_swj_clock(self, request):
+        self._require(request, 5)
+        clock = int.from_bytes(request[1:5], 'little')
+        if clock == 0:
+            return b'\x11\xff', 5
+        self.clock = clock
+        return b'\x11\x00', 5
+
+    def cmd_swj_sequence(self, request):
+        count = request[1] if request[1] else 256
+        length = 2 + (count + 7) // 8
+        self._require(request, length)
+        data = request[2:length]
+        self._elapse_bits(count)
+        for num in range(count):
+            bit = (data[num // 8] >> (num % 8)) & 0x1
+            if self.target.mode == 'swd':
+                self.target.clock_swd(bit)
+            else:
+                self.target.clock_jtag(bit)
+        return b'\x12\x00', length
+
+    def cmd_swd_configure(self, request):
+        self._require(request, 2)
+        return b'\x13\x00', 2
+
+    def cmd_jtag_sequence(self, request):
+        count, idx = request[1], 2
+        sequences = []
+        for _ in range(count):
+            info = request[idx]
+            bits = info & 0x3f if info & 0x3f else 64
+            nbytes = (bits + 7) // 8
+            sequences.append((info, bits, request[idx+1:idx+1+nbytes]))
+            idx += 1 + nbytes
+        self._require(request, idx)
+        if self.port != 'jtag':
+            return b'\x14\xff', idx
+        response = bytearray()
+        for info, bits, data in sequences:
+            self._elapse_bits(bits)
+            tdo = 0
+            for num in range(bits):
+                tdo |= self.target.clock_jtag((info >> 6) & 0x1, (data[num // 8] >> (num % 8)) & 0x1) << num
+            if info & 0x80:
+                response += tdo.to_bytes((bits + 7) // 8, 'little')
+        return b'\x14\x00' + bytes(response), idx
+
+    def cmd_jtag_configure(self, request):
+        count = request[1]
+        self._require(request, 2 + count)
+        lengths = request[2:2+count]
+        if count > 4:
+            return b'\x15\xff', 2 + count
+        self.jtag_ir_lengths = list(lengths)
+        return b'\x15\x00', 2 + count
+
+    def cmd_jtag_idcode(self, request):
+        index = request[1]
+        if self.port != 'jtag' or index >= len(self.jtag_ir_lengths) or self.target.mode != 'jtag':
+            return b'\x16\xff\x00\x00\x00\x00', 2
+        # selects the idcode instruction on the addressed device, and bypass on all others
+        for num, tap in enumerate(self.target.taps):
+            tap.ir = tap.IR_IDCODE if num == index else tap.IR_BYPASS
+        self.target.tap_state = 'idle'
+        idcode = self.target.taps[index].idcode
+        if self._unstable():
+            idcode = (idcode << 1) & 0xffffffff
+        return b'\x16\x00' + idcode.to_bytes(4, 'little'), 2
+
+    def cmd_swd_sequence(self, request):
+        count, idx = request[1], 2
+        sequences = []
+        for _ in range(count):
+            info = request[idx]
+            bits = info & 0x3f if info & 0x3f else 64
+            nbytes = 0 if info & 0x80 else (bits + 7) // 8
+            sequences.append((info, bits, request[idx+1:idx+1+nbytes]))
+            idx += 1 + nbytes
+        self._require(request, idx)
+        if self.port != 'swd':
+            # errors still respond with space for all of the input data
+            size = sum((bits + 7) // 8 for info, bits, _ in sequences if info & 0x80)
+            return b'\x1d\xff' + bytes(size), idx
+        response = bytearray()
+        for info, bits, data in sequences:
+            self._elapse_bits(bits)
+            value = 0
+            for num in range(bits):
+                if info & 0x80:
+                    value |= self.target.clock_swd() << num
+                else:
+                    self.target.clock_swd((data[num // 8] >> (num % 8)) & 0x1)
+            if info & 0x80:
+                response += value.to_bytes((bits + 7) // 8, 'little')
+        return b'\x1d\x00' + bytes(response), idx
+
+    def _elapse_bits(self, bits):
+        if self.clocked:
+            self.elapsed += bits / self.clock
+
+    COMMANDS = {
+        0x00: cmd_info,
+        0x01: cmd_host_status,
+        0x02: cmd_connect,
+        0x03: cmd_disconnect,
+        0x04: cmd_transfer_configure,
+        0x05: cmd_transfer,
+        0x06: cmd_transfer_block,
+        0x08: cmd_write_abort,
+        0x09: cmd_delay,
+        0x0a: cmd_reset_target,
+        0x10: cmd_swj_pins,
+        0x11: cmd_swj_clock,
+        0x12: cmd_swj_sequence,
+        0x13: cmd_swd_configure,
+        0x14: cmd_jtag_sequence,
+        0x15: cmd_jtag_configure,
+        0x16: cmd_jtag_idcode,
+        0x1d: cmd_swd_sequence,
+    }
+
+class SimBackend(usb.backend.IBackend):
+    # pyusb backend exposing simulated probes, pass to usb.core.find(backend=...)
+    def __init__(self, probes=None):
+        super().__init__()
+        self.probes = probes if probes is not None else [SimProbe()]
+
+    def enumerate_devices(self):
+        return iter(self.probes)
+
+    def get_device_descriptor(self, dev):
+        return dev.device_descriptor()
+
+    def get_configuration_descriptor(self, dev, config):
+        if config != 0:
+            raise IndexError('Invalid configuration index')
+        return dev.configuration_descriptor()
+
+    def get_interface_descriptor(self, dev, intf, alt, config):
+        if alt != 0 or intf >= len(dev.interfaces()):
+            raise IndexError('Invalid interface index')
+        return dev.interface_descriptor(intf)
+
+    def get_endpoint_descriptor(self, dev, ep, intf, alt, config):
+        return dev.endpoint_descriptor(intf, ep)
+
+    def open_device(self, dev):
+        return dev
+
+    def close_device(self, dev_handle):
+        pass
+
+    def set_configuration(self, dev_handle, config_value):
+        pass
+
+    def get_configuration(self, dev_handle):
+        return 1
+
+    def set_interface_altsetting(self, dev_handle, intf, altsetting):
+        pass
+
+    def claim_interface(self, dev_handle, intf):
+        pass
+
+    def release_interface(self, dev_handle, intf):
+        pass
+
+    def bulk_write(self, dev_handle, ep, intf, data, timeout):
+        return dev_handle.write(ep, data, timeout)
+
+    def bulk_read(self, dev_handle, ep, intf, buff, timeout):
+        data = dev_handle.read(ep, len(buff) * buff.itemsize, timeout)
+        buff[:len(data)] = array.array('B', data)
+        return len(data)
+
+    def intr_read(self, dev_handle, ep, intf, buff, timeout):
+        return self.bulk_read(dev_handle, ep, intf, buff, timeout)
+
+    def ctrl_transfer(self, dev_handle, bmRequestType, bRequest, wValue, wIndex, data, timeout):
+        # only standard GET_DESCRIPTOR requests for strings are supported
+        if bmRequestType == 0x80 and bRequest == 0x06 and wValue >> 8 == usb.util.DESC_TYPE_STRING:
+            desc = dev_handle.string_descriptor(wValue & 0xff)[:len(data)]
+            data[:len(desc)] = array.array('B', desc)
+            return len(desc)
+        raise usb.core.USBError('Pipe error', -9, 32)
+
+    def clear_halt(self, dev_handle, ep):
+        pass
+
+    def reset_device(self, dev_handle):
+        dev_handle.reset()
+
+    def is_kernel_driver_active(self, dev_handle, intf):
+        return False
+
+    def detach_kernel_driver(self, dev_handle, intf):
+        pass
+
+    def attach_kernel_driver(self, dev_handle, intf):
+        pass
@@ -0,0 +1,165 @@
+import bisect
+import collections
+import hashlib
+import json
+import mmap
+import os
+import struct
+
+# the image west builds from target/nucleo_l4r5zi
+TARGET_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'target', 'nucleo_l4r5zi')
+TARGET_ELF = os.path.join(TARGET_DIR, 'build', 'zephyr', 'zephyr.elf')
+SYMBOL_CACHE = os.path.join(os.path.expanduser('~'), '.cache', 'riceprobe', 'symbols')
+# bump when the cached index format changes
+CACHE_VERSION = 1
+
+EM_ARM = 40
+SHT_SYMTAB = 2
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_SECTION = 3
+STT_FILE = 4
+STB_LOCAL = 0
+SHN_UNDEF = 0
+# elf header after e_ident, section header and symbol layouts, for 32 and 64-bit files
+ELF_HEADER = {1: 'HHIIIIIHHHHHH', 2: 'HHIQQQIHHHHHH'}
+SECTION_HEADER = {1: 'IIIIIIIIII', 2: 'IIQQQQIIQQ'}
+SYMBOL = {1: 'IIIBBH', 2: 'IBBHQQ'}
+
+Symbol = collections.namedtuple('Symbol', ['name', 'address', 'size', 'type', 'local'])
+
+def file_hash(path):
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        return hashlib.sha256(data).hexdigest()
+
+def read_symbols(path):
+    # the named, defined symbols of an elf file, reading only the header, the section headers and the
+    # .symtab and .strtab sections, arm function addresses have the thumb bit cleared
+    with open(path, 'rb') as file, mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        if data[:4] != b'\x7fELF' or data[4] not in (1, 2) or data[5] not in (1, 2):
+            raise ValueError(f'{path} is not an elf file')
+        bits, order = data[4], '<' if data[5] == 1 else '>'
+        header = struct.unpack_from(order + ELF_HEADER[bits], data, 16)
+        machine, shoff, shentsize, shnum = header[1], header[5], header[10], header[11]
+        section = struct.Struct(order + SECTION_HEADER[bits])
+        sections = [section.unpack_from(data, shoff + num * shentsize) for num in range(shnum)]
+        symtab = next((s for s in sections if s[1] == SHT_SYMTAB), None)
+        if symtab is None:
+            raise ValueError(f'{path} has no symbol table, it may be stripped')
+        # name, type, flags, addr, offset, size, link, ...
+        _, _, _, _, offset, size, link = symtab[:7]
+        strtab = sections[link]
+        strings = data[strtab[4]:strtab[4]+strtab[5]]
+        entry = struct.Struct(order + SYMBOL[bits])
+        symbols = []
+        for fields in entry.iter_unpack(data[offset:offset+size]):
+            if bits == 1:
+                name, value, length, info, _, shndx = fields
+            else:
+                name, info, _, shndx, value, length = fields
+            kind = info & 0xf
+            if name == 0 or shndx == SHN_UNDEF or kind in (STT_SECTION, STT_FILE):
+                continue
+            name = strings[name:strings.index(b'\x00', name)].decode(errors='replace')
+            # arm mapping symbols ($t, $d, $a) only mark code and data
+            if name.startswith('$'):
+                continue
+            if machine == EM_ARM and kind == STT_FUNC:
+                value &= ~0x1
+            symbols.append(Symbol(name, value, length, kind, info >> 4 == STB_LOCAL))
+        return symbols
+
+def _intervals(sized):
+    # sweeps the symbols in start order, keeping a stack of those still open, the innermost on top,
+    # which owns everything from the last boundary up to the next start or end
+    starts, ends, owners = [], [], []
+    stack = []
+    pos = 0
+    def cover(end):
+        nonlocal pos
+        if stack and end > pos:
+            starts.append(pos)
+            ends.append(end)
+            owners.append(stack[-1])
+        pos = max(pos, end)
+    for symbol in sized:
+        while stack and stack[-1].address + stack[-1].size <= symbol.address:
+            cover(stack[-1].address + stack[-1].size)
+            stack.pop()
+        cover(symbol.address)
+        stack.append(symbol)
+    while stack:
+        cover(stack[-1].address + stack[-1].size)
+        stack.pop()
+    return starts, ends, owners
+
+class SymbolIndex:
+    # name to symbol and address to symbol lookups for an elf image, built on first use and cached
+    # in cache (None to disable) by the file's hash, where a name is used more than once the global
+    # symbol wins, then the first one
+    def __init__(self, path=TARGET_ELF, cache=SYMBOL_CACHE):
+        self.path = path
+        self.cache = cache
+        self.names = None
+        # the address space covered by sized symbols, as sorted, non-overlapping [start, end) intervals
+        # and the innermost symbol covering each, a symbol nested in another splits it in two
+        self.starts = None
+        self.ends = None
+        self.intervals = None
+
+    def __getitem__(self, name):
+        return self._index()[name]
+
+    def __contains__(self, name):
+        return name in self._index()
+
+    def address(self, name):
+        return self[name].address
+
+    def lookup(self, addr):
+        # (symbol, offset) of the symbol containing addr, None when there isn't one
+        self._index()
+        idx = bisect.bisect_right(self.starts, addr) - 1
+        if idx < 0 or addr >= self.ends[idx]:
+            return None
+        symbol = self.intervals[idx]
+        return symbol, addr - symbol.address
+
+    def symbolize(self, addr):
+        # name+offset for an address such as a halted pc, or the hex address
+        found = self.lookup(addr)
+        if found is None:
+            return f'0x{addr:08x}'
+        symbol, offset = found
+        return f'{symbol.name}+0x{offset:x}' if offset else symbol.name
+
+    def _index(self):
+        if self.names is None:
+            symbols = self._load()
+            names = {}
+            for symbol in symbols:
+                if symbol.name not in names or (names[symbol.name].local and not symbol.local):
+                    names[symbol.name] = symbol
+            # for the same start the smallest symbol comes last, and so is the innermost
+            sized = sorted((s for s in symbols if s.size), key=lambda s: (s.address, -s.size))
+            self.starts, self.ends, self.intervals = _intervals(sized)
+            self.names = names
+        return self.names
+
+    def _load(self):
+        if self.cache is None:
+            return read_symbols(self.path)
+        cache = os.path.join(self.cache, f'{file_hash(self.path)}.json')
+        try:
+            with open(cache) as file:
+                cached = json.load(file)
+            if cached['version'] == CACHE_VERSION:
+                return [Symbol(*symbol) for symbol in cached['symbols']]
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        symbols = read_symbols(self.path)
+        os.makedirs(self.cache, exist_ok=True)
+        with open(cache + '.tmp', 'w') as file:
+            json.dump({'version': CACHE_VERSION, 'symbols': symbols}, file)
+        os.replace(cache + '.tmp', cache)
+        return symbols
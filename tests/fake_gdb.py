@@ -0,0 +1,118 @@
+import socket
+import threading
+
+from gdbrsp import checksum, unescape
+
+class FakeGdbStub:
+    # gdb remote serial protocol stub with a block of memory and 17 32-bit registers (r0-r15 and
+    # xpsr, pc is 15), continuing with a breakpoint set stops at the first one, packets records the
+    # packets received and acks the acks received
+    def __init__(self, base=0x20000000, size=0x40000, packet_size=0x3fff, no_ack=True):
+        self.base = base
+        self.memory = bytearray(size)
+        self.registers = [0] * 17
+        self.packet_size = packet_size
+        self.no_ack = no_ack
+        self.breakpoints = set()
+        self.packets = []
+        self.acks = 0
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(1)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        buffer = bytearray()
+        ack = True
+        while True:
+            data = conn.recv(65536)
+            if not data:
+                break
+            buffer += data
+            while buffer:
+                if buffer[:1] in (b'+', b'-'):
+                    self.acks += 1
+                    del buffer[:1]
+                    continue
+                if buffer[:1] == b'\x03':
+                    del buffer[:1]
+                    self.send(conn, b'T02', ack)
+                    continue
+                end = buffer.find(b'#')
+                if buffer[:1] != b'$' or end < 0 or len(buffer) < end + 3:
+                    break
+                packet = bytes(buffer[1:end])
+                assert(bytes(buffer[end+1:end+3]) == checksum(packet))
+                assert(end + 3 <= self.packet_size)
+                del buffer[:end+3]
+                if ack:
+                    conn.sendall(b'+')
+                self.packets.append(packet)
+                reply = self.evaluate(packet)
+                if reply is not None:
+                    self.send(conn, reply, ack)
+                if packet == b'QStartNoAckMode':
+                    ack = False
+        conn.close()
+
+    def send(self, conn, reply, ack):
+        conn.sendall(b'$' + reply + b'#' + checksum(reply))
+
+    def _range(self, addr, length):
+        start = addr - self.base
+        return start if 0 <= start and start + length <= len(self.memory) else None
+
+    def evaluate(self, packet):
+        kind, body = packet[:1], packet[1:]
+        if packet.startswith(b'qSupported'):
+            features = b'PacketSize=%x;swbreak+;hwbreak+' % self.packet_size
+            return features + (b';QStartNoAckMode+' if self.no_ack else b'')
+        if packet == b'QStartNoAckMode':
+            return b'OK'
+        if packet == b'?':
+            return b'S05'
+        if kind == b'm':
+            addr, length = (int(v, 16) for v in body.split(b','))
+            start = self._range(addr, length)
+            return b'E01' if start is None else self.memory[start:start+length].hex().encode()
+        if kind == b'X':
+            header, _, data = body.partition(b':')
+            addr, length = (int(v, 16) for v in header.split(b','))
+            data = unescape(data)
+            start = self._range(addr, length)
+            if start is None or len(data) != length:
+                return b'E01'
+            self.memory[start:start+length] = data
+            return b'OK'
+        if kind == b'g':
+            return b''.join(r.to_bytes(4, 'little').hex().encode() for r in self.registers)
+        if kind == b'p':
+            num = int(body, 16)
+            return self.registers[num].to_bytes(4, 'little').hex().encode() if num < 17 else b'E00'
+        if kind == b'P':
+            num, value = body.split(b'=')
+            self.registers[int(num, 16)] = int.from_bytes(bytes.fromhex(value.decode()), 'little')
+            return b'OK'
+        if kind in (b'Z', b'z'):
+            type, addr, _ = (int(v, 16) for v in body.split(b','))
+            if kind == b'Z':
+                self.breakpoints.add((type, addr))
+            else:
+                self.breakpoints.discard((type, addr))
+            return b'OK'
+        if kind == b'c':
+            # running until the first breakpoint, or until interrupted
+            if not self.breakpoints:
+                return None
+            self.registers[15] = min(addr for _, addr in self.breakpoints)
+            return b'T05hwbreak:;'
+        if kind == b'D':
+            return b'OK'
+        return b''
@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+TERM = b'\x1a'
+# how send_many wraps each command
+CATCH = re.compile(rb'^format "%d %s" \[catch \{(.*)\} (\w+)\] \$\2$')
+# time taken to run the config commands before the tcl port opens
+STARTUP_DELAY = 0.2
+
+class FakeTclServer:
+    # answers each terminated command with responses[command], sent in small pieces, unknown
+    # commands get default, or are errors if default is None, as are commands whose evaluate raises
+    # ValueError, connections that turn on tcl notifications are sent each event passed to notify,
+    # commands starting with a key of delays are answered that many seconds late
+    def __init__(self, responses, piece=997, port=0, default=None, delays=None):
+        self.responses = responses
+        self.delays = delays if delays is not None else {}
+        self.piece = piece
+        self.default = default
+        self.commands = []
+        self.listeners = []
+        self.lock = threading.Lock()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(4)
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def serve(self):
+        while True:
+            conn, _ = self.sock.accept()
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+    def handle(self, conn):
+        buffer = b''
+        while True:
+            try:
+                data = conn.recv(4096)
+            except OSError:
+                # the client went away without reading its responses
+                break
+            if not data:
+                break
+            buffer += data
+            while TERM in buffer:
+                command, buffer = buffer.split(TERM, 1)
+                if command == b'tcl_notifications on':
+                    response = b'Tcl Notifications: on' + TERM
+                    self.listeners.append(conn)
+                else:
+                    self.pause(command)
+                    try:
+                        response = self.evaluate(command) + TERM
+                    except ValueError as e:
+                        response = str(e).encode() + TERM
+                with self.lock:
+                    try:
+                        for idx in range(0, len(response), self.piece):
+                            conn.sendall(response[idx:idx+self.piece])
+                    except OSError:
+                        # see above, the next recv ends the connection
+                        buffer = b''
+        if conn in self.listeners:
+            self.listeners.remove(conn)
+        conn.close()
+
+    def pause(self, command):
+        catch = CATCH.match(command)
+        command = catch.group(1) if catch is not None else command
+        for prefix, delay in self.delays.items():
+            if command.startswith(prefix):
+                time.sleep(delay)
+
+    def notify(self, event):
+        with self.lock:
+            for conn in self.listeners:
+                conn.sendall(b'type target_event event %b\r\n' % event + TERM)
+
+    def evaluate(self, command):
+        catch = CATCH.match(command)
+        if catch is not None:
+            inner = catch.group(1)
+            try:
+                response = self.evaluate(inner)
+            except ValueError as e:
+                return b'1 ' + str(e).encode()
+            return (b'1 ' if self.failed(inner) else b'0 ') + response
+        self.commands.append(command)
+        if self.failed(command):
+            return b'invalid command name "%b"' % command.split(b' ')[0]
+        return self.responses.get(command, self.default)
+
+    def failed(self, command):
+        return command not in self.responses and self.default is None
+
+class FakeOpenOCD(FakeTclServer):
+    # stands in for the openocd executable, accepting every command, history returns the commands
+    # seen so far, one per line, shutdown exits, halt and resume send target events, and
+    # read_memory and write_memory access some sram at 0x20000000 and the DHCSR halt bit, and binary
+    # images can be written to and checksummed against 4k sector flash at 0x08000000
+    SRAM = 0x20000000
+    DHCSR = 0xe000edf0
+    FLASH = 0x08000000
+    SECTOR_SIZE = 0x1000
+
+    def __init__(self, *args, **kwargs):
+        self.sram = bytearray(0x40000)
+        self.flash = bytearray(b'\xff') * 0x200000
+        self.halted = False
+        super().__init__(*args, **kwargs)
+
+    def evaluate(self, command):
+        memory = re.match(rb'^(read|write)_memory (\w+) 32 (?:(\d+)|\{(.*)\})$', command)
+        if memory is not None:
+            self.commands.append(command)
+            return self.memory(memory.group(1), int(memory.group(2), 0), memory.group(3), memory.group(4))
+        image = re.match(rb'^(flash write_image erase|verify_image_checksum) \{(.*)\} (\w+) bin$', command)
+        if image is not None:
+            self.commands.append(command)
+            return self.image(image.group(1), image.group(2), int(image.group(3), 0))
+        if command == b'history':
+            return b'\n'.join(self.commands)
+        if command == b'shutdown':
+            threading.Timer(0.01, os._exit, args=(0,)).start()
+        # target events, sent before the command's response like openocd does
+        if command == b'halt':
+            self.halted = True
+            self.notify(b'halted')
+        elif command == b'resume':
+            self.halted = False
+            self.notify(b'resumed')
+        return super().evaluate(command)
+
+    def image(self, op, path, addr):
+        with open(path, 'rb') as file:
+            data = file.read()
+        offset = addr - self.FLASH
+        if op == b'verify_image_checksum':
+            if self.flash[offset:offset+len(data)] != data:
+                raise ValueError('checksum mismatch - attempting binary compare')
+            return b'verified %d bytes' % len(data)
+        # erase the sectors first, like openocd's write_image erase
+        start = offset & -self.SECTOR_SIZE
+        end = (offset + len(data) + self.SECTOR_SIZE - 1) & -self.SECTOR_SIZE
+        self.flash[start:end] = b'\xff' * (end - start)
+        self.flash[offset:offset+len(data)] = data
+        return b'wrote %d bytes from file %b' % (len(data), path)
+
+    def memory(self, op, addr, count, words):
+        if op == b'write':
+            for word in words.split():
+                self.sram[addr-self.SRAM:addr-self.SRAM+4] = int(word, 0).to_bytes(4, 'little')
+                addr += 4
+            return b''
+        values = []
+        for offset in range(addr, addr + 4 * int(count), 4):
+            if offset == self.DHCSR:
+                values.append((1 << 17) if self.halted else 0)
+            else:
+                values.append(int.from_bytes(self.sram[offset-self.SRAM:offset-self.SRAM+4], 'little'))
+        return b' '.join(b'0x%08x' % value for value in values)
+
+def main(argv):
+    # openocd style arguments, only the tcl port is used
+    port = 6666
+    for arg in argv:
+        match = re.match(r'^tcl_port (\d+)$', arg)
+        if match is not None:
+            port = int(match.group(1))
+    time.sleep(STARTUP_DELAY)
+    server = FakeOpenOCD({b'version': b'Open On-Chip Debugger 0.12.0'}, port=port, default=b'')
+    server.thread.join()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
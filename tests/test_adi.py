@@ -0,0 +1,62 @@
+import pytest
+
+from adi import AP_CSW, AP_IDR, AP_TAR, ACK_FAULT, DP_CTRL_STAT, DP_DPIDR, DebugPort, TransferError
+
+ROM_TABLE = 0xe00ff000
+
+@pytest.fixture
+def writes(dap, monkeypatch):
+    # count the usb packets sent to the probe
+    packets = []
+    write = dap.write
+    monkeypatch.setattr(dap, 'write', lambda data: packets.append(bytes(data)) or write(data))
+    return packets
+
+def test_register_access(dap, writes):
+    dap.configure_swd()
+    dap.power_up()
+    dp = DebugPort(dap)
+    assert(dp.read_dp(DP_DPIDR).result() == 0x2ba01477)
+    ap = dp.ap(0)
+    assert(ap.read(AP_IDR).result() == 0x24770011)
+
+    # SELECT, CSW, and TAR are only written when they change
+    del writes[:]
+    ap.write(AP_CSW, 0x22000012)
+    ap.write(AP_CSW, 0x22000012)
+    ap.write(AP_TAR, 0x20000000)
+    ap.write(AP_TAR, 0x20000000)
+    # SELECT bank 0, CSW, and TAR
+    assert(len(writes) == 3)
+
+def test_rom_table_walk(dap, writes):
+    dap.configure_swd()
+    dap.power_up()
+    dp = DebugPort(dap)
+    ap = dp.ap(0)
+    del writes[:]
+    # entries and component id registers, queued and sent together, with TAR following the
+    # auto increment of sequential reads
+    with dp.batch():
+        entries = [ap.read32(ROM_TABLE + 4 * n) for n in range(6)]
+        cidr = [ap.read32(ROM_TABLE + 0xff0 + 4 * n) for n in range(4)]
+    assert(len(writes) == 1)
+    assert([e.result() for e in entries] == [0xfff0f003, 0xfff02003, 0xfff03003, 0xfff01003, 0xfff41003, 0xfff42003])
+    assert([c.result() for c in cidr] == [0x0d, 0x10, 0x05, 0xb1])
+
+def test_fault_recovery(dap):
+    dap.configure_swd()
+    dap.power_up()
+    dp = DebugPort(dap)
+    ap = dp.ap(0)
+    with pytest.raises(TransferError) as e:
+        with dp.batch():
+            ap.write32(0x20000000, 0x12345678)
+            ap.read32(0x30000000)
+            after = ap.read32(0x20000000)
+    assert(e.value.ack == ACK_FAULT)
+    # STICKYERR is reported, then cleared, accesses after the fault are dropped
+    assert(e.value.ctrl_stat & 0x20)
+    assert(isinstance(after.exception(), TransferError))
+    assert(not dp.read_dp(DP_CTRL_STAT).result() & 0x20)
+    assert(ap.read32(0x20000000).result() == 0x12345678)
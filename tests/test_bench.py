@@ -0,0 +1,12 @@
+import bench
+from simulator import SimBackend
+
+def test_run_compare():
+    results = bench.run(SimBackend(), iterations=5)
+    assert(all(f'latency.0x{cmd:02x}.p99_us' in results for cmd in bench.LATENCY_COMMANDS))
+    assert(all(f'swj_clock.{clock}.bytes_per_s' in results for clock in bench.SWJ_CLOCKS))
+    # no change against itself, slower latency or lower throughput is flagged
+    assert(bench.compare(results, results, 0.1) == [])
+    baseline = {'latency.0x05.p50_us': results['latency.0x05.p50_us'] / 2, 'loopback.64.bytes_per_s': 1e12}
+    regressions = bench.compare(results, baseline, 0.1)
+    assert([r[0] for r in regressions] == ['latency.0x05.p50_us', 'loopback.64.bytes_per_s'])
@@ -0,0 +1,40 @@
+import array
+import time
+
+import codec
+
+def test_encode_decode(dap):
+    dap.configure_swd()
+    encoder = codec.Encoder(dap.packet_size)
+    request = encoder.encode(codec.DAP_SWJ_CLOCK, 1000000)
+    assert(bytes(request) == b'\x11\x40\x42\x0f\x00')
+    command, fields, tail = codec.decode_response(dap.command(bytes(request)))
+    assert(command.name == 'swj_clock' and fields == (0,) and len(tail) == 0)
+
+    request = codec.encode(codec.DAP_TRANSFER, 0, 2, tail=b'\x02\x06')
+    assert(codec.decode_request(request)[1] == (0, 2))
+    command, (count, ack), _ = codec.decode_response(dap.command(request))
+    assert((count, ack) == (2, 1))
+    # DPIDR, then CTRL/STAT
+    assert(codec.transfer_words(dap.command(request))[0] == 0x2ba01477)
+
+    command, (status, idcode), _ = codec.decode_response(dap.command(b'\x16\x00'))
+    assert(command.name == 'jtag_idcode')
+
+def test_decode_words():
+    responses = [
+        b'\x06\x03\x00\x01' + array.array('I', [1, 2, 3]).tobytes(),
+        b'\x05\x02\x01' + array.array('I', [4, 5]).tobytes(),
+        b'\x06\x00\x00\x02',
+    ]
+    out = codec.decode_words(responses, array.array('I', [0]))
+    assert(list(out) == [0, 1, 2, 3, 4, 5])
+    assert(list(codec.block_words(responses[0])) == [1, 2, 3])
+
+    # comfortably over a million words a second, in full 512 byte packets
+    packet = b'\x06\x7f\x00\x01' + bytes(range(256)) * 2
+    responses = [packet[:4 + 4 * 127]] * 2000
+    start = time.perf_counter()
+    words = codec.decode_words(responses)
+    assert(len(words) == 127 * 2000)
+    assert(len(words) / (time.perf_counter() - start) > 1e6)
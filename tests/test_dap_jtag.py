@@ -268,3 +268,26 @@ def test_jtag_transfer_commands(dap):
     data = dap.read(1, timeout=10)
     # command doesn't return anything
     assert(len(data) == 0)
+
+def test_execute_queue_commands(dap):
+    dap.configure_jtag()
+    # the same idcode reads as above, but with all commands sent in a single packet
+    with dap.batch() as batch:
+        batch.command(b'\x15\x02\x04\x05', expect=b'\x15\x00')
+        idcode = batch.command(b'\x16\x00', expect=b'\x16\x00\x77\x04\xa0\x4b')
+        batch.command(b'\x00\xff', expect=b'\x00\x02\x00\x02')
+        # incomplete commands inside a batch still produce an error byte
+        error = batch.command(b'\x00\xbb')
+        sequence = batch.command(b'\x14\x05\x41\x00\x02\x00\xa0\x00\x00\x00\x00\x42\x00\x01\x00')
+    assert(idcode.result() == b'\x16\x00\x77\x04\xa0\x4b')
+    assert(error.result() == b'\xff')
+    assert(sequence.result() == b'\x14\x00\x77\x04\xa0\x4b')
+
+    # more commands than fit in a single packet should be split across multiple packets, and
+    # queueing should produce the same responses
+    for queue in (False, True):
+        batch = dap.batch(queue=queue)
+        results = [batch.command(b'\x16\x00') for _ in range(100)]
+        assert(len(batch.packets()) == 2)
+        batch.execute()
+        assert(all(r.result() == b'\x16\x00\x77\x04\xa0\x4b' for r in results))
@@ -16,3 +16,68 @@ def test_swd_configure_sequence_commands(dap):
     # SWD sequence when configured as JTAG should response with an error status, but same length response
     dap.command(b'\x02\x02', expect=b'\x02\x02')
     dap.command(b'\x1d\x03\x08\xa5\x84\xa2', expect=b'\x1d\xff\x00\x00\x00\x00\x00\x00')
+
+def test_memory_read_write(dap):
+    dap.configure_swd()
+    dap.power_up()
+    # use the top of sram, well away from anything the target firmware is using, and cross
+    # a few 1k auto increment boundaries
+    address = 0x2009e800
+    data = bytes((n * 7) & 0xff for n in range(4096))
+    dap.write_memory(address, data)
+    assert(dap.read_memory(address, len(data)) == data)
+    # unaligned reads only return the requested bytes
+    assert(dap.read_memory(address + 1021, 7) == data[1021:1028])
+    # byte writes leave the rest of the word alone, and block writes still work after them
+    dap.write_bytes(address + 1, b'\xaa\xbb')
+    assert(dap.read_memory(address, 4) == data[0:1] + b'\xaa\xbb' + data[3:4])
+    dap.write_memory(address, data[:8])
+    assert(dap.read_memory(address, 8) == data[:8])
+
+def test_pipelined_commands(dap):
+    dap.configure_swd()
+    dap.power_up()
+    address = 0x2009e800
+    data = bytes((n * 13) & 0xff for n in range(2048))
+    with dap.pipeline() as pipeline:
+        # responses come back in submission order
+        results = [pipeline.submit(b'\x00\x04', expect=b'\x00\x062.1.1\x00') for _ in range(8)]
+        idcode = pipeline.submit(b'\x1d\x03\x08\xa5\x84\xa2')
+        # regular commands and memory access go through the pipeline while it is active
+        dap.command(b'\x13\x00', expect=b'\x13\x00')
+        dap.write_memory(address, data)
+        assert(dap.read_memory(address, len(data)) == data)
+    assert(all(r.result() == b'\x00\x062.1.1\x00' for r in results))
+    assert(idcode.result() == b'\x1d\x00\x03\x77\x14\xa0\x2b\x02')
+
+def test_pipelined_queued_batch(dap):
+    dap.configure_swd()
+    pipeline = dap.pipeline(depth=2)
+    # commands go through the pipeline as soon as it exists
+    assert(dap.active_pipeline is pipeline)
+    with pipeline:
+        # queued packets, more of them than the pipeline is deep, are answered through its reader
+        batch = dap.batch(queue=True)
+        results = [batch.command(b'\x00\x04') for _ in range(1000)]
+        assert(len(batch.packets()) > 2)
+        batch.execute()
+        dap.command(b'\x00\x04', expect=b'\x00\x062.1.1\x00')
+    assert(dap.active_pipeline is None)
+    assert(all(r.result() == b'\x00\x062.1.1\x00' for r in results))
+
+def test_configure_link_state(dap, monkeypatch):
+    packets = []
+    write = dap.write
+    monkeypatch.setattr(dap, 'write', lambda data: packets.append(bytes(data)) or write(data))
+    # a full bring-up is a single packet, with the reset pulse timed on the probe
+    dap.configure_swd(force=True)
+    assert(len(packets) == 1 and packets[0][0] == 0x7f)
+    # configuring again into the same state sends nothing
+    dap.configure_swd()
+    dap.set_clock(dap.link_clock)
+    assert(len(packets) == 1)
+    dap.command(b'\x1d\x03\x08\xa5\x84\xa2', expect=b'\x1d\x00\x03\x77\x14\xa0\x2b\x02')
+    # but anything that may disturb the line state brings the link up again
+    dap.configure_swd()
+    assert(len(packets) == 3)
+    dap.command(b'\x1d\x03\x08\xa5\x84\xa2', expect=b'\x1d\x00\x03\x77\x14\xa0\x2b\x02')
@@ -0,0 +1,86 @@
+import struct
+
+from fake_openocd import FakeOpenOCD
+from flash import FLASH_BASE, SECTOR_SIZE, FlashProgrammer, read_image, split_sectors
+from openocd import OpenOCD
+
+def connect(server):
+    openocd = OpenOCD(tcl_port=server.port)
+    openocd.tcl_sock.connect((openocd.ip, server.port))
+    return openocd
+
+def writes(server):
+    return [c for c in server.commands if c.startswith(b'flash write_image')]
+
+def test_delta_program(tmp_path):
+    server = FakeOpenOCD({}, default=b'')
+    openocd = connect(server)
+    programmer = FlashProgrammer(openocd, manifest=tmp_path / 'manifest')
+    image = bytearray((n * 7) & 0xff for n in range(10 * SECTOR_SIZE - 100))
+    path = tmp_path / 'zephyr.bin'
+    path.write_bytes(image)
+
+    # without a manifest the target is checked, and the erased flash needs everything
+    result = programmer.program(path)
+    assert((result['check'], result['sectors'], result['changed'], result['runs']) == ('target', 10, 10, 1))
+    assert(server.flash[:len(image)] == image)
+
+    # nothing to do for the same image
+    result = programmer.program(path)
+    assert((result['check'], result['changed']) == ('manifest', 0))
+    assert(len(writes(server)) == 1)
+
+    # a small change, and growing through the end of the last sector into a new one
+    image[3 * SECTOR_SIZE + 10] ^= 0xff
+    image += bytes(200)
+    path.write_bytes(image)
+    result = programmer.program(path)
+    assert((result['changed'], result['runs'], result['bytes_written']) == (3, 2, 3 * SECTOR_SIZE))
+    assert(len(writes(server)) == 3)
+    assert(server.flash[:len(image)] == image)
+
+    # flashed some other way, checking the target finds what actually differs
+    server.flash[5 * SECTOR_SIZE] ^= 0x01
+    programmer.forget()
+    result = programmer.program(path)
+    assert((result['check'], result['changed']) == ('target', 1))
+    assert(server.flash[:len(image)] == image)
+    assert(server.commands[-1] == b'reset run')
+    openocd.tcl_sock.close()
+
+def test_slow_program(tmp_path):
+    # each run is erased and programmed by one command, which takes longer than other commands
+    server = FakeOpenOCD({}, default=b'', delays={b'flash write_image': 1.2})
+    openocd = connect(server)
+    programmer = FlashProgrammer(openocd, manifest=tmp_path / 'manifest')
+    image = bytes((n * 7) & 0xff for n in range(4 * SECTOR_SIZE))
+    path = tmp_path / 'zephyr.bin'
+    path.write_bytes(image)
+    result = programmer.program(path)
+    assert((result['changed'], result['runs']) == (4, 1))
+    assert(server.flash[:len(image)] == image)
+    # the connection is back to its usual timeout, and in step
+    assert(openocd.tcl_sock.gettimeout() == 1.0)
+    assert(openocd.send(b'version') == b'')
+    openocd.tcl_sock.close()
+
+def test_read_image(tmp_path):
+    # an elf with code, initialized data loaded from flash, and a ram only segment
+    segments = [(0x08000000, b'\x01' * 0x1800), (0x08001800, b'\x02' * 0x10), (0x20000000, b'\x03' * 0x10)]
+    phoff = 52
+    offset = phoff + 32 * len(segments)
+    headers, data = b'', b''
+    for paddr, contents in segments:
+        size = len(contents)
+        headers += struct.pack('<IIIIIIII', 1, offset + len(data), paddr, paddr, size, size, 5, 4)
+        data += contents
+    header = b'\x7fELF\x01\x01\x01' + bytes(9) + struct.pack(
+        '<HHIIIIIHHHHHH', 2, 40, 1, 0x08000101, phoff, 0, 0, 52, 32, len(segments), 40, 0, 0
+    )
+    path = tmp_path / 'zephyr.elf'
+    path.write_bytes(header + headers + data)
+    assert(read_image(path) == segments)
+
+    sectors = split_sectors(read_image(path))
+    assert(list(sectors) == [FLASH_BASE, FLASH_BASE + SECTOR_SIZE])
+    assert(sectors[FLASH_BASE + SECTOR_SIZE] == b'\x01' * 0x800 + b'\x02' * 0x10 + b'\xff' * 0x7f0)
@@ -0,0 +1,59 @@
+import pytest
+import time
+
+from fake_gdb import FakeGdbStub
+from gdbrsp import GdbClient, GdbError, WATCH_WRITE
+
+def test_memory():
+    stub = FakeGdbStub()
+    with GdbClient(port=stub.port) as gdb:
+        assert(gdb.packet_size == 0x3fff and not gdb.ack)
+        # every byte value, including the ones that have to be escaped in X packets
+        data = bytes(n & 0xff for n in range(0x10000)) + b'#$}*' * 64
+        gdb.write_memory(0x20000003, data)
+        assert(stub.memory[3:3+len(data)] == data)
+        start = time.perf_counter()
+        assert(gdb.read_memory(0x20000003, len(data)) == data)
+        elapsed = time.perf_counter() - start
+        # reads are split to fill the server's packet size, writes send binary data
+        reads = [p for p in stub.packets if p[:1] == b'm']
+        writes = [p for p in stub.packets if p[:1] == b'X']
+        assert(len(reads) == -(-len(data) // ((0x3fff - 4) // 2)))
+        assert(len(writes) <= len(data) // 0x3f00 + 2)
+        assert(len(data) / elapsed > 1e6)
+        with pytest.raises(GdbError):
+            gdb.read_memory(0x10000000, 4)
+    # acks only until no-ack mode is on
+    assert(stub.acks <= 3)
+
+def test_ack_mode():
+    stub = FakeGdbStub(packet_size=0x100, no_ack=False)
+    with GdbClient(port=stub.port) as gdb:
+        assert(gdb.ack and gdb.packet_size == 0x100)
+        gdb.write_memory(0x20000000, b'}' * 300)
+        assert(gdb.read_memory(0x20000000, 300) == b'}' * 300)
+        # every reply acked, the last one may still be on its way
+        assert(stub.acks >= len(stub.packets) - 1)
+
+def test_registers_breakpoints():
+    stub = FakeGdbStub()
+    stub.registers = list(range(17))
+    with GdbClient(port=stub.port) as gdb:
+        assert(gdb.read_register_words() == list(range(17)))
+        gdb.write_register(0, 0xdeadbeef)
+        assert(gdb.read_register(0) == 0xdeadbeef)
+
+        gdb.insert_breakpoint(0x08001234)
+        gdb.insert_watchpoint(0x20000ff0, 4, WATCH_WRITE)
+        gdb.resume()
+        assert(gdb.wait_stop(timeout=1.0).startswith(b'T05'))
+        assert(gdb.read_register(15) == 0x08001234)
+        gdb.remove_breakpoint(0x08001234)
+        gdb.remove_watchpoint(0x20000ff0, 4, WATCH_WRITE)
+        assert(stub.breakpoints == set())
+
+        # runs until interrupted
+        gdb.resume()
+        with pytest.raises(TimeoutError):
+            gdb.wait_stop(timeout=0.05)
+        assert(gdb.interrupt().startswith(b'T02'))
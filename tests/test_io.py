@@ -1,5 +1,8 @@
+import pytest
 import usb.util
 
+from riceio import Loopback, RiceIO
+
 def test_write_read(usb_device):
     intf = usb.util.find_descriptor(
         usb_device.get_active_configuration(),
@@ -9,3 +12,29 @@ def test_write_read(usb_device):
 
     out_ep.write(b'testing')
     assert(in_ep.read(512).tobytes() == b'testing')
+
+@pytest.mark.no_replay
+def test_stream(usb_device):
+    results = RiceIO.open(usb_device).stream(packets=500, depth=4)
+    assert(results['failures'] == [])
+    assert((results['errors'], results['duplicates'], results['missing']) == (0, 0, 0))
+    assert(results['bytes_per_s'] > 0 and results['latency.p99_us'] >= results['latency.p50_us'])
+
+def test_stream_loopback():
+    # the stand-in keeps at most capacity packets, so the stream has to keep reading to make progress
+    loopback = Loopback(latency=0.0005, capacity=4)
+    results = RiceIO(*loopback.endpoints()).stream(packets=400, packet_size=64, depth=4)
+    assert((results['errors'], results['missing']) == (0, 0))
+    assert(results['latency.p50_us'] >= 500)
+    # several packets in flight hide some of the latency a single packet waits out
+    single = RiceIO(*loopback.endpoints()).stream(packets=100, packet_size=64, depth=1)
+    assert((single['errors'], single['missing']) == (0, 0))
+    assert(results['bytes_per_s'] > single['bytes_per_s'])
+
+    # a corrupted packet is counted, not fatal
+    write = loopback.write
+    def corrupt(data, timeout=None):
+        return write(bytes(data[:-1]) + b'\xff' if data[0] == 7 else data, timeout)
+    loopback.write = corrupt
+    results = RiceIO(*loopback.endpoints()).stream(packets=20, packet_size=64, depth=2)
+    assert((results['errors'], results['missing']) == (1, 1))
@@ -0,0 +1,41 @@
+from jtag import Jtag, JtagProgram, tms_path
+
+DEBUG_IDCODE = 0x4ba00477
+BOUNDARY_SCAN_IDCODE = 0x06470041
+
+def test_tms_path():
+    assert(tms_path('idle', 'shift-dr') == [1, 0, 0])
+    assert(tms_path('idle', 'shift-ir') == [1, 1, 0, 0])
+    assert(tms_path('exit1-dr', 'idle') == [1, 0])
+    assert(tms_path('shift-ir', 'shift-ir') == [])
+    assert(tms_path(None, 'idle') == [1, 1, 1, 1, 1, 0])
+
+def test_idcode_program(dap):
+    dap.configure_jtag()
+    # configure_jtag leaves the tap in idle, the debug tap is closest to tdo
+    jtag = Jtag(dap, state='idle')
+    jtag.configure([4, 5])
+    program = JtagProgram()
+    program.shift_ir(0, 0b1110).shift_dr(0, 32)
+    program.shift_ir(1, 0b00001).shift_dr(1, 32)
+    # the whole program, ir and dr scans for both taps, fits in a single command
+    assert(len(jtag.compile(program).commands) == 1)
+    assert(jtag.run(program) == [DEBUG_IDCODE, BOUNDARY_SCAN_IDCODE])
+    assert(jtag.state == 'idle')
+
+    # running again reuses the compiled program
+    compiled = jtag.compile(program)
+    assert(jtag.run(program) == [DEBUG_IDCODE, BOUNDARY_SCAN_IDCODE])
+    assert(jtag.compile(program) is compiled and len(jtag.cache) == 1)
+
+    # an unknown state starts with a tap reset, which also selects the idcode instruction
+    jtag.state = None
+    program = JtagProgram().shift_dr(0, 32)
+    assert(jtag.run(program) == [DEBUG_IDCODE])
+
+    # programs larger than a packet are split over several commands
+    program = JtagProgram()
+    for _ in range(100):
+        program.shift_ir(0, 0b1110).shift_dr(0, 32).idle(8)
+    assert(len(jtag.compile(program).commands) > 1)
+    assert(jtag.run(program) == [DEBUG_IDCODE] * 100)
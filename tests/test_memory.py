@@ -0,0 +1,80 @@
+import struct
+
+from fake_openocd import FakeOpenOCD
+from memory import DHCSR, TargetMemory
+from openocd import OpenOCD
+from usbtrace import TraceBuffer
+
+def traced(dap, fn):
+    # the dap packets sent while running fn
+    trace = TraceBuffer()
+    dap.trace = trace
+    try:
+        fn()
+    finally:
+        dap.trace = None
+    return trace.records()
+
+def test_memory_cache(dap):
+    dap.configure_swd()
+    dap.power_up()
+    address = 0x2009e000
+    data = bytes((n * 11) & 0xff for n in range(4096))
+    dap.write_memory(address, data)
+    mem = TargetMemory(dap, page_size=1024, pages=8)
+    mem.halt()
+    assert(mem.halted and dap.read_memory(DHCSR, 4)[2] & 0x2)
+
+    assert(mem[address+1:address+3001] == data[1:3001])
+    assert(mem.misses == 3)
+    # a halted target is only read once
+    def inspect():
+        assert(mem[address+5] == data[5])
+        assert(mem.read32(address + 1024) == int.from_bytes(data[1024:1028], 'little'))
+        assert(mem.unpack('<HHI', address + 2040) == struct.unpack_from('<HHI', data, 2040))
+        assert(bytes(mem.view(address + 100, 1800)) == data[100:1900])
+    assert(traced(dap, inspect) == [])
+
+    # writes go to the target and the cached page, unaligned ones too
+    mem[address+2:address+5] = b'abc'
+    assert(dap.read_memory(address, 8) == data[:2] + b'abc' + data[5:8])
+    assert(traced(dap, lambda: mem[address:address+8]) == [])
+
+    # writes while batching go out together on exit
+    with mem.batch():
+        def writes():
+            for n in range(64):
+                mem.write32(address + 2048 + 8 * n, n)
+        assert(traced(dap, writes) == [])
+        words = struct.unpack_from('<4I', data, 2048)
+        assert(mem.read_words(address + 2048, 4) == [0, words[1], 1, words[3]])
+        assert(dap.read_memory(address + 2048, 4) == data[2048:2052])
+    assert(dap.read_memory(address + 2048 + 8 * 63, 4) == (63).to_bytes(4, 'little'))
+
+    # running memory is read from the target each time, except the code region
+    assert(mem.read32(0x08000000) == 0xffffffff)
+    mem.resume()
+    assert(not mem.halted and dap.read_memory(DHCSR, 4)[2] & 0x2 == 0)
+    dap.write_memory(address, b'\x01\x02\x03\x04')
+    assert(mem.read32(address) == 0x04030201)
+    assert(traced(dap, lambda: mem.read32(0x08000000)) == [])
+
+def test_memory_openocd():
+    server = FakeOpenOCD({}, default=b'')
+    openocd = OpenOCD(tcl_port=server.port)
+    openocd.tcl_sock.connect((openocd.ip, server.port))
+    server.sram[:8] = b'\x01\x00\x00\x00\x02\x00\x00\x00'
+    mem = TargetMemory(openocd)
+    mem.halt()
+    reads = len(server.commands)
+    assert(mem.read_words(0x20000000, 2) == [1, 2])
+    assert(mem.read_words(0x20000000, 2) == [1, 2])
+    assert(len(server.commands) == reads + 1)
+
+    # resuming outside of TargetMemory drops the cache too
+    sequence = openocd.wait_for_state('halted')
+    openocd.send(b'resume')
+    openocd.wait_for_state('running', since=sequence)
+    server.sram[:4] = b'\x05\x00\x00\x00'
+    assert(mem.read32(0x20000000) == 5)
+    openocd.close()
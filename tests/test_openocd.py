@@ -1,7 +1,12 @@
 import pathlib
+import pytest
+import re
 import tempfile
 import time
 
+# openocd needs the real probe and target
+pytestmark = pytest.mark.hardware
+
 def test_flash_read(openocd_rtt):
     openocd, _ = openocd_rtt
     # start in a halted state
@@ -18,7 +23,7 @@ def test_flash_read(openocd_rtt):
     openocd.send(b'resume')
     assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
 
-def test_manipulate_memory(openocd_rtt):
+def test_manipulate_memory(openocd_rtt, symbols):
     openocd, rtt = openocd_rtt
     # start in a running state
     openocd.send(b'resume')
@@ -28,11 +33,14 @@ def test_manipulate_memory(openocd_rtt):
     assert(rtt.send(b'\n') == 1)
     assert(rtt.expect_bytes(b'target:~$ ') is not None)
 
-    # get the address of a global volatile variable
-    assert(rtt.send(b'test var\n') == 9)
-    address = rtt.expect_regex(rb'int \'var\' address: (0x[0-9a-fA-f]{1,8})').groups[0]
-    value = rtt.expect_regex(rb'int \'var\' value: (\d{1,10})').groups[0]
-    assert(value == b'0')
+    # get the address of a global volatile variable, from the image when it is built
+    if symbols is not None:
+        address = b'0x%x' % symbols.address('var')
+    else:
+        assert(rtt.send(b'test var\n') == 9)
+        address = rtt.expect_regex(rb'int \'var\' address: (0x[0-9a-fA-f]{1,8})').groups[0]
+        value = rtt.expect_regex(rb'int \'var\' value: (\d{1,10})').groups[0]
+        assert(value == b'0')
 
     # perform read-write-verify with openocd
     assert(b'0' in openocd.send(b'mrw %b' % (address)))
@@ -47,6 +55,9 @@ def test_manipulate_memory(openocd_rtt):
     # add a watchpoint to the above variable
     openocd.send(b'halt')
     assert(b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'))
+    # the halt below has to come from an event after this one, taken before resuming so a late event
+    # from here can't be mistaken for it
+    sequence = openocd.wait_for_state('halted')
     openocd.send(b'wp %b 4 a' % (address))
     openocd.send(b'resume')
     assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
@@ -55,18 +66,15 @@ def test_manipulate_memory(openocd_rtt):
     assert(rtt.send(b'\n') == 1)
     assert(rtt.expect_bytes(b'target:~$ ') is not None)
     assert(rtt.send(b'test setvar 1\n') == 14)
-    # halt might not happen instantly
-    end = time.time() + 0.5
-    while time.time() < end:
-        if b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'):
-            break
+    # halt might not happen instantly, wait for the halted event
+    openocd.wait_for_state('halted', timeout=0.5, since=sequence)
     assert(b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'))
     # remove the watchpoint
     openocd.send(b'rwp %b' % (address))
     openocd.send(b'resume')
     assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
 
-def test_breakpoint(openocd_rtt):
+def test_breakpoint(openocd_rtt, symbols):
     openocd, rtt = openocd_rtt
     # start in a running state
     openocd.send(b'resume')
@@ -76,13 +84,19 @@ def test_breakpoint(openocd_rtt):
     assert(rtt.send(b'\n') == 1)
     assert(rtt.expect_bytes(b'target:~$ ') is not None)
 
-    # get the address of the test function
-    assert(rtt.send(b'test fn\n') == 8)
-    address = rtt.expect_regex(rb'fn address: (0x[0-9a-fA-f]{1,8})').groups[0]
+    # get the address of the test function, from the image when it is built
+    if symbols is not None:
+        address = b'0x%x' % symbols.address('cmd_test_fn')
+    else:
+        assert(rtt.send(b'test fn\n') == 8)
+        address = rtt.expect_regex(rb'fn address: (0x[0-9a-fA-f]{1,8})').groups[0]
 
     # set a breakpoint for this function
     openocd.send(b'halt')
     assert(b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'))
+    # the halt below has to come from an event after this one, taken before resuming so a late event
+    # from here can't be mistaken for it
+    sequence = openocd.wait_for_state('halted')
     openocd.send(b'bp %b 2 hw' % (address))
     openocd.send(b'resume')
     assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
@@ -91,17 +105,39 @@ def test_breakpoint(openocd_rtt):
     assert(rtt.send(b'\n') == 1)
     assert(rtt.expect_bytes(b'target:~$ ') is not None)
     assert(rtt.send(b'test fn\n') == 8)
-    # halt might not happen instantly
-    end = time.time() + 0.5
-    while time.time() < end:
-        if b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'):
-            break
+    # halt might not happen instantly, wait for the halted event
+    openocd.wait_for_state('halted', timeout=0.5, since=sequence)
     assert(b'halted' in openocd.send(b'$_CHIPNAME.cpu curstate'))
+    if symbols is not None:
+        pc = int(re.search(rb'0x[0-9a-fA-F]+', openocd.send(b'reg pc')).group(), 16)
+        assert(symbols.symbolize(pc) == 'cmd_test_fn')
     # remove the watchpoint
     openocd.send(b'rbp all')
     openocd.send(b'resume')
     assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
 
+def test_gdb_memory(openocd_rtt, record_property):
+    openocd, _ = openocd_rtt
+    # the target stays halted while gdb is connected
+    with openocd.connect_gdb() as gdb:
+        start = time.perf_counter()
+        dump = gdb.read_memory(0x20000000, 0x4000)
+        gdb_rate = len(dump) / (time.perf_counter() - start)
+        # all of the general registers in one packet
+        assert(len(gdb.read_register_words()) >= 17)
+
+        # the same words through tcl, one command each
+        start = time.perf_counter()
+        words = openocd.send_many([b'mrw 0x%x' % (0x20000000 + 4 * n) for n in range(256)])
+        tcl_rate = len(words) * 4 / (time.perf_counter() - start)
+        assert([int(word) for word in words] == [int.from_bytes(dump[4*n:4*n+4], 'little') for n in range(256)])
+        # the rates depend on the host and the adapter speed, so they are reported (in the junit xml)
+        # rather than compared
+        record_property('gdb_bytes_per_s', round(gdb_rate))
+        record_property('tcl_bytes_per_s', round(tcl_rate))
+    openocd.send(b'resume')
+    assert(b'running' in openocd.send(b'$_CHIPNAME.cpu curstate'))
+
 def test_rtt_transfer(openocd_rtt):
     openocd, rtt = openocd_rtt
     # start in a running state
@@ -0,0 +1,44 @@
+import os
+import pytest
+import subprocess
+import sys
+
+from conftest import RICEPROBE_VID, RICEPROBE_PID
+from dap import Dap
+from probes import ProbeLock, find_serials, openocd_ports
+from shard import split
+from simulator import SimBackend, SimProbe
+
+def test_find_by_serial():
+    backend = SimBackend([SimProbe(serial='RPB1-23000000021'), SimProbe(serial='RPB1-23000000011')])
+    assert(find_serials(RICEPROBE_VID, RICEPROBE_PID, backend) == ['RPB1-23000000011', 'RPB1-23000000021'])
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=backend, serial='RPB1-23000000021')
+    assert(dap.command(b'\x00\x03') == b'\x00\x11RPB1-23000000021\x00')
+    # each probe gets its own openocd ports
+    assert(openocd_ports(0)['tcl_port'] == 6666)
+    assert(len(set(openocd_ports(0).values()) | set(openocd_ports(1).values())) == 8)
+
+def test_probe_lock(tmp_path):
+    with ProbeLock('RPB1-23000000001', tmp_path):
+        with pytest.raises(TimeoutError):
+            ProbeLock('RPB1-23000000001', tmp_path).acquire(timeout=0.2)
+        # other probes aren't affected
+        with ProbeLock('RPB1-23000000011', tmp_path):
+            pass
+    lock = ProbeLock('RPB1-23000000001', tmp_path)
+    lock.acquire(timeout=0.2)
+    lock.release()
+
+def test_split():
+    shards = split({'a': 10, 'b': 6, 'c': 5, 'd': 1}, 2)
+    assert(shards == [['a', 'd'], ['b', 'c']])
+    assert(split({'a': 1}, 1) == [['a']])
+
+def test_sharded_run():
+    # two simulated probes, each worker runs its share of the modules on its own probe
+    command = [sys.executable, 'shard.py', '--sim', 'tests/test_jtag.py', 'tests/test_adi.py', '-q']
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    process = subprocess.run(command, cwd=root, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+    assert(process.returncode == 0)
+    assert('==== RPB1-23000000001 ====' in process.stdout and '==== RPB1-23000000011 ====' in process.stdout)
+    assert(process.stdout.count(' passed') == 2)
@@ -0,0 +1,62 @@
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+from conftest import RICEPROBE_VID, RICEPROBE_PID
+from dap import Dap
+from replay import RecordingBackend, ReplayBackend, ReplayDivergence
+from simulator import SimBackend
+
+def session(backend):
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=backend)
+    dap.configure_swd()
+    dap.power_up()
+    dap.write_memory(0x20000000, bytes(range(256)) * 8)
+    data = dap.read_memory(0x20000000, 2048)
+    start = time.monotonic()
+    dap.command(b'\x09\x10\x27', expect=b'\x09\x00')
+    delay = time.monotonic() - start
+    dap.shutdown()
+    return data, delay
+
+@pytest.fixture(scope='module')
+def recording(tmp_path_factory):
+    path = tmp_path_factory.mktemp('replay') / 'session.json'
+    backend = RecordingBackend(SimBackend())
+    data, _ = session(backend)
+    backend.save(path)
+    return path, data
+
+def test_replay(recording):
+    path, data = recording
+    backend = ReplayBackend.load(path)
+    assert(session(backend)[0] == data)
+    assert(backend.remaining() == 0)
+    # with timing, the 10ms delay command takes as long as it did when recorded
+    _, delay = session(ReplayBackend.load(path, timing=True))
+    assert(delay > 0.009)
+
+def test_replay_divergence(recording):
+    path, _ = recording
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=ReplayBackend.load(path))
+    dap.configure_swd()
+    with pytest.raises(ReplayDivergence):
+        dap.command(b'\x00\x04')
+
+@pytest.mark.no_replay
+def test_suite_round_trip(tmp_path):
+    # the rest of the suite, recorded against the simulator, passes again replayed from the recording
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    path = tmp_path / 'suite.json'
+    args = [
+        sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider',
+        '--deselect', 'tests/test_replay.py::test_suite_round_trip',
+    ]
+    for options in (['--sim', f'--record={path}'], [f'--replay={path}', '--replay-timing']):
+        result = subprocess.run(args + options, cwd=root, capture_output=True, text=True)
+        assert(result.returncode == 0), result.stdout[-4000:]
+    # the recording isn't empty, so the replay did stand in for the probe
+    assert(ReplayBackend.load(path).remaining() > 0)
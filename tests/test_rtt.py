@@ -0,0 +1,124 @@
+import pytest
+import socket
+import streamexpect
+import time
+
+from conftest import RICEPROBE_VID, RICEPROBE_PID
+from dap import Dap
+from openocd import RttSocket
+from rtt import DapRtt
+from simulator import RttShell, SimBackend, SimProbe
+
+@pytest.fixture
+def rtt_pair():
+    # the far end stands in for the openocd rtt server
+    target, host = socket.socketpair()
+    rtt = RttSocket(host, size=0x10000)
+    yield target, rtt
+    target.close()
+    rtt.close()
+
+def test_channel_expect(rtt_pair):
+    target, rtt = rtt_pair
+    assert(rtt.send(b'test var\n') == 9)
+    assert(target.recv(16) == b'test var\n')
+
+    # matches split across chunks, and each expect continues after the previous match
+    target.sendall(b'int \'var\' address: 0x2000')
+    target.sendall(b'1234\r\nint \'var\' value: 0\r\ntarget:~$ ')
+    address = rtt.expect_regex(rb'int \'var\' address: (0x[0-9a-fA-f]{1,8})\r').groups[0]
+    assert(address == b'0x20001234')
+    assert(rtt.expect_regex(rb'int \'var\' value: (\d{1,10})').groups == (b'0',))
+    match = rtt.expect_bytes(b'target:~$ ')
+    assert(rtt.time_of(match.start) is not None)
+    with pytest.raises(streamexpect.ExpectTimeout):
+        rtt.expect_bytes(b'target:~$ ', timeout=0.1)
+
+def test_channel_drains_bursts(rtt_pair):
+    target, rtt = rtt_pair
+    # output that arrives while nothing is expecting is still read, up to the buffer size
+    dump = b''.join(b'0x%08x\r\n' % n for n in range(0x1000))
+    target.sendall(dump + b'target:~$ ')
+    assert(rtt.expect_bytes(b'target:~$ ').start == len(dump))
+    assert(rtt.dropped == 0)
+
+    # past the buffer size the oldest unread output is dropped and counted
+    target.sendall(dump * 3)
+    target.sendall(b'target:~$ ')
+    rtt.expect_bytes(b'target:~$ ')
+    assert(rtt.dropped > 0)
+    assert(len(rtt.data) <= rtt.size)
+
+# the channel polls the target on its own thread
+@pytest.mark.no_replay
+def test_dap_rtt(dap, usb_backend, probe_serial):
+    # with the simulator, stand in for the shell of the target firmware
+    shell = None
+    if isinstance(usb_backend, SimBackend):
+        probe = next(p for p in usb_backend.probes if p.serial == probe_serial)
+        shell = RttShell(probe.target.memory)
+        shell.start()
+    dap.configure_swd()
+    dap.power_up()
+    rtt = DapRtt(dap)
+    try:
+        # same send and expect surface as the openocd rtt channel
+        assert(rtt.send(b'\n\n') == 2)
+        assert(rtt.expect_bytes(b'target:~$ ') is not None)
+        assert(rtt.send(b'test setvar 1234567890\n') == 23)
+        assert(rtt.send(b'test var\n') == 9)
+        address = rtt.expect_regex(rb'int \'var\' address: (0x[0-9a-fA-f]{1,8})').groups[0]
+        value = rtt.expect_regex(rb'int \'var\' value: (\d{1,10})').groups[0]
+        assert(value == b'1234567890')
+        # the dap can be shared with the channel while holding its lock
+        with rtt.lock:
+            assert(dap.read_memory(int(address, 0), 4) == (1234567890).to_bytes(4, 'little'))
+
+        # output larger than the up buffer arrives intact
+        assert(rtt.send(b'test dump\n') == 10)
+        assert(rtt.expect_bytes(b'0x0000018f') is not None)
+        assert(rtt.expect_bytes(b'target:~$ ') is not None)
+        assert(rtt.dropped == 0)
+    finally:
+        rtt.close()
+        if shell is not None:
+            shell.stop()
+
+def test_dap_rtt_corrupted():
+    probe = SimProbe()
+    shell = RttShell(probe.target.memory)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd()
+    dap.power_up()
+    rtt = DapRtt(dap)
+    # an up buffer write offset past the end of the buffer fails the channel, and expect reports why
+    # rather than waiting out its timeout
+    probe.target.memory.write(shell.up + 12, 4, 0x10000)
+    start = time.monotonic()
+    with pytest.raises(ConnectionError) as e:
+        rtt.expect_bytes(b'target:~$ ', timeout=3)
+    assert(time.monotonic() - start < 1)
+    assert(isinstance(e.value.__cause__, ValueError) and 'corrupted' in str(e.value.__cause__))
+    rtt.close()
+    dap.shutdown()
+
+def test_dap_rtt_unaligned_write():
+    probe = SimProbe()
+    shell = RttShell(probe.target.memory)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd()
+    dap.power_up()
+    rtt = DapRtt(dap)
+    with rtt.lock:
+        # the bytes around an unaligned range are never read back and written, the target may be
+        # changing them
+        address = rtt.down[1]
+        dap.write_memory(address, bytes(range(16)))
+        read_memory = dap.read_memory
+        dap.read_memory = None
+        rtt._write_bytes(address + 1, b'abcdefghij')
+        rtt._write_bytes(address + 13, b'k')
+        dap.read_memory = read_memory
+        assert(dap.read_memory(address, 16) == b'\x00abcdefghij\x0b\x0ck\x0e\x0f')
+    rtt.close()
+    dap.shutdown()
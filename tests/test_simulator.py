@@ -0,0 +1,139 @@
+import json
+import pytest
+import threading
+import time
+import usb.core
+
+from conftest import RICEPROBE_VID, RICEPROBE_PID
+from dap import Dap
+from simulator import SimBackend, SimProbe
+
+def test_latency_model():
+    probe = SimProbe(packet_latency=0.002, transfer_latency=0.0001)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd()
+    dap.command(b'\x05\x00\x02\x04\x00\x00\x00\x50\x08\x00\x00\x00\x00', expect=b'\x05\x02\x01')
+
+    # each round trip pays the packet latency, each of the 100 TAR reads its own latency
+    start = time.monotonic()
+    for _ in range(10):
+        dap.command(b'\x06\x00\x64\x00\x07')
+    elapsed = time.monotonic() - start
+    assert(elapsed > 10 * (0.002 + 100 * 0.0001))
+
+def test_packet_buffering():
+    probe = SimProbe(packet_count=2)
+    dev = usb.core.find(idVendor=RICEPROBE_VID, idProduct=RICEPROBE_PID, backend=SimBackend([probe]))
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    assert(dap.packet_count == 2)
+    # the probe accepts as many packets as it has buffers for before the host must read
+    dap.write(b'\x00\x04')
+    dap.write(b'\x00\x04')
+    with pytest.raises(usb.core.USBTimeoutError):
+        dap.out_ep.write(b'\x00\x04', timeout=10)
+    assert(dap.read(512) == b'\x00\x062.1.1\x00')
+    assert(dap.read(512) == b'\x00\x062.1.1\x00')
+    dev.reset()
+
+def test_target_memory():
+    probe = SimProbe()
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    probe.target.memory.write_bytes(0x20000100, b'\x78\x56\x34\x12')
+    dap.configure_swd()
+    # power up, select ap 0 bank 0, word sized auto incrementing access, then read sram
+    request = b'\x04\x00\x00\x00\x50' + b'\x08\x00\x00\x00\x00' + b'\x01\x12\x00\x00\x22'
+    request += b'\x05\x00\x01\x00\x20' + b'\x0f'
+    dap.command(b'\x05\x00\x05' + request, expect=b'\x05\x05\x01\x78\x56\x34\x12')
+    # unmapped memory produces a fault, which is sticky until cleared
+    dap.command(b'\x05\x00\x02\x05\x00\x00\x00\x30\x0f', expect=b'\x05\x01\x04')
+    dap.command(b'\x05\x00\x01\x03', expect=b'\x05\x00\x04')
+    dap.command(b'\x05\x00\x02\x00\x04\x00\x00\x00\x03', expect=b'\x05\x02\x01\x52\x00\x00\x23')
+
+def test_pipelined_latency():
+    probe = SimProbe(packet_count=4, packet_latency=0.005)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    assert(dap.packet_count == 4)
+    # with four packets in flight the round trip latency mostly overlaps
+    start = time.monotonic()
+    with dap.pipeline() as pipeline:
+        results = [pipeline.submit(b'\x00\x04') for _ in range(20)]
+    elapsed = time.monotonic() - start
+    assert(all(r.result() == b'\x00\x062.1.1\x00' for r in results))
+    assert(elapsed < 20 * 0.005 / 2)
+
+def test_pipeline_threads():
+    probe = SimProbe(packet_count=4)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd()
+    dap.power_up()
+    dap.write_memory(0x20000000, b''.join((0x1000 + n).to_bytes(4, 'little') for n in range(8)))
+    results = [[] for _ in range(8)]
+    # let other threads run between a packet being queued and written
+    write = dap.write
+    dap.write = lambda data: time.sleep(0.0001) or write(data)
+    def read(num):
+        # SELECT, CSW, TAR, then a DRW read of this thread's own word
+        request = b'\x05\x00\x04\x08' + bytes(4) + b'\x01' + (0x22000012).to_bytes(4, 'little')
+        request += b'\x05' + (0x20000000 + 4 * num).to_bytes(4, 'little') + b'\x0f'
+        results[num] = [pipeline.submit(request) for _ in range(50)]
+    # each thread gets the responses to its own packets
+    with dap.pipeline() as pipeline:
+        threads = [threading.Thread(target=read, args=(num,)) for num in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    for num in range(8):
+        assert(all(r.result()[3:7] == (0x1000 + num).to_bytes(4, 'little') for r in results[num]))
+
+def test_pipeline_read_error():
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([SimProbe(packet_count=4)]))
+    submitted = threading.Event()
+    def read(size, timeout=None):
+        submitted.wait()
+        raise usb.core.USBTimeoutError('Operation timed out', -7, 110)
+    with dap.pipeline() as pipeline:
+        dap.read = read
+        results = [pipeline.submit(b'\x00\x04') for _ in range(3)]
+        submitted.set()
+        # the failed read fails its command, and everything after it, rather than getting out of step
+        with pytest.raises(usb.core.USBTimeoutError):
+            results[0].result()
+        for result in results[1:]:
+            with pytest.raises(ConnectionError):
+                result.result()
+        with pytest.raises(ConnectionError):
+            pipeline.submit(b'\x00\x04')
+    assert(dap.active_pipeline is None)
+
+def test_clock_autotune(tmp_path):
+    cache = str(tmp_path / 'swj_clock.json')
+    probe = SimProbe(max_clock=8000000)
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd()
+    dap.power_up()
+    # failed candidates bring the link back up without pulsing nRESET
+    resets = []
+    probe.target.reset = lambda reset=probe.target.reset: resets.append(reset())
+    clock = dap.autotune_clock(scratch=0x2009f000, cache=cache)
+    assert(resets == [])
+    # within the margin of the fastest stable rate, and the link still works at the chosen rate
+    assert(8000000 * 0.7 < clock <= 8000000 * 0.75)
+    assert(probe.clock == clock and dap.link_clock == clock)
+    assert(dap.read_idcode() == 0x2ba01477)
+    dap.write_memory(0x2009f000, b'\x78\x56\x34\x12')
+    assert(dap.read_memory(0x2009f000, 4) == b'\x78\x56\x34\x12')
+
+    # later sessions start from the cached rate, and bring-up uses it
+    dap = Dap(RICEPROBE_VID, RICEPROBE_PID, backend=SimBackend([probe]))
+    dap.configure_swd(force=True)
+    assert(dap.autotune_clock(cache=cache) == clock)
+    dap.configure_swd(force=True)
+    assert(probe.clock == clock)
+
+    # jtag has its own idcode, and so its own entry
+    dap.configure_jtag()
+    dap.configure_chain([4, 5])
+    assert(dap.autotune_clock(cache=cache) == clock)
+    with open(cache) as file:
+        assert(len(json.load(file)) == 2)
@@ -0,0 +1,86 @@
+import struct
+import time
+
+import symbols
+from symbols import EM_ARM, STT_FUNC, STT_OBJECT, SymbolIndex, read_symbols
+
+def write_elf(path, symbols, machine=EM_ARM):
+    # a 32-bit little endian elf with just a symbol table, symbols are (name, value, size, type, local)
+    strtab = bytearray(b'\x00')
+    symtab = bytearray(bytes(16))
+    # locals come first in a symbol table, then a section symbol and an arm mapping symbol to skip
+    for name, value, size, kind, local in [('', 0, 0, 3, True), ('$t', 0x08000000, 0, 0, True)] + symbols:
+        offset = len(strtab) if name else 0
+        strtab += name.encode() + b'\x00' if name else b''
+        symtab += struct.pack('<IIIBBH', offset, value, size, (0 if local else 1) << 4 | kind, 0, 1)
+    shoff = 52 + len(symtab) + len(strtab)
+    header = b'\x7fELF\x01\x01\x01' + bytes(9) + struct.pack(
+        '<HHIIIIIHHHHHH', 2, machine, 1, 0, 0, shoff, 0, 52, 0, 0, 40, 4, 0
+    )
+    sections = [
+        bytes(40),
+        struct.pack('<IIIIIIIIII', 0, 1, 6, 0x08000000, 0, 0, 0, 0, 4, 0),
+        struct.pack('<IIIIIIIIII', 0, 2, 0, 0, 52, len(symtab), 3, 3, 4, 16),
+        struct.pack('<IIIIIIIIII', 0, 3, 0, 0, 52 + len(symtab), len(strtab), 0, 0, 1, 0),
+    ]
+    with open(path, 'wb') as file:
+        file.write(header + symtab + strtab + b''.join(sections))
+
+SYMBOLS = [
+    ('var', 0x20000010, 4, STT_OBJECT, True),
+    ('main', 0x08000101, 0x40, STT_FUNC, False),
+    # thumb function address, the bit is cleared
+    ('cmd_test_fn', 0x08000141, 0x20, STT_FUNC, False),
+    ('_image_ram_start', 0x20000000, 0, 0, False),
+    ('var', 0x20000020, 4, STT_OBJECT, False),
+]
+
+def test_symbols(tmp_path):
+    path = tmp_path / 'zephyr.elf'
+    write_elf(path, SYMBOLS)
+    assert(len(read_symbols(path)) == 5)
+    index = SymbolIndex(path, cache=None)
+    assert(index.address('cmd_test_fn') == 0x08000140)
+    # the global one of a name used twice
+    assert(index['var'].address == 0x20000020 and not index['var'].local)
+    assert('_image_ram_start' in index and 'missing' not in index)
+
+    assert(index.symbolize(0x08000140) == 'cmd_test_fn')
+    assert(index.symbolize(0x0800015e) == 'cmd_test_fn+0x1e')
+    assert(index.symbolize(0x08000160) == '0x08000160')
+    symbol, offset = index.lookup(0x20000012)
+    assert((symbol.name, symbol.address, symbol.local, offset) == ('var', 0x20000010, True, 2))
+    assert(index.lookup(0x07fffff0) is None)
+
+    # a symbol nested in a function, past its end the address belongs to the function again
+    write_elf(path, SYMBOLS + [('main_loop', 0x08000110, 0x8, 0, True)])
+    index = SymbolIndex(path, cache=None)
+    assert(index.symbolize(0x0800010c) == 'main+0xc')
+    assert(index.symbolize(0x08000114) == 'main_loop+0x4')
+    assert(index.symbolize(0x08000118) == 'main+0x18')
+    assert(index.symbolize(0x0800013e) == 'main+0x3e')
+    assert(index.symbolize(0x08000140) == 'cmd_test_fn')
+
+    start = time.perf_counter()
+    for _ in range(10000):
+        index.address('var')
+        index.lookup(0x08000123)
+    assert(time.perf_counter() - start < 0.5)
+
+def test_symbol_cache(tmp_path, monkeypatch):
+    path = tmp_path / 'zephyr.elf'
+    cache = tmp_path / 'cache'
+    write_elf(path, SYMBOLS)
+    assert(SymbolIndex(path, cache).address('main') == 0x08000100)
+    assert(len(list(cache.iterdir())) == 1)
+
+    # later loads of the same file come from the cache, without parsing the elf
+    def parse(path):
+        raise AssertionError('parsed')
+    monkeypatch.setattr(symbols, 'read_symbols', parse)
+    assert(SymbolIndex(path, cache).symbolize(0x08000104) == 'main+0x4')
+    # a rebuilt image has a new hash
+    write_elf(path, SYMBOLS[:2])
+    monkeypatch.undo()
+    assert('cmd_test_fn' not in SymbolIndex(path, cache))
+    assert(len(list(cache.iterdir())) == 2)
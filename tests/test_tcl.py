@@ -0,0 +1,148 @@
+import os
+import pytest
+import socket
+import threading
+import time
+
+from fake_openocd import FakeTclServer
+from openocd import OpenOCD, OpenOCDPool, TclError
+
+FAKE_OPENOCD = os.path.join(os.path.dirname(__file__), 'fake_openocd.py')
+
+def connect(server):
+    openocd = OpenOCD(tcl_port=server.port)
+    openocd.tcl_sock.connect((openocd.ip, server.port))
+    return openocd
+
+def test_large_response():
+    dump = b''.join(b'0x%08x: %08x\n' % (n, n * 3) for n in range(0x10000))
+    server = FakeTclServer({b'version': b'Open On-Chip Debugger', b'mdw 0 0x10000': dump})
+    openocd = connect(server)
+    assert(openocd.send(b'version') == b'Open On-Chip Debugger')
+    assert(openocd.send(b'mdw 0 0x10000') == dump)
+    # the buffer grows to fit the response, and responses after it still frame correctly
+    assert(openocd.send(b'version') == b'Open On-Chip Debugger')
+
+    # streaming returns the same data in pieces, without growing the buffer to hold all of it
+    size = len(openocd.buffer)
+    chunks = list(openocd.send_stream(b'mdw 0 0x10000'))
+    assert(len(chunks) > 1 and b''.join(chunks) == dump)
+    assert(len(openocd.buffer) == size)
+    assert(list(openocd.send_stream(b'version')) == [b'Open On-Chip Debugger'])
+    openocd.tcl_sock.close()
+
+def test_send_many():
+    responses = {b'mrw 0x%08x' % (0x20000000 + 4 * n): b'%d' % n for n in range(200)}
+    responses[b'mww 0x20000000 1'] = b''
+    server = FakeTclServer(responses, piece=64)
+    openocd = connect(server)
+    commands = [b'mrw 0x%08x' % (0x20000000 + 4 * n) for n in range(200)]
+    sock = openocd.tcl_sock
+    writes = []
+    class Socket:
+        # counts the commands in each write
+        def sendall(self, data):
+            writes.append(data.count(OpenOCD.TERM))
+            sock.sendall(data)
+        def __getattr__(self, name):
+            return getattr(sock, name)
+    openocd.tcl_sock = Socket()
+    assert(openocd.send_many(commands, window=16) == [b'%d' % n for n in range(200)])
+    # a full window first, then one more as each response comes back
+    assert(writes == [16] + [1] * 184)
+    openocd.tcl_sock = sock
+
+    # commands that would unbalance the catch wrapping are rejected before anything is sent
+    for command in [b'echo {a', b'echo a}', b'echo {a\\}', b'echo \x1a']:
+        with pytest.raises(ValueError):
+            openocd.send_many([b'mrw 0x20000000', command])
+
+    # failures are reported per command, and the connection stays in step afterwards
+    commands = [b'mww 0x20000000 1', b'bogus 1', b'mrw 0x20000004', b'bogus 2']
+    with pytest.raises(TclError) as e:
+        openocd.send_many(commands)
+    assert(sorted(e.value.errors) == [1, 3])
+    assert(e.value.errors[1] == (b'bogus 1', b'invalid command name "bogus"'))
+    assert(e.value.responses == [b'', None, b'1', None])
+    assert(openocd.send(b'mrw 0x20000008') == b'2')
+    openocd.tcl_sock.close()
+
+def test_send_many_timeout():
+    responses = {b'mrw 0x%08x' % (0x20000000 + 4 * n): b'%d' % n for n in range(4)}
+    server = FakeTclServer(responses, delays={b'mrw 0x20000004': 0.3})
+    openocd = connect(server)
+    openocd.tcl_sock.settimeout(0.2)
+    # a response that comes late fails the batch, but the ones still owed are read before raising,
+    # so the next command gets its own response
+    with pytest.raises(socket.timeout):
+        openocd.send_many([b'mrw 0x%08x' % (0x20000000 + 4 * n) for n in range(3)])
+    assert(openocd.send(b'mrw 0x2000000c') == b'3')
+
+    # when they don't come at all, the connection is closed rather than left out of step
+    server.delays[b'mrw 0x20000004'] = 1.0
+    with pytest.raises(socket.timeout):
+        openocd.send_many([b'mrw 0x%08x' % (0x20000000 + 4 * n) for n in range(3)])
+    with pytest.raises(OSError):
+        openocd.send(b'mrw 0x2000000c')
+
+def test_notifications():
+    server = FakeTclServer({b'version': b'Open On-Chip Debugger', b'[target current] curstate': b'running'})
+    openocd = connect(server)
+    events = []
+    openocd.add_callback(lambda event, state: events.append((event, state)))
+    assert(openocd.notifications.state == 'running')
+    assert(openocd.wait_for_state('running') == 0)
+
+    # waits for the event, without any commands sent meanwhile
+    threading.Timer(0.05, server.notify, args=(b'halted',)).start()
+    start = time.monotonic()
+    sequence = openocd.wait_for_state('halted', timeout=1.0)
+    assert(0.04 < time.monotonic() - start < 0.5)
+    assert(server.commands == [b'[target current] curstate'])
+
+    # since skips a state already reached, events that aren't state changes count too
+    server.notify(b'gdb-start')
+    server.notify(b'resumed')
+    server.notify(b'halted')
+    assert(openocd.wait_for_state('halted', since=sequence) == sequence + 3)
+    assert(events[-3:] == [('gdb-start', None), ('resumed', 'running'), ('halted', 'halted')])
+    with pytest.raises(TimeoutError):
+        openocd.wait_for_state('running', timeout=0.05)
+
+    # command responses are still answered in order on the main connection
+    assert(openocd.send(b'version') == b'Open On-Chip Debugger')
+    openocd.notifications.close()
+    openocd.tcl_sock.close()
+
+def free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+def test_server_pool():
+    pool = OpenOCDPool()
+    # the fake server takes a while to open its port, so this only works if start waits for it
+    openocd = pool.acquire(exec=FAKE_OPENOCD, tcl_port=free_port())
+    pid = openocd.process.pid
+    assert(openocd.send(b'bp 0x08000000 2 hw') == b'')
+    pool.release(openocd)
+    history = openocd.send(b'history').split(b'\n')
+    assert(history[:2] == [b'version', b'reset run'])
+    assert(history[-5:] == [b'rtt server stop 7777', b'rtt stop', b'rbp all', b'rwp all', b'resume'])
+
+    # the next user gets the same server, without another startup or reset
+    assert(pool.acquire(exec=FAKE_OPENOCD, tcl_port=openocd.tcl_port) is openocd)
+    assert(openocd.process.pid == pid)
+    assert(openocd.send(b'history').count(b'reset run') == 1)
+
+    # a server that died is restarted and initialized again
+    openocd.process.kill()
+    openocd.process.wait()
+    pool.release(openocd)
+    assert(pool.acquire(exec=FAKE_OPENOCD, tcl_port=openocd.tcl_port) is openocd)
+    assert(openocd.process.pid != pid)
+    assert(openocd.send(b'history').split(b'\n')[:2] == [b'version', b'reset run'])
+
+    process = openocd.process
+    pool.close()
+    assert(process.poll() is not None)
@@ -0,0 +1,57 @@
+import usb.util
+
+from usbtrace import CHANNEL_DAP, CHANNEL_IO, TRACE_IN, TraceBuffer, TracedEndpoint, summarize
+
+def test_trace_dap(dap, tmp_path):
+    # packet details are queried once, outside the trace
+    dap.packet_size, dap.packet_count
+    trace = TraceBuffer()
+    dap.trace = trace
+    try:
+        for _ in range(4):
+            dap.command(b'\x00\x04', expect=b'\x00\x062.1.1\x00')
+        with dap.pipeline() as pipeline:
+            for _ in range(8):
+                pipeline.submit(b'\x00\xff')
+    finally:
+        dap.trace = None
+
+    records = trace.records()
+    writes = [r for r in records if r[4] == CHANNEL_DAP]
+    reads = [r for r in records if r[4] == CHANNEL_DAP | TRACE_IN]
+    assert(len(writes) == len(reads) == 12)
+    assert(all(r[3] == 0x00 for r in records))
+    assert([r[2] for r in reads[:4]] == [8] * 4)
+    # responses are timed from the request they answer
+    assert(all(read[0] == write[0] and read[1] >= write[1] for write, read in zip(writes, reads)))
+
+    path = tmp_path / 'dap.trace'
+    trace.dump(path)
+    assert(TraceBuffer.load(path).records() == records)
+    summary = summarize(records)
+    assert(summary['commands']['dap.0x00']['count'] == 12)
+    assert(0.0 < summary['utilization'] <= 1.0)
+
+def test_trace_io(usb_device):
+    intf = usb.util.find_descriptor(
+        usb_device.get_active_configuration(),
+        custom_match=lambda i : usb.util.get_string(usb_device, i.iInterface) == 'Rice I/O v1'
+    )
+    trace = TraceBuffer()
+    ep = TracedEndpoint(*intf.endpoints(), trace)
+    ep.write(b'testing')
+    assert(ep.read(512).tobytes() == b'testing')
+    records = [(r[2], r[3], r[4]) for r in trace.records()]
+    assert(records == [(7, ord('t'), CHANNEL_IO), (7, ord('t'), CHANNEL_IO | TRACE_IN)])
+
+def test_trace_ring():
+    # only the newest records are kept once the buffer wraps
+    trace = TraceBuffer(4)
+    for num in range(10):
+        trace.record(num * 100, num * 100 + 50, CHANNEL_DAP | TRACE_IN, num, 1)
+    assert(trace.count == 10)
+    assert([r[3] for r in trace.records()] == [6, 7, 8, 9])
+    summary = summarize(trace.records())
+    # busy for 50ns of every 100ns, with 50ns gaps between
+    assert(summary['span_ns'] == 350 and summary['busy_ns'] == 200)
+    assert(summary['gaps']['count'] == 3 and summary['gaps']['max_us'] == 0.05)
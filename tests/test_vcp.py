@@ -1,15 +1,23 @@
+import pytest
 import serial
+import sys
 
-from conftest import RICEPROBE_VID, RICEPROBE_PID
+from conftest import EDBG_VID, EDBG_PID, RICEPROBE_VID, RICEPROBE_PID
+from vcp import FrameParser, PtyPair, frame, sweep
 
-EDBG_VID = 0x03EB
-EDBG_PID = 0x2111
-
-def test_loopback():
+def open_ports(timeout=0.1):
     # use the embedded debugger VCP as the interface to the RICEProbe VCP
-    edbg_ser = serial.serial_for_url(f'hwgrep://{EDBG_VID:x}:{EDBG_PID:x}', baudrate=115200, timeout=0.1)
+    edbg_ser = serial.serial_for_url(f'hwgrep://{EDBG_VID:x}:{EDBG_PID:x}', baudrate=115200, timeout=timeout)
     # using pyserial will ensure that all of actions an OS takes while connecting to a CDC ACM device are also working
-    rice_ser = serial.serial_for_url(f'hwgrep://{RICEPROBE_VID:x}:{RICEPROBE_PID:x}', baudrate=115200, timeout=0.1)
+    rice_ser = serial.serial_for_url(
+        f'hwgrep://{RICEPROBE_VID:x}:{RICEPROBE_PID:x}', baudrate=115200, timeout=timeout
+    )
+    return edbg_ser, rice_ser
+
+# the embedded debugger vcp is on the target board
+@pytest.mark.hardware
+def test_loopback():
+    edbg_ser, rice_ser = open_ports()
 
     # riceprobe write
     rice_ser.write(b'123456')
@@ -20,3 +28,43 @@ def test_loopback():
     edbg_ser.write(b'abcdef')
     data = rice_ser.read(7)
     assert(data == b'abcdef')
+
+@pytest.mark.hardware
+def test_stream():
+    edbg_ser, rice_ser = open_ports()
+    for result in sweep(rice_ser, edbg_ser, [115200, 921600], [64, 512], frames=100):
+        for direction in ('a_to_b', 'b_to_a'):
+            stats = result[direction]
+            assert((stats['lost'], stats['corrupt'], stats['reordered'], stats['failures']) == (0, 0, 0, []))
+    edbg_ser.close()
+    rice_ser.close()
+
+@pytest.mark.skipif(sys.platform == 'win32', reason='pty stand-in needs a posix system')
+def test_stream_pty():
+    pair = PtyPair()
+    a, b = pair.ports()
+    results = sweep(a, b, [460800, 3000000], [16, 256], frames=60)
+    for result in results:
+        for direction in ('a_to_b', 'b_to_a'):
+            stats = result[direction]
+            assert((stats['received'], stats['lost'], stats['bytes_lost'], stats['failures']) == (60, 0, 0, []))
+    # the pair moves data at the baud rate, 10 bits a byte
+    assert(results[0]['a_to_b']['bytes_per_s'] < 46080 * 1.1)
+    assert(results[-1]['a_to_b']['bytes_per_s'] > results[0]['a_to_b']['bytes_per_s'] * 2)
+    a.close()
+    b.close()
+    pair.close()
+
+def test_frame_parser():
+    frames = [frame(seq, bytes(range(seq, seq + 20))) for seq in range(6)]
+    parser = FrameParser()
+    # frame 1 is dropped, frame 2 is truncated, frame 4 is corrupted, and frame 3 arrives again late
+    corrupted = frames[4][:12] + b'\x00' + frames[4][13:]
+    stream = frames[0] + frames[2][:10] + frames[3] + corrupted + frames[5] + frames[3]
+    # split at arbitrary points, as reads would
+    seen = []
+    for idx in range(0, len(stream), 7):
+        seen += [seq for seq, _ in parser.feed(stream[idx:idx+7])]
+    assert(seen == [0, 3, 5, 3])
+    # frames 1, 2 and 4 never arrived intact
+    assert((parser.lost, parser.corrupt, parser.reordered) == (3, 2, 1))
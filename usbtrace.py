@@ -0,0 +1,206 @@
+import argparse
+import collections
+import struct
+import sys
+import threading
+import time
+
+from codec import command_name
+
+# usb transfer trace records: start time and latency in nanoseconds, length, command id (the first
+# byte of the packet), and the channel with the direction in the top bit, for in transfers the start
+# is when the matching request was written, so the latency is the round trip
+RECORD = struct.Struct('<qqIBB')
+MAGIC = b'RPTRACE1'
+HEADER = struct.Struct('<8sHQ')
+
+CHANNEL_DAP = 0x00
+CHANNEL_IO = 0x01
+CHANNEL_VCP = 0x02
+TRACE_IN = 0x80
+CHANNEL_NAMES = {CHANNEL_DAP: 'dap', CHANNEL_IO: 'io', CHANNEL_VCP: 'vcp'}
+
+class TraceBuffer:
+    # fixed size ring of packed records, so recording allocates nothing, once full the oldest records
+    # are overwritten
+    def __init__(self, capacity=1 << 16):
+        self.capacity = capacity
+        self.data = bytearray(RECORD.size * capacity)
+        # records written since the start, the last capacity of which are kept
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def record(self, start, end, channel, command, length):
+        with self.lock:
+            offset = (self.count % self.capacity) * RECORD.size
+            RECORD.pack_into(self.data, offset, start, end - start, length, command, channel)
+            self.count += 1
+
+    def clear(self):
+        with self.lock:
+            self.count = 0
+
+    def _ordered(self):
+        # kept records, oldest first, as bytes
+        with self.lock:
+            if self.count <= self.capacity:
+                return bytes(self.data[:self.count * RECORD.size])
+            split = (self.count % self.capacity) * RECORD.size
+            return bytes(self.data[split:] + self.data[:split])
+
+    def records(self):
+        # (start, latency, length, command, channel) for each kept record, oldest first
+        return list(RECORD.iter_unpack(self._ordered()))
+
+    def dump(self, path):
+        data = self._ordered()
+        with open(path, 'wb') as file:
+            file.write(HEADER.pack(MAGIC, RECORD.size, self.count))
+            file.write(data)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'rb') as file:
+            magic, size, count = HEADER.unpack(file.read(HEADER.size))
+            if magic != MAGIC or size != RECORD.size:
+                raise ValueError(f'{path} is not a RICEProbe trace')
+            data = file.read()
+        trace = cls(max(len(data) // RECORD.size, 1))
+        trace.data[:len(data)] = data
+        trace.count = len(data) // RECORD.size
+        return trace
+
+class TracedEndpoint:
+    # wraps a pyusb endpoint pair, recording each write, and each read as a round trip from the write
+    # it answers (the rice i/o interface echoes writes in order)
+    def __init__(self, out_ep, in_ep, trace, channel=CHANNEL_IO):
+        self.out_ep = out_ep
+        self.in_ep = in_ep
+        self.trace = trace
+        self.channel = channel
+        self.writes = collections.deque()
+
+    def write(self, data, timeout=None):
+        start = time.perf_counter_ns()
+        written = self.out_ep.write(data, timeout)
+        self.trace.record(start, time.perf_counter_ns(), self.channel, data[0] if len(data) else 0, len(data))
+        self.writes.append(start)
+        return written
+
+    def read(self, size_or_buffer, timeout=None):
+        result = self.in_ep.read(size_or_buffer, timeout)
+        end = time.perf_counter_ns()
+        start = self.writes.popleft() if self.writes else end
+        # reads into a buffer return the length read
+        data, length = (size_or_buffer, result) if isinstance(result, int) else (result, len(result))
+        self.trace.record(start, end, self.channel | TRACE_IN, data[0] if length else 0, length)
+        return result
+
+class TracedSerial:
+    # wraps a pyserial port, recording each write and read call with its own duration
+    def __init__(self, serial, trace, channel=CHANNEL_VCP):
+        self.serial = serial
+        self.trace = trace
+        self.channel = channel
+
+    def __getattr__(self, attr):
+        return getattr(self.serial, attr)
+
+    def write(self, data):
+        start = time.perf_counter_ns()
+        written = self.serial.write(data)
+        self.trace.record(start, time.perf_counter_ns(), self.channel, data[0] if len(data) else 0, len(data))
+        return written
+
+    def read(self, size=1):
+        start = time.perf_counter_ns()
+        data = self.serial.read(size)
+        end = time.perf_counter_ns()
+        self.trace.record(start, end, self.channel | TRACE_IN, data[0] if data else 0, len(data))
+        return data
+
+def histogram(latencies):
+    # counts per power of two bucket in microseconds, bucket n holds [2^n, 2^(n+1)) us, bucket 0 also
+    # holds anything under a microsecond
+    buckets = collections.Counter(max(int(latency // 1000), 1).bit_length() - 1 for latency in latencies)
+    return dict(sorted(buckets.items()))
+
+def percentile(ordered, pct):
+    return ordered[min(len(ordered) - 1, len(ordered) * pct // 100)]
+
+def summarize(records):
+    # per dap command and per other channel round trip latencies (from in records), bus utilization as the time with a transfer
+    # in flight over the whole trace, and the idle gaps between those busy periods
+    if not records:
+        return {'commands': {}, 'span_ns': 0, 'busy_ns': 0, 'utilization': 0.0, 'gaps': {'count': 0}}
+    latencies = collections.defaultdict(list)
+    for start, latency, length, command, channel in records:
+        if channel & TRACE_IN:
+            name = CHANNEL_NAMES.get(channel & 0x7f, f'{channel & 0x7f}')
+            # only dap packets start with a command id, other channels carry plain data
+            latencies[f'{name}.0x{command:02x}' if channel & 0x7f == CHANNEL_DAP else name].append(latency)
+    commands = {}
+    for name, values in sorted(latencies.items()):
+        ordered = sorted(values)
+        commands[name] = {
+            'count': len(ordered),
+            'min_us': ordered[0] / 1000,
+            'p50_us': percentile(ordered, 50) / 1000,
+            'p99_us': percentile(ordered, 99) / 1000,
+            'max_us': ordered[-1] / 1000,
+            'histogram_us': histogram(ordered),
+        }
+
+    intervals = sorted((start, start + latency) for start, latency, _, _, _ in records)
+    busy, gaps = 0, []
+    current_start, current_end = intervals[0]
+    for start, end in intervals[1:]:
+        if start > current_end:
+            busy += current_end - current_start
+            gaps.append(start - current_end)
+            current_start = start
+        current_end = max(current_end, end)
+    busy += current_end - current_start
+    span = max(end for _, end in intervals) - intervals[0][0]
+    gaps.sort()
+    return {
+        'commands': commands,
+        'span_ns': span,
+        'busy_ns': busy,
+        'utilization': busy / span if span else 1.0,
+        'gaps': {
+            'count': len(gaps),
+            'total_us': sum(gaps) / 1000,
+            'p50_us': percentile(gaps, 50) / 1000 if gaps else 0.0,
+            'max_us': gaps[-1] / 1000 if gaps else 0.0,
+            'histogram_us': histogram(gaps),
+        },
+    }
+
+def format_summary(summary):
+    lines = []
+    for name, stats in summary['commands'].items():
+        label = command_name(int(name[-2:], 16)) if name.startswith('dap.') else ''
+        lines.append(
+            f'{name:10} {label:18} n={stats["count"]:<8} p50={stats["p50_us"]:9.1f}us '
+            f'p99={stats["p99_us"]:9.1f}us max={stats["max_us"]:9.1f}us'
+        )
+        lines.append(' ' * 30 + ' '.join(f'<{2 << n}us:{c}' for n, c in stats['histogram_us'].items()))
+    lines.append(f'span {summary["span_ns"] / 1e6:.3f}ms, utilization {summary["utilization"]:.1%}')
+    gaps = summary['gaps']
+    if gaps['count']:
+        lines.append(
+            f'idle gaps n={gaps["count"]} total={gaps["total_us"]:.1f}us p50={gaps["p50_us"]:.1f}us '
+            f'max={gaps["max_us"]:.1f}us'
+        )
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='summarize a RICEProbe usb transfer trace')
+    parser.add_argument('trace', help='trace file, from TraceBuffer.dump')
+    args = parser.parse_args(argv)
+    print(format_summary(summarize(TraceBuffer.load(args.trace).records())))
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
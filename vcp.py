@@ -0,0 +1,258 @@
+import os
+import select
+import statistics
+import struct
+import sys
+import threading
+import time
+import zlib
+
+# frame: magic, sequence number and payload length, then the payload and a crc32 of everything
+# before it, so drops, corruption, truncation and reordering all show up on the receiving side
+FRAME_MAGIC = 0xa55a
+FRAME_HEADER = struct.Struct('<HIH')
+FRAME_CRC = struct.Struct('<I')
+FRAME_OVERHEAD = FRAME_HEADER.size + FRAME_CRC.size
+MAGIC_BYTES = FRAME_MAGIC.to_bytes(2, 'little')
+# the longest payload a frame can carry, anything longer is a corrupted header
+MAX_PAYLOAD = 4096
+
+def frame(seq, payload):
+    data = FRAME_HEADER.pack(FRAME_MAGIC, seq, len(payload)) + payload
+    return data + FRAME_CRC.pack(zlib.crc32(data))
+
+class FrameParser:
+    # finds frames in a byte stream, resynchronizing on the magic after damage, and tracks sequence
+    # numbers to count lost and out of order frames
+    def __init__(self):
+        self.buffer = bytearray()
+        self.expected = 0
+        self.frames = 0
+        self.lost = 0
+        self.reordered = 0
+        self.corrupt = 0
+        # bytes skipped while looking for a frame
+        self.skipped = 0
+
+    def feed(self, data):
+        # returns (sequence, payload length) of each intact frame completed by data
+        self.buffer += data
+        frames = []
+        while True:
+            idx = self.buffer.find(MAGIC_BYTES)
+            if idx < 0:
+                # keep a trailing byte that could start the magic
+                keep = 1 if self.buffer[-1:] == MAGIC_BYTES[:1] else 0
+                self.skipped += len(self.buffer) - keep
+                del self.buffer[:len(self.buffer) - keep]
+                return frames
+            if idx:
+                self.skipped += idx
+                del self.buffer[:idx]
+            if len(self.buffer) < FRAME_HEADER.size:
+                return frames
+            _, seq, length = FRAME_HEADER.unpack_from(self.buffer)
+            if length > MAX_PAYLOAD:
+                self._damaged()
+                continue
+            end = FRAME_HEADER.size + length
+            if len(self.buffer) < end + FRAME_CRC.size:
+                return frames
+            if zlib.crc32(memoryview(self.buffer)[:end]) != FRAME_CRC.unpack_from(self.buffer, end)[0]:
+                self._damaged()
+                continue
+            del self.buffer[:end + FRAME_CRC.size]
+            self.frames += 1
+            if seq < self.expected:
+                self.reordered += 1
+            else:
+                self.lost += seq - self.expected
+                self.expected = seq + 1
+            frames.append((seq, length))
+
+    def _damaged(self):
+        # skip the magic, and look for the next frame from there
+        self.corrupt += 1
+        self.skipped += 1
+        del self.buffer[:1]
+
+class VcpStream:
+    # streams framed payloads from tx to rx (pyserial ports, or anything with the same write, read
+    # and in_waiting), writing in chunk_size pieces on one thread while reading on another
+    def __init__(self, tx, rx):
+        self.tx = tx
+        self.rx = rx
+
+    def run(self, frames=200, payload=56, chunk_size=64, idle=0.5):
+        # idle is how long the reader waits for more data once everything is written
+        data = bytearray()
+        # offset just past each frame, which is when it counts as sent
+        ends = []
+        for seq in range(frames):
+            offset = seq & 0xff
+            data += frame(seq, bytes((offset + n) & 0xff for n in range(payload)))
+            ends.append(len(data))
+        sent = [0.0] * frames
+        latencies = []
+        parser = FrameParser()
+        done = threading.Event()
+        failures = []
+        received = [0]
+        times = {}
+
+        def writer():
+            view = memoryview(data)
+            idx = 0
+            times['start'] = time.perf_counter()
+            for offset in range(0, len(data), chunk_size):
+                self.tx.write(view[offset:offset+chunk_size])
+                now = time.perf_counter()
+                written = min(offset + chunk_size, len(data))
+                while idx < frames and ends[idx] <= written:
+                    sent[idx] = now
+                    idx += 1
+            self.tx.flush()
+            done.set()
+
+        def reader():
+            last = time.perf_counter()
+            while True:
+                chunk = self.rx.read(max(self.rx.in_waiting, 1))
+                now = time.perf_counter()
+                if chunk:
+                    last = now
+                    received[0] += len(chunk)
+                    for seq, _ in parser.feed(chunk):
+                        if seq < frames:
+                            latencies.append(now - sent[seq])
+                    times['end'] = now
+                    if parser.expected >= frames:
+                        return
+                elif done.is_set() and now - last > idle:
+                    return
+
+        def run(fn):
+            try:
+                fn()
+            except Exception as e:
+                failures.append(e)
+                done.set()
+
+        threads = [threading.Thread(target=run, args=(fn,)) for fn in (reader, writer)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        elapsed = times.get('end', 0.0) - times.get('start', 0.0)
+        latencies.sort()
+        results = {
+            'frames': frames,
+            'chunk_size': chunk_size,
+            'bytes_per_s': received[0] / elapsed if elapsed > 0 else 0.0,
+            'received': parser.frames,
+            # frames never seen, including any after the last one received
+            'lost': parser.lost + frames - parser.expected,
+            'corrupt': parser.corrupt,
+            'reordered': parser.reordered,
+            'bytes_lost': len(data) - received[0],
+            'failures': [repr(e) for e in failures],
+        }
+        if latencies:
+            results.update({
+                'latency.p50_us': statistics.median(latencies) * 1e6,
+                'latency.p99_us': latencies[min(len(latencies) - 1, len(latencies) * 99 // 100)] * 1e6,
+                'latency.max_us': latencies[-1] * 1e6,
+            })
+        return results
+
+def duplex(a, b, **kwargs):
+    # streams a to b and b to a at the same time, each direction on its own writer and reader
+    results = {}
+    def run(name, tx, rx):
+        results[name] = VcpStream(tx, rx).run(**kwargs)
+    threads = [
+        threading.Thread(target=run, args=('a_to_b', a, b)),
+        threading.Thread(target=run, args=('b_to_a', b, a)),
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def sweep(a, b, baudrates, chunk_sizes, **kwargs):
+    # full duplex results for each baud rate and chunk size, both ports are switched to each rate
+    results = []
+    for baudrate in baudrates:
+        a.baudrate = b.baudrate = baudrate
+        for chunk_size in chunk_sizes:
+            a.reset_input_buffer()
+            b.reset_input_buffer()
+            result = duplex(a, b, chunk_size=chunk_size, **kwargs)
+            results.append({'baudrate': baudrate, 'chunk_size': chunk_size, **result})
+    return results
+
+class PtyPair:
+    # two pseudo terminals joined back to back, standing in for the rice and embedded debugger vcps,
+    # open each end with pyserial at ports(), and with throttle, data moves at the baud rate the
+    # receiving end is set to (10 bits a byte), as it would over a uart
+    def __init__(self, throttle=True):
+        if sys.platform == 'win32':
+            raise ValueError('pty stand-in needs a posix system')
+        import pty
+        import termios
+        self.termios = termios
+        self.throttle = throttle
+        # termios speed constants to baud rates
+        self.speeds = {
+            getattr(termios, name): int(name[1:])
+            for name in dir(termios) if name[:1] == 'B' and name[1:].isdigit()
+        }
+        self.ends = [pty.openpty() for _ in range(2)]
+        self.names = [os.ttyname(slave) for _, slave in self.ends]
+        self.running = True
+        (master_a, slave_a), (master_b, slave_b) = self.ends
+        self.threads = [
+            threading.Thread(target=self._bridge, args=(master_a, master_b, slave_b), daemon=True),
+            threading.Thread(target=self._bridge, args=(master_b, master_a, slave_a), daemon=True),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def ports(self, baudrate=115200, timeout=0.1):
+        import serial
+        return tuple(serial.Serial(name, baudrate=baudrate, timeout=timeout) for name in self.names)
+
+    def close(self):
+        self.running = False
+        for thread in self.threads:
+            thread.join(1.0)
+        for master, slave in self.ends:
+            os.close(master)
+            os.close(slave)
+
+    def _rate(self, slave):
+        # bytes per second at the slave's baud rate, None when it isn't a standard rate
+        baudrate = self.speeds.get(self.termios.tcgetattr(slave)[5])
+        return baudrate / 10 if baudrate else None
+
+    def _bridge(self, source, dest, dest_slave):
+        ready = time.perf_counter()
+        while self.running:
+            if not select.select([source], [], [], 0.05)[0]:
+                continue
+            rate = self._rate(dest_slave) if self.throttle else None
+            try:
+                # a couple of milliseconds of data at a time when throttled, to keep latency realistic
+                data = os.read(source, 4096 if rate is None else max(16, int(rate * 0.002)))
+            except OSError:
+                # the slave side isn't open
+                time.sleep(0.01)
+                continue
+            if rate is not None:
+                ready = max(ready, time.perf_counter()) + len(data) / rate
+                time.sleep(max(ready - time.perf_counter(), 0))
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dest, view):]